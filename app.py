@@ -1,10 +1,40 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
-import google.generativeai as genai
+from flask import Flask, Response, g, has_request_context, render_template, request, jsonify, redirect, url_for, session
+import click
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import os
-from supabase import create_client, Client
+from PIL import Image, ImageChops, ImageFilter, ImageOps, ImageStat
+import atexit
+import base64
+import csv
+import gzip
+import hashlib
+import io
 import json
+import math
+import mimetypes
+import posixpath
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+from collections import Counter, OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from werkzeug.exceptions import NotFound, RequestEntityTooLarge
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
 
 load_dotenv()
 app = Flask(__name__)
@@ -14,45 +44,2126 @@ app.secret_key = os.getenv('FLASK_SECRET_KEY', 'your-secret-key-here')  # use en
 SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
 SUPABASE_KEY = os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
 
+# Local verification of Supabase access tokens; projects with asymmetric signing keys use the JWKS
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")  # HS256 projects (Settings > API > JWT secret)
+JWKS_CACHE_TTL = int(os.getenv("JWKS_CACHE_TTL", 3600))
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", 120))  # seconds before expiry to refresh
+SUPABASE_CLIENT_POOL_SIZE = int(os.getenv("SUPABASE_CLIENT_POOL_SIZE", 500))  # per-user clients kept
+SESSION_STORE_TTL = int(os.getenv("SESSION_STORE_TTL", 30 * 24 * 3600))  # idle seconds a refresh token is kept
+
 # Gemini / Generative AI key
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY")
 
-# Create Supabase client with proper error handling
-supabase: Client = None
-if SUPABASE_URL and SUPABASE_KEY:
+# Upstream overrides, e.g. to point the app at the local fakes in bench/
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")  # served over REST when set
+OPENWEATHER_BASE_URL = os.getenv("OPENWEATHER_BASE_URL", "https://api.openweathermap.org").rstrip("/")
+
+# When each process builds its Supabase/Gemini clients: background (after start), eager or lazy (first use)
+CLIENT_WARMUP = os.getenv("CLIENT_WARMUP", "background").lower()
+
+# Weather cache configuration (seconds / entries / degrees)
+WEATHER_CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", 600))
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", 4096))
+WEATHER_NEGATIVE_TTL = int(os.getenv("WEATHER_NEGATIVE_TTL", 3600))
+WEATHER_GRID_DEGREES = float(os.getenv("WEATHER_GRID_DEGREES", 0.1))  # ~11 km cells
+WEATHER_BULK_MAX = int(os.getenv("WEATHER_BULK_MAX", 100))  # locations per /weather/bulk request
+WEATHER_BULK_CONCURRENCY = int(os.getenv("WEATHER_BULK_CONCURRENCY", 8))  # lookups in flight per request
+
+# Bounded pool for independent I/O (Supabase, OpenWeather) fanned out per request
+IO_POOL_WORKERS = int(os.getenv("IO_POOL_WORKERS", 16))
+CHAT_STAGE_TIMEOUT = float(os.getenv("CHAT_STAGE_TIMEOUT", 6))  # seconds per pre-LLM lookup
+
+# Per-user profile context cache
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 900))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 10000))
+
+# Opt-in cache of Gemini answers for near-identical questions
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 6 * 3600))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 5000))
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", 0.75))  # Jaccard similarity
+
+# Write-behind persistence of chat messages
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", 100))  # rows per bulk insert
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", 0.5))  # seconds
+PERSIST_MAX_RETRIES = int(os.getenv("PERSIST_MAX_RETRIES", 5))
+
+# Conversation memory: recent turns verbatim plus a rolling summary of older ones
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", 6))
+HISTORY_SUMMARY_EVERY = int(os.getenv("HISTORY_SUMMARY_EVERY", 4))  # older turns folded in per summary refresh
+HISTORY_TURN_CHARS = int(os.getenv("HISTORY_TURN_CHARS", 600))  # each remembered message is clipped to this
+HISTORY_SUMMARY_CHARS = int(os.getenv("HISTORY_SUMMARY_CHARS", 1200))
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", 5000))  # conversations held in memory
+
+# History API page sizes (?limit= is capped at the max)
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 20))
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", 100))
+
+# Pest checker image preprocessing
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 15 * 1024 * 1024))
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", 1024))  # pixels on the longest side
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", 85))
+
+# Local pre-filter for pest checker uploads (runs before any vision model call)
+PREFILTER_MODE = os.getenv("PREFILTER_MODE", "flag").lower()  # flag, reject or off
+PREFILTER_THRESHOLD = float(os.getenv("PREFILTER_THRESHOLD", 0.2))  # plant score (0-1) below this is not a crop photo
+PREFILTER_MIN_SHARPNESS = float(os.getenv("PREFILTER_MIN_SHARPNESS", 50))  # edge variance; lower is too blurry
+
+# Multi-image field surveys (/pest-checker/batch)
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 4))  # concurrent vision calls per process, shared by all batches
+BATCH_REQUEST_WORKERS = int(os.getenv("BATCH_REQUEST_WORKERS", 2))  # of those, how many one batch may hold
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", 100))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 200 * 1024 * 1024))
+BATCH_ITEM_TIMEOUT = float(os.getenv("BATCH_ITEM_TIMEOUT", 60))  # seconds per image from submission to the pool
+# Request bodies are capped per endpoint (see _limit_request_body); larger ones get a 413 before parsing
+MAX_FORM_BYTES = int(os.getenv("MAX_FORM_BYTES", 1024 * 1024))  # login, chat and the other form/JSON routes
+app.config["MAX_CONTENT_LENGTH"] = MAX_FORM_BYTES
+
+# Diagnosis cache for repeated pest-checker photos
+DIAGNOSIS_CACHE_TTL = int(os.getenv("DIAGNOSIS_CACHE_TTL", 7 * 24 * 3600))
+DIAGNOSIS_CACHE_SIZE = int(os.getenv("DIAGNOSIS_CACHE_SIZE", 5000))
+DIAGNOSIS_PHASH_DISTANCE = int(os.getenv("DIAGNOSIS_PHASH_DISTANCE", 4))  # max differing bits for a near match
+DIAGNOSIS_CACHE_PATH = os.getenv("DIAGNOSIS_CACHE_PATH")  # optional SQLite file; memory only when unset
+
+# Forecast cache and background refresh of frequently requested locations
+FORECAST_CACHE_TTL = int(os.getenv("FORECAST_CACHE_TTL", 1800))
+WEATHER_REFRESH_INTERVAL = int(os.getenv("WEATHER_REFRESH_INTERVAL", 300))  # seconds; 0 disables
+HOT_LOCATION_WINDOW = int(os.getenv("HOT_LOCATION_WINDOW", 3600))  # seconds since last request
+HOT_LOCATION_LIMIT = int(os.getenv("HOT_LOCATION_LIMIT", 50))  # locations refreshed per pass
+ACTIVE_USER_WINDOW = int(os.getenv("ACTIVE_USER_WINDOW", 24 * 3600))  # prefetch for users seen this recently
+OPENWEATHER_PREFETCH_RPM = int(os.getenv("OPENWEATHER_PREFETCH_RPM", 30))  # quota share for prefetching
+PREFETCH_PEAK_HOURS = os.getenv("PREFETCH_PEAK_HOURS", "4-9")  # local hours, e.g. "4-9,17-19"
+PREFETCH_PEAK_INTERVAL = int(os.getenv("PREFETCH_PEAK_INTERVAL", 120))  # seconds between passes at peak
+PREFETCH_TZ_OFFSET = timedelta(minutes=int(os.getenv("PREFETCH_TZ_OFFSET_MINUTES", 330)))  # IST
+
+# OpenWeather HTTP client: pooled keep-alive connections, bounded retries, circuit breaker
+OPENWEATHER_POOL_SIZE = int(os.getenv("OPENWEATHER_POOL_SIZE", 20))
+OPENWEATHER_RETRIES = int(os.getenv("OPENWEATHER_RETRIES", 2))
+OPENWEATHER_CONNECT_TIMEOUT = float(os.getenv("OPENWEATHER_CONNECT_TIMEOUT", 2))
+OPENWEATHER_READ_TIMEOUT = float(os.getenv("OPENWEATHER_READ_TIMEOUT", 5))
+OPENWEATHER_BREAKER_THRESHOLD = int(os.getenv("OPENWEATHER_BREAKER_THRESHOLD", 5))  # consecutive failures
+OPENWEATHER_BREAKER_RESET = float(os.getenv("OPENWEATHER_BREAKER_RESET", 30))  # seconds before a probe
+
+# Gemini admission control (per process: divide the model quota across workers)
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", 60))  # requests per minute
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", 10))
+GEMINI_MAX_CONCURRENT = int(os.getenv("GEMINI_MAX_CONCURRENT", 16))  # calls in flight
+GEMINI_USER_CONCURRENT = int(os.getenv("GEMINI_USER_CONCURRENT", 2))  # calls per user, running or queued
+GEMINI_QUEUE_SIZE = int(os.getenv("GEMINI_QUEUE_SIZE", 64))  # callers allowed to wait for a slot
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", 10))  # seconds a caller may wait
+
+# Add a Server-Timing header to every response (always available per request with ?timing=1)
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+
+# Rendered pages and static assets: pre-compressed once, revalidated with ETags
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", 2000))  # (template, user) renders kept
+PAGE_CACHE_TTL = int(os.getenv("PAGE_CACHE_TTL", 24 * 3600))
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))  # smaller bodies are sent as-is
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", 365 * 24 * 3600))  # fingerprinted asset URLs
+
+# Local PIN code -> coordinates index (SQLite file, created on first use)
+GEOCODE_INDEX_PATH = os.getenv(
+    "GEOCODE_INDEX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "geocode_index.sqlite3"),
+)
+
+# Server-side refresh tokens (SQLite file shared by the workers on this host); the cookie only holds a session id
+SESSION_STORE_PATH = os.getenv(
+    "SESSION_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions.sqlite3"),
+)
+
+class Lazy:
+    """A client built on first use, once per process, safe to race from many threads.
+
+    Importing the Gemini and Supabase SDKs costs most of a second, so the
+    module imports neither; ``get()`` builds the value the first time it is
+    needed and ``peek()`` returns it only if that already happened.
+    """
+
+    instances = []
+
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.init_seconds = None
+        self._value = None
+        self._ready = False
+        self._lock = threading.Lock()
+        Lazy.instances.append(self)
+
+    def get(self):
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    started = time.perf_counter()
+                    self._value = self.factory()
+                    self.init_seconds = time.perf_counter() - started
+                    self._ready = True
+        return self._value
+
+    def peek(self):
+        return self._value if self._ready else None
+
+    def reset(self):
+        # After fork() the parent's client (and possibly a held lock) must not be reused
+        self._lock = threading.Lock()
+        self._value = None
+        self._ready = False
+        self.init_seconds = None
+
+def _create_supabase():
+    """Create Supabase client with proper error handling."""
+    if not (SUPABASE_URL and SUPABASE_KEY):
+        print("Supabase URL or Key not configured. SUPABASE_URL/SUPABASE_KEY environment variables required.")
+        return None
+    from supabase import create_client
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        return create_client(SUPABASE_URL, SUPABASE_KEY)
     except Exception as e:
         print(f"Failed to create Supabase client: {e}")
-        supabase = None
-else:
-    print("Supabase URL or Key not configured. SUPABASE_URL/SUPABASE_KEY environment variables required.")
+        return None
+
+# Supabase client; created per process on first use or by the warm-up in create_app
+supabase_client = Lazy("supabase", _create_supabase)
+
+def get_supabase():
+    """The shared Supabase client, or None when it is not configured."""
+    return supabase_client.get()
 
 # Configure Gemini / Generative AI
-if GEMINI_API_KEY:
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        # Initialize a default model object for simple text generation (if supported by your genai version)
+class ModelRegistry:
+    """Resolves one GenerativeModel per endpoint on first use and hands out the same instance.
+
+    Each endpoint has an ordered list of candidate model names. With
+    ``verify=True`` every candidate is probed with a tiny ``count_tokens`` call,
+    so a retired or unavailable model falls through to the next name instead of
+    failing on the first user request. ``configure`` runs once before the first
+    resolve and returns False when Gemini is not available at all.
+    """
+
+    def __init__(self, candidates_by_endpoint, configure=None, verify=False):
+        self.candidates = candidates_by_endpoint
+        self.configure = configure
+        self.verify = verify
+        self.selected = {}
+        self._models = {}
+        self._setup = Lazy("gemini", self._load)
+
+    def _load(self):
         try:
-            model = genai.GenerativeModel("gemini-2.0-flash")
-        except Exception:
-            try:
-                model = genai.GenerativeModel("gemini-2.0-flash")
-            except Exception:
+            if self.configure is None or self.configure():
+                self.resolve(verify=self.verify)
+        except Exception as e:
+            print(f"Failed to configure Gemini API key: {e}")
+        return self
+
+    def resolve(self, verify=False):
+        import google.generativeai as genai
+        instances = {}
+        for endpoint, names in self.candidates.items():
+            self._models[endpoint] = None
+            self.selected[endpoint] = None
+            for name in names:
                 try:
-                    model = genai.GenerativeModel("gemini")
-                except Exception:
-                    try:
-                        model = genai.GenerativeModel("gemini-2.0")
-                    except Exception:
-                        model = None
+                    if name not in instances:
+                        candidate = genai.GenerativeModel(name)
+                        if verify:
+                            candidate.count_tokens("ping")
+                        instances[name] = candidate
+                except Exception as e:
+                    print(f"Model '{name}' unavailable for {endpoint}: {e}")
+                    continue
+                self._models[endpoint] = instances[name]
+                self.selected[endpoint] = name
+                break
+            if self._models[endpoint] is None:
+                print(f"No usable Gemini model for {endpoint}; tried {', '.join(names)}")
+        return self
+
+    def get(self, endpoint):
+        self._setup.get()
+        return self._models.get(endpoint)
+
+    def status(self):
+        self._setup.get()
+        return {endpoint: {"selected": self.selected.get(endpoint), "candidates": names}
+                for endpoint, names in self.candidates.items()}
+
+
+def _model_candidates(env_name, default):
+    return [name.strip() for name in os.getenv(env_name, default).split(",") if name.strip()]
+
+def _configure_gemini():
+    if not GEMINI_API_KEY:
+        print("GEMINI_API_KEY is not set. Vision and text generation endpoints will be disabled.")
+        return False
+    import google.generativeai as genai
+    if GEMINI_API_ENDPOINT:
+        genai.configure(api_key=GEMINI_API_KEY, transport="rest",
+                        client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+    else:
+        genai.configure(api_key=GEMINI_API_KEY)
+    return True
+
+# Ordered candidates per endpoint; override with a comma-separated list
+model_registry = ModelRegistry({
+    "chat": _model_candidates("CHAT_MODELS", "gemini-2.0-flash,gemini-1.5-flash,gemini-pro,gemini-1.5-pro"),
+    "vision": _model_candidates("VISION_MODELS", "gemini-2.0-flash,gemini-1.5-flash,gemini-pro-vision"),
+}, configure=_configure_gemini, verify=os.getenv("MODEL_WARMUP", "false").lower() in ("1", "true", "yes"))
+
+# ---------- SERVING ----------
+
+_initialized_pid = None
+_init_lock = threading.Lock()
+
+def create_app():
+    """Returns the app, starting client warm-up for this process on the first call.
+
+    Supabase, Gemini and the session verifier are built lazily on first use,
+    once per process, so each gunicorn worker builds its own instead of
+    inheriting them across fork(). CLIENT_WARMUP picks when that happens:
+    ``background`` builds them on a thread as soon as the worker starts,
+    ``eager`` before this returns and ``lazy`` on the first request that needs one.
+    """
+    global _initialized_pid
+    if _initialized_pid != os.getpid():
+        with _init_lock:
+            if _initialized_pid != os.getpid():
+                _initialized_pid = os.getpid()
+                if CLIENT_WARMUP == "eager":
+                    init_clients()
+                elif CLIENT_WARMUP == "background":
+                    threading.Thread(target=init_clients, name="agribuddy-warmup", daemon=True).start()
+    return app
+
+def init_clients():
+    """Build every lazily created client now."""
+    try:
+        get_supabase()
+        model_registry.get("chat")
+        auth_sessions.get()
     except Exception as e:
-        print(f"Failed to configure Gemini API key: {e}")
-        model = None
-else:
-    print("GEMINI_API_KEY is not set. Vision and text generation endpoints will be disabled.")
-    model = None
+        print(f"Client warm-up failed: {e}")
+
+def _reset_after_fork():
+    # Threads, executors and SQLite handles don't survive fork(); the child builds its own lazily
+    global io_pool, vision_pool
+    io_pool = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS, thread_name_prefix="agribuddy-io")
+    vision_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="agribuddy-vision")
+    for lazy in Lazy.instances:
+        lazy.reset()
+    conversation_memory.reset_pool()
+    weather_prefetcher.reset()
+    message_writer.reset()
+    geocode_index.reset()
+    diagnosis_cache.reset()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+# Requests and response streams still running; drain() waits for both
+_in_flight = {"requests": 0, "streams": 0}
+_in_flight_lock = threading.Lock()
+_draining = threading.Event()
+
+def _count_in_flight(kind, delta):
+    with _in_flight_lock:
+        _in_flight[kind] += delta
+
+def streaming_response(body, **kwargs):
+    """Response for a streaming body; shutdown waits until it has been sent in full."""
+    response = Response(body, **kwargs)
+    # Counted from here rather than inside the generator: the request is torn down before the body is sent
+    _count_in_flight("streams", 1)
+    response.call_on_close(lambda: _count_in_flight("streams", -1))
+    return response
+
+# Registered ahead of the other request hooks so clients exist by the time they run
+@app.before_request
+def _admit_request():
+    create_app()
+    if _draining.is_set():
+        response = jsonify({"error": "Server is restarting, please retry"})
+        response.status_code = 503
+        response.headers["Retry-After"] = "1"
+        response.headers["Connection"] = "close"
+        return response
+    g.counted_in_flight = True
+    _count_in_flight("requests", 1)
+
+@app.teardown_request
+def _release_request(exc):
+    if g.pop("counted_in_flight", False):
+        _count_in_flight("requests", -1)
+
+def drain(timeout=30.0):
+    """Graceful shutdown: refuse new requests, let in-flight requests and streams finish,
+    then flush conversation summaries and queued writes."""
+    _draining.set()
+    deadline = time.monotonic() + timeout
+    while (_in_flight["requests"] or _in_flight["streams"]) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if _in_flight["requests"] or _in_flight["streams"]:
+        print(f"Shutting down with {_in_flight['requests']} requests and {_in_flight['streams']} streams still open")
+    weather_prefetcher.stop()
+    # Summaries enqueue their own writes, so they finish before the writer is closed
+    conversation_memory.close()
+    io_pool.shutdown(wait=True)
+    vision_pool.shutdown(wait=True)
+    message_writer.close(timeout=max(1.0, deadline - time.monotonic()))
+
+# ---------- METRICS ----------
+
+class Metrics:
+    """Minimal in-process Prometheus registry: labelled counters, gauges and histograms.
+
+    Collectors registered with ``register_collector`` are called at scrape time
+    and return ``(name, type, labels, value)`` tuples, which lets existing stats
+    dictionaries (caches, queues, breakers) be exported without double bookkeeping.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge_add(self, name, amount, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        samples = {}  # name -> (type, [lines])
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, ("counter", []))[1].append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), value in gauges.items():
+            samples.setdefault(name, ("gauge", []))[1].append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), hist in histograms.items():
+            lines = samples.setdefault(name, ("histogram", []))[1]
+            for bound, count in zip(self.BUCKETS, hist):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {hist[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+        for collector in self._collectors:
+            try:
+                for name, kind, labels, value in collector():
+                    if value is None:
+                        continue
+                    samples.setdefault(name, (kind, []))[1].append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+            except Exception as e:
+                print("Metrics collector failed:", str(e))
+        out = []
+        for name in sorted(samples):
+            kind, lines = samples[name]
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+
+@contextmanager
+def track(stage):
+    """Time one external call: duration histogram, error counter, in-flight gauge and Server-Timing entry."""
+    metrics.gauge_add("agribuddy_stage_in_flight", 1, stage=stage)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc("agribuddy_stage_errors_total", stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.gauge_add("agribuddy_stage_in_flight", -1, stage=stage)
+        metrics.observe("agribuddy_stage_duration_seconds", elapsed, stage=stage)
+        add_server_timing(stage, elapsed)
+
+def add_server_timing(stage, seconds):
+    # Work done on pool threads has no request context; callers add those stages explicitly
+    if has_request_context():
+        g.setdefault("server_timing", []).append((stage, seconds))
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    metrics.gauge_add("agribuddy_requests_in_flight", 1)
+
+@app.after_request
+def _record_request(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.gauge_add("agribuddy_requests_in_flight", -1)
+        metrics.observe("agribuddy_request_duration_seconds", time.perf_counter() - started, route=route)
+        metrics.inc("agribuddy_requests_total", route=route, method=request.method, status=response.status_code)
+    if SERVER_TIMING_ENABLED or request.args.get("timing"):
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in g.get("server_timing", [])]
+        if started is not None:
+            entries.append(f"total;dur={(time.perf_counter() - started) * 1000:.1f}")
+        if entries:
+            response.headers["Server-Timing"] = ", ".join(entries)
+    return response
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# ---------- CACHING HELPERS ----------
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a TTL."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                # Expired entries stay until evicted so get_stale() can fall back to them
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_stale(self, key, default=None):
+        """Return an entry even if it has expired (e.g. while an upstream is down)."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            self.stale_hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def ttl_remaining(self, key):
+        """Seconds until the entry expires (negative once expired), or None if absent."""
+        with self._lock:
+            entry = self._data.get(key)
+            return None if entry is None else entry[1] - time.monotonic()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class RateLimited(Exception):
+    """Raised when a rate limiter has no capacity left for the caller."""
+
+
+class TokenBucket:
+    """Classic token bucket: ``rate`` tokens per second, bursts up to ``capacity``."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def wait_time(self, tokens=1):
+        """Seconds until ``tokens`` would be available."""
+        with self._lock:
+            self._refill()
+            missing = tokens - self._tokens
+        return 0.0 if missing <= 0 else missing / self.rate if self.rate > 0 else float("inf")
+
+    def acquire(self, tokens=1, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.try_acquire(tokens):
+                return True
+            wait = self.wait_time(tokens)
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(min(wait, 1.0))
+
+
+class LatencyWindow:
+    """Rolling window of recent durations (seconds) for cheap percentile reporting."""
+
+    def __init__(self, size=2048):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def percentile(self, pct):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+    def summary(self):
+        def ms(value):
+            return None if value is None else round(value * 1000, 2)
+        return {
+            "count": self.count,
+            "p50_ms": ms(self.percentile(50)),
+            "p95_ms": ms(self.percentile(95)),
+            "p99_ms": ms(self.percentile(99)),
+        }
+
+
+class GeocodeIndex:
+    """PIN code -> (lat, lon, name) index stored in a memory-mapped SQLite file.
+
+    The file is opened lazily on first lookup and written through whenever the
+    geo API resolves a PIN code that is not indexed yet.
+    """
+
+    MMAP_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def _connect(self):
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                    conn.execute(f"PRAGMA mmap_size={self.MMAP_SIZE}")
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS pincodes ("
+                        "pin TEXT PRIMARY KEY, lat REAL NOT NULL, lon REAL NOT NULL, name TEXT"
+                        ") WITHOUT ROWID"
+                    )
+                    self._conn = conn
+        return self._conn
+
+    def lookup(self, pin):
+        try:
+            conn = self._connect()
+            with self._lock:
+                row = conn.execute("SELECT lat, lon, name FROM pincodes WHERE pin = ?", (pin,)).fetchone()
+        except sqlite3.Error as e:
+            print("Geocode index lookup failed:", str(e))
+            return None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row
+
+    def store_many(self, rows):
+        """Insert or replace (pin, lat, lon, name) rows; returns the number written."""
+        rows = list(rows)
+        if not rows:
+            return 0
+        try:
+            conn = self._connect()
+            with self._lock:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT OR REPLACE INTO pincodes (pin, lat, lon, name) VALUES (?, ?, ?, ?)", rows)
+                conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            print("Geocode index write failed:", str(e))
+            return 0
+        self.writes += len(rows)
+        return len(rows)
+
+    def store(self, pin, lat, lon, name):
+        return self.store_many([(pin, lat, lon, name)]) == 1
+
+    def reset(self):
+        # A SQLite connection must not be shared with a forked child; reconnect on next use
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def stats(self):
+        size = None
+        if self._conn is not None:
+            with self._lock:
+                size = self._conn.execute("SELECT COUNT(*) FROM pincodes").fetchone()[0]
+        return {"path": self.path, "entries": size, "hits": self.hits, "misses": self.misses, "writes": self.writes}
+
+
+geocode_index = GeocodeIndex(GEOCODE_INDEX_PATH)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that is known to be failing."""
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures and lets one probe through
+    every ``reset_timeout`` seconds until a call succeeds again."""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.trips += 1
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        return {"state": self.state, "consecutive_failures": self.failures, "trips": self.trips, "rejected": self.rejected}
+
+
+def _build_http_session(pool_size, retries):
+    retry_options = dict(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        backoff_factor=0.2,
+        raise_on_status=False,
+    )
+    try:
+        retry = Retry(backoff_jitter=0.3, **retry_options)
+    except TypeError:
+        # urllib3 < 2 has no jitter option
+        retry = Retry(**retry_options)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    http = requests.Session()
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http, adapter
+
+
+def _connection_pool_stats(adapter):
+    pools = adapter.poolmanager.pools
+    connections = requests_sent = 0
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is not None:
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+    return {
+        "connections_opened": connections,
+        "requests": requests_sent,
+        "reuse_ratio": round(1 - connections / requests_sent, 4) if requests_sent else 0.0,
+    }
+
+
+openweather_http, _openweather_adapter = _build_http_session(OPENWEATHER_POOL_SIZE, OPENWEATHER_RETRIES)
+openweather_breaker = CircuitBreaker(OPENWEATHER_BREAKER_THRESHOLD, OPENWEATHER_BREAKER_RESET)
+
+# Shared by /weather, /chat and the weather dashboard
+weather_cache = TTLCache(WEATHER_CACHE_SIZE, WEATHER_CACHE_TTL)
+weather_lookup_latency = LatencyWindow()
+openweather_latency = LatencyWindow()
+
+io_pool = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS, thread_name_prefix="agribuddy-io")
+
+# Rendered profile prompt context per user, dropped when the profile changes
+profile_cache = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+vision_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="agribuddy-vision")
+
+# Latest conversation id per user; new conversations are known here before they are flushed
+conversation_cache = TTLCache(10000, 24 * 3600)
+
+# Chat latency; time-to-first-token is the number users actually feel
+chat_ttft = LatencyWindow()
+chat_latency = LatencyWindow()
+openweather_stats = {"calls": 0, "errors": 0}
+_openweather_stats_lock = threading.Lock()
+_NOT_FOUND = object()  # negative-cache marker for unknown ZIP codes
+
+# ---------- GEMINI ADMISSION ----------
+
+class Overloaded(Exception):
+    """Raised when a Gemini call is not admitted; ``retry_after`` is a hint in seconds."""
+
+    def __init__(self, reason, retry_after, status=503):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.status = status
+
+
+class AdmissionController:
+    """Gate in front of every Gemini call.
+
+    A global token bucket keeps the process under the model's request quota and a
+    concurrency cap bounds calls in flight. Callers beyond the cap wait in a FIFO queue
+    up to ``queue_timeout``; once ``queue_size`` are waiting, new ones are turned away
+    at once instead of piling up on upstream 429s. Each user may hold at most
+    ``per_user`` calls (running or queued), so one farmer cannot starve the rest.
+    Background callers pass no user and only count against the global limits.
+    """
+
+    def __init__(self, bucket, max_concurrent, per_user, queue_size, queue_timeout):
+        self.bucket = bucket
+        self.max_concurrent = max_concurrent
+        self.per_user = per_user
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = deque()
+        self._by_user = Counter()
+        self._avg_hold = 2.0  # seconds, moving average of how long a call keeps its slot
+        self.admitted = 0
+        self.rejected = Counter()
+
+    def _reject(self, reason, retry_after, status=503):
+        self.rejected[reason] += 1
+        metrics.inc("agribuddy_gemini_rejected_total", reason=reason)
+        raise Overloaded(reason, retry_after, status)
+
+    def _queue_retry_after(self):
+        return self._avg_hold * (len(self._waiting) + 1) / max(1, self.max_concurrent)
+
+    def acquire(self, user_id=None, timeout=None):
+        started = time.monotonic()
+        deadline = started + (self.queue_timeout if timeout is None else timeout)
+        ticket = object()
+        with self._cond:
+            if user_id is not None and self._by_user[user_id] >= self.per_user:
+                self._reject("user_limit", self._avg_hold, status=429)
+            if self._active >= self.max_concurrent or self._waiting:
+                if len(self._waiting) >= self.queue_size:
+                    self._reject("queue_full", self._queue_retry_after())
+                self._waiting.append(ticket)
+                if user_id is not None:
+                    self._by_user[user_id] += 1
+                try:
+                    while self._waiting[0] is not ticket or self._active >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject("queue_timeout", self._queue_retry_after())
+                        self._cond.wait(remaining)
+                except Overloaded:
+                    self._forget_user(user_id)
+                    raise
+                finally:
+                    self._waiting.remove(ticket)
+                    # The next waiter may now be at the head of the queue
+                    self._cond.notify_all()
+            elif user_id is not None:
+                self._by_user[user_id] += 1
+            self._active += 1
+        # Hold the slot while waiting for quota so queue order is preserved
+        wait = self.bucket.wait_time()
+        if time.monotonic() + wait > deadline or not self.bucket.acquire(timeout=deadline - time.monotonic()):
+            self.release(user_id)
+            with self._cond:
+                self._reject("rate_limited", wait or 1)
+        with self._cond:
+            self.admitted += 1
+        metrics.observe("agribuddy_gemini_queue_wait_seconds", time.monotonic() - started)
+
+    def _forget_user(self, user_id):
+        # Caller holds self._cond; drop the key at zero so idle users don't accumulate
+        if user_id is not None:
+            self._by_user[user_id] -= 1
+            if self._by_user[user_id] <= 0:
+                del self._by_user[user_id]
+
+    def release(self, user_id=None, held=None):
+        with self._cond:
+            self._active -= 1
+            self._forget_user(user_id)
+            if held is not None:
+                self._avg_hold = 0.9 * self._avg_hold + 0.1 * held
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, user_id=None, timeout=None):
+        self.acquire(user_id, timeout)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user_id, time.monotonic() - started)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "in_flight": self._active,
+                "queued": len(self._waiting),
+                "max_concurrent": self.max_concurrent,
+                "queue_size": self.queue_size,
+                "users_active": len(self._by_user),
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "avg_call_seconds": round(self._avg_hold, 3),
+            }
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution and its result (or error)."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            metrics.inc("agribuddy_gemini_coalesced_total")
+            return call.result()
+        try:
+            result = func()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+gemini_admission = AdmissionController(
+    TokenBucket(GEMINI_RPM / 60.0, capacity=max(1, GEMINI_BURST)),
+    max_concurrent=GEMINI_MAX_CONCURRENT,
+    per_user=GEMINI_USER_CONCURRENT,
+    queue_size=GEMINI_QUEUE_SIZE,
+    queue_timeout=GEMINI_QUEUE_TIMEOUT,
+)
+gemini_flight = SingleFlight()
+
+def gemini_call(key, func, user_id=None):
+    """Run ``func`` (one Gemini request) under admission control, sharing it with identical callers."""
+    def admitted():
+        with gemini_admission.slot(user_id):
+            return func()
+    return gemini_flight.do(key, admitted)
+
+@app.errorhandler(Overloaded)
+def _overloaded(e):
+    message = "AgriBuddy is busy right now. Please try again in a moment."
+    # The chat page shows ``reply``; everything else reads ``error``
+    body = {"reply": message} if request.path.startswith("/chat") else {"error": message}
+    response = jsonify(dict(body, reason=e.reason))
+    response.status_code = e.status
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+# Upload routes get their file limit plus room for the multipart boundaries and part headers
+_UPLOAD_FRAMING = 1024 * 1024
+_UPLOAD_LIMITS = {
+    "pest_checker_post": MAX_IMAGE_BYTES + _UPLOAD_FRAMING,
+    "pest_checker_batch": BATCH_MAX_BYTES + _UPLOAD_FRAMING,
+}
+
+@app.before_request
+def _limit_request_body():
+    limit = _UPLOAD_LIMITS.get(request.endpoint)
+    if limit is not None:
+        request.max_content_length = limit
+
+@app.errorhandler(RequestEntityTooLarge)
+def _request_too_large(e):
+    limit = (request.max_content_length or MAX_FORM_BYTES) / (1024 * 1024)
+    return jsonify({"error": f"Request too large. Maximum size is {limit:g} MB"}), 413
+
+# ---------- RESPONSE CACHE ----------
+
+_QUESTION_STOPWORDS = frozenset(
+    "a an the is are was were be to of in on at for and or my our i we you me us it this that "
+    "do does did can could should would will shall what when where which how please tell about "
+    "with from by any some there here kya hai ka ki ke mein".split()
+)
+
+# Words that flip a question's meaning; a cached answer is only reused when these match exactly
+_QUESTION_NEGATIONS = frozenset(
+    "not no never none nothing without avoid stop cannot unsafe unsuitable unhealthy harmful wrong "
+    "nahi nahin mat".split()
+)
+
+def _question_negations(question):
+    text = re.sub(r"n't\b", " not", question.lower().replace("\u2019", "'"))
+    return frozenset(w for w in re.sub(r"[^\w\s]", " ", text).split() if w in _QUESTION_NEGATIONS)
+
+def _question_features(question):
+    """Word tokens plus per-word character trigrams, so word order and small typos don't matter."""
+    words = [w for w in re.sub(r"[^\w\s]", " ", question.lower()).split() if w not in _QUESTION_STOPWORDS]
+    features = set(words)
+    for word in words:
+        padded = f" {word} "
+        features.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(features)
+
+def build_shared_prompt(user_message, bucket):
+    """Prompt for an answer other farmers may be served: only the cache bucket, no personal details."""
+    state, soil_type, weather_bucket = bucket
+    prompt = "You are AgriBuddy, a helpful farmer assistant. "
+    if state:
+        prompt += f"The farmer is in {state.title()}. "
+    if soil_type:
+        prompt += f"Their soil type is {soil_type}. "
+    prompt += f"User says: '{user_message}'. "
+    condition, _, temp_band = weather_bucket.partition(":")
+    if condition != "none":
+        prompt += f"Current weather: {condition}"
+        if temp_band != "na":
+            prompt += f", around {temp_band}-{int(temp_band) + 5}°C"
+        prompt += ". "
+    return prompt
+
+def response_cache_bucket(profile, weather_info):
+    """Coarse context an answer depends on: state, soil type and a weather bucket."""
+    weather_bucket = "none"
+    if isinstance(weather_info, WeatherSnapshot):
+        description = str(weather_info.description or "")
+        for condition in ("thunder", "rain", "drizzle", "snow", "mist", "fog", "haze", "cloud", "clear"):
+            if condition in description:
+                break
+        else:
+            condition = "other"
+        temperature = weather_info.temperature
+        temp_band = int(temperature // 5 * 5) if isinstance(temperature, (int, float)) else "na"
+        weather_bucket = f"{condition}:{temp_band}"
+    return (
+        str(profile.get("state") or "").strip().lower(),
+        str(profile.get("soil_type") or "").strip().lower(),
+        weather_bucket,
+    )
+
+class ResponseCache:
+    """Similarity-matched answer cache with TTL and LRU eviction.
+
+    Questions are compared by Jaccard similarity of their token/trigram sets,
+    only against entries that share the same context bucket and the same
+    negation words ("not", "unsafe", ...). An inverted index
+    from feature to entry ids keeps lookups to the few plausible candidates.
+    """
+
+    def __init__(self, maxsize, ttl, threshold):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()  # id -> (bucket, features, answer, expires_at)
+        self._index = {}  # (bucket, feature) -> set of ids
+        self._exact = {}  # (bucket, features) -> id
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _remove(self, entry_id):
+        bucket, features, _, _ = self._entries.pop(entry_id)
+        self._exact.pop((bucket, features), None)
+        for feature in features:
+            ids = self._index.get((bucket, feature))
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._index[(bucket, feature)]
+
+    def lookup(self, question, bucket):
+        bucket = (bucket, _question_negations(question))
+        features = _question_features(question)
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_score = None, 0.0
+            if features:
+                overlaps = Counter()
+                for feature in features:
+                    overlaps.update(self._index.get((bucket, feature), ()))
+                for entry_id, overlap in overlaps.most_common(32):
+                    _, entry_features, _, expires_at = self._entries[entry_id]
+                    if expires_at <= now:
+                        continue
+                    score = overlap / (len(features) + len(entry_features) - overlap)
+                    if score > best_score:
+                        best_id, best_score = entry_id, score
+            if best_id is None or best_score < self.threshold:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id][2]
+
+    def store(self, question, bucket, answer):
+        bucket = (bucket, _question_negations(question))
+        features = _question_features(question)
+        if not features:
+            return
+        with self._lock:
+            existing = self._exact.get((bucket, features))
+            if existing is not None:
+                self._remove(existing)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (bucket, features, answer, time.monotonic() + self.ttl)
+            self._exact[(bucket, features)] = entry_id
+            for feature in features:
+                self._index.setdefault((bucket, feature), set()).add(entry_id)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_THRESHOLD)
+
+# ---------- DIAGNOSIS CACHE ----------
+
+class DiagnosisCache:
+    """Parsed pest-checker results keyed by exact (SHA-256) and perceptual image hash.
+
+    Exact hashes are looked up directly; otherwise the closest perceptual hash
+    within ``max_distance`` bits is used. Entries expire after ``ttl`` seconds
+    and the least recently used ones are evicted beyond ``maxsize``. When
+    ``path`` is set, results are also written to SQLite and the most recent ones
+    are loaded back on first use, so they survive restarts.
+    """
+
+    def __init__(self, maxsize, ttl, max_distance, path=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.path = path
+        self._entries = OrderedDict()  # sha256 -> (phash, result, expires_at)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._loaded = False
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _distinctive(phash):
+        # Flat or almost featureless images hash to (nearly) all zeros or ones and match each other
+        return 8 <= bin(phash).count("1") <= 56
+
+    def _load(self):
+        self._loaded = True
+        if not self.path:
+            return
+        try:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS diagnoses ("
+                "sha256 TEXT PRIMARY KEY, phash TEXT NOT NULL, result TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            cutoff = time.time() - self.ttl
+            rows = self._conn.execute(
+                "SELECT sha256, phash, result, created_at FROM diagnoses WHERE created_at > ? "
+                "ORDER BY created_at DESC LIMIT ?", (cutoff, self.maxsize)
+            ).fetchall()
+        except sqlite3.Error as e:
+            print("Diagnosis cache unavailable on disk:", str(e))
+            self._conn = None
+            return
+        now_wall, now = time.time(), time.monotonic()
+        for sha, phash, result, created_at in reversed(rows):
+            self._entries[sha] = (int(phash, 16), json.loads(result), now + self.ttl - (now_wall - created_at))
+
+    def get(self, prepared):
+        now = time.monotonic()
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            entry = self._entries.get(prepared.sha256)
+            if entry is not None and entry[2] > now:
+                self._entries.move_to_end(prepared.sha256)
+                self.exact_hits += 1
+                return entry[1]
+            if self._distinctive(prepared.phash):
+                best_sha, best_distance = None, self.max_distance + 1
+                for sha, (phash, _, expires_at) in self._entries.items():
+                    distance = bin(phash ^ prepared.phash).count("1")
+                    if distance < best_distance and expires_at > now:
+                        best_sha, best_distance = sha, distance
+                if best_sha is not None:
+                    self._entries.move_to_end(best_sha)
+                    self.near_hits += 1
+                    return self._entries[best_sha][1]
+            self.misses += 1
+            return None
+
+    def set(self, prepared, result):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._entries[prepared.sha256] = (prepared.phash, result, time.monotonic() + self.ttl)
+            self._entries.move_to_end(prepared.sha256)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            if self._conn is not None:
+                try:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO diagnoses (sha256, phash, result, created_at) VALUES (?, ?, ?, ?)",
+                        (prepared.sha256, f"{prepared.phash:016x}", json.dumps(result), time.time()),
+                    )
+                except sqlite3.Error as e:
+                    print("Failed to persist diagnosis:", str(e))
+
+    def reset(self):
+        # Reopen (and reload) the SQLite file in a forked child instead of sharing the parent's handle
+        self._lock = threading.Lock()
+        self._conn = None
+        self._loaded = False
+
+    def stats(self):
+        lookups = self.exact_hits + self.near_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "persistent": bool(self.path),
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.exact_hits + self.near_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+
+diagnosis_cache = DiagnosisCache(DIAGNOSIS_CACHE_SIZE, DIAGNOSIS_CACHE_TTL, DIAGNOSIS_PHASH_DISTANCE, DIAGNOSIS_CACHE_PATH)
+
+# ---------- WRITE-BEHIND PERSISTENCE ----------
+
+def _permanent_db_error(e):
+    """PostgREST errors that fail the same way on every attempt: bad rows, unknown columns, RLS, auth.
+
+    PGRST0xx (database unreachable or timed out) and errors without a code (network) are worth retrying.
+    """
+    code = str(getattr(e, "code", None) or "")
+    if code.startswith("PGRST"):
+        return not code.startswith("PGRST0")
+    # SQLSTATE classes 22 (data exception), 23 (constraint violation), 42 (undefined column, privilege)
+    return code[:2] in ("22", "23", "42")
+
+class WriteBehindQueue:
+    """Collects rows on request threads and bulk-inserts them from a background thread.
+
+    Each row is written with the client of the user it belongs to (``user_db``,
+    resolved at enqueue time), so row level security applies and one user's rows
+    never share a statement with another's.
+    A user's rows are written in enqueue order; rows for the same table that
+    arrive close together are combined into a single insert (or upsert, for rows
+    enqueued with ``upsert=True``). Failed batches are retried with exponential
+    backoff before being dropped; errors that would fail again (see
+    ``_permanent_db_error``) are dropped at once so they don't hold up the queue.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_retries):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = False
+        self.stats_counts = {"enqueued": 0, "written": 0, "batches": 0, "retries": 0, "dropped": 0}
+
+    def enqueue(self, user_id, table, rows, upsert=False):
+        if isinstance(rows, dict):
+            rows = [rows]
+        self._ensure_started()
+        # Resolved now: the user's pooled client is dropped when they log out before the flush
+        db = user_db(user_id)
+        for row in rows:
+            self._queue.put((user_id, db, table, upsert, row))
+        self.stats_counts["enqueued"] += len(rows)
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._start_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._stopping = False
+                    self._thread = threading.Thread(target=self._run, name="agribuddy-writer", daemon=True)
+                    self._thread.start()
+
+    def _take_batch(self, block):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval) if block else self._queue.get_nowait())
+        except queue.Empty:
+            return batch
+        # Give concurrent requests a moment to add rows to the same round trip
+        deadline = time.monotonic() + (self.flush_interval if block else 0)
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping:
+            batch = self._take_batch(block=True)
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        # Per user, consecutive rows for one table become one insert, keeping conversations
+        # ahead of their messages; different users never share a statement
+        by_user = {}
+        for user_id, db, table, upsert, row in batch:
+            groups = by_user.setdefault(user_id, [])
+            if groups and groups[-1][:3] == (db, table, upsert):
+                groups[-1][3].append(row)
+            else:
+                groups.append((db, table, upsert, [row]))
+        for user_id, groups in by_user.items():
+            for db, table, upsert, rows in groups:
+                self._write_group(user_id, db, table, upsert, rows)
+
+    def _write_group(self, user_id, db, table, upsert, rows):
+        if upsert:
+            # Only the latest version of a row needs to reach the database
+            rows = list({row["id"]: row for row in rows}.values())
+        for attempt in range(self.max_retries + 1):
+            try:
+                if upsert:
+                    with track(f"supabase_upsert_{table}"):
+                        db.table(table).upsert(rows).execute()
+                else:
+                    with track(f"supabase_insert_{table}"):
+                        db.table(table).insert(rows).execute()
+                self.stats_counts["written"] += len(rows)
+                self.stats_counts["batches"] += 1
+                return
+            except Exception as e:
+                if attempt == self.max_retries or _permanent_db_error(e):
+                    print(f"Dropping {len(rows)} {table} rows for user {user_id} after {attempt + 1} attempts:",
+                          str(e))
+                    self.stats_counts["dropped"] += len(rows)
+                    return
+                self.stats_counts["retries"] += 1
+                time.sleep(min(10.0, 0.2 * 2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def flush(self):
+        """Write everything queued so far on the calling thread."""
+        while True:
+            batch = self._take_batch(block=False)
+            if not batch:
+                return
+            self._write(batch)
+
+    def close(self, timeout=10.0):
+        self._stopping = True
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def reset(self):
+        """Forget the parent's writer thread after fork(); the child starts its own on first enqueue."""
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def stats(self):
+        return dict(self.stats_counts, pending=self._queue.qsize())
+
+
+message_writer = WriteBehindQueue(PERSIST_BATCH_SIZE, PERSIST_FLUSH_INTERVAL, PERSIST_MAX_RETRIES)
+atexit.register(message_writer.close)
+
+# ---------- CONVERSATION MEMORY ----------
+
+SUMMARY_PROMPT = """You maintain a short running summary of a conversation between a farmer and AgriBuddy, a farming assistant.
+Keep facts the assistant will need later: crops, field sizes, problems reported, advice already given, decisions made.
+Write plain sentences, at most {limit} characters, no preamble.
+
+Summary so far:
+{summary}
+
+New turns to fold in:
+{turns}
+
+Updated summary:"""
+
+
+class ConversationMemory:
+    """Bounded prompt context per conversation: the last ``window`` turns verbatim plus a summary.
+
+    Turns that fall out of the window are folded into the summary in the
+    background once ``summarize_every`` of them have piled up, so prompt size
+    and per-turn work stay constant however long the conversation gets. State
+    is kept in an LRU and written back to the conversation row through the
+    write-behind queue; a conversation not in memory costs one single-row read.
+    """
+
+    def __init__(self, window, summarize_every, turn_chars, summary_chars, maxsize):
+        self.window = window
+        self.summarize_every = max(1, summarize_every)
+        self.turn_chars = turn_chars
+        self.summary_chars = summary_chars
+        self._states = TTLCache(maxsize, 7 * 24 * 3600)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="agribuddy-summary")
+        # Cleared when the conversations table lacks the memory columns (migration not applied)
+        self.persistent = True
+        self._columns_checked = False
+        self.loads = self.summaries = self.summary_failures = 0
+
+    def _clip(self, text):
+        text = (text or "").strip()
+        return text if len(text) <= self.turn_chars else text[:self.turn_chars - 3].rstrip() + "..."
+
+    def load(self, conversation_id, user_id=None):
+        """State for the conversation, reading it from the database on a cold start."""
+        if conversation_id is None:
+            return None
+        state = self._states.get(conversation_id)
+        if state is not None:
+            return state
+        state = {"summary": "", "turns": [], "summarizing": False}
+        if self.persistent:
+            try:
+                with track("supabase_conversation_memory_select"):
+                    res = user_db(user_id).table("conversations").select("summary,recent_turns").eq("id", conversation_id).limit(1).execute()
+                if res.data:
+                    state["summary"] = res.data[0].get("summary") or ""
+                    state["turns"] = list(res.data[0].get("recent_turns") or [])
+                self._columns_checked = True
+            except Exception as e:
+                if not self._missing_columns(e):
+                    raise
+        if not self.persistent:
+            state["turns"] = self._recent_messages(conversation_id, user_id)
+        self.loads += 1
+        with self._lock:
+            # Another request may have loaded it meanwhile; keep whichever arrived first
+            existing = self._states.get(conversation_id)
+            if existing is not None:
+                return existing
+            self._states.set(conversation_id, state)
+        return state
+
+    def _recent_messages(self, conversation_id, user_id):
+        # Without stored memory, rebuild the window from the newest messages (still a bounded read)
+        with track("supabase_messages_select"):
+            res = (user_db(user_id).table("messages").select("role,content").eq("conversation_id", conversation_id)
+                   .order("created_at", desc=True).limit(2 * self.window).execute())
+        turns, question = [], None
+        for row in reversed(res.data or []):
+            if row.get("role") == "user":
+                question = row.get("content")
+            elif question is not None:
+                turns.append({"user": self._clip(question), "assistant": self._clip(row.get("content"))})
+                question = None
+        return turns
+
+    def render(self, state):
+        """Prompt text for the conversation so far ("" for a new conversation)."""
+        if not state:
+            return ""
+        with self._lock:
+            summary = state["summary"]
+            turns = state["turns"][-self.window:] if self.window else []
+        lines = []
+        if summary:
+            lines.append(f"Summary of the earlier conversation: {summary}")
+        if turns:
+            lines.append("Recent conversation:")
+            for turn in turns:
+                lines.append(f"Farmer: {turn['user']}")
+                lines.append(f"AgriBuddy: {turn['assistant']}")
+        return "\n".join(lines)
+
+    def record(self, conversation_id, user_id, user_message, reply_text):
+        """Append a finished turn and persist the updated window."""
+        with self._lock:
+            state = self._states.get(conversation_id)
+            if state is None:
+                # New conversation, or one evicted from memory since the request started
+                state = {"summary": "", "turns": [], "summarizing": False}
+                self._states.set(conversation_id, state)
+            state["turns"].append({"user": self._clip(user_message), "assistant": self._clip(reply_text)})
+            overflow = len(state["turns"]) - self.window
+            start_summary = overflow >= self.summarize_every and not state["summarizing"]
+            if start_summary:
+                state["summarizing"] = True
+        self._persist(conversation_id, user_id, state)
+        if start_summary:
+            self._pool.submit(self._summarize, conversation_id, user_id, state)
+
+    def _summarize(self, conversation_id, user_id, state):
+        with self._lock:
+            folded = state["turns"][:len(state["turns"]) - self.window]
+            previous = state["summary"]
+        try:
+            summary = self._generate_summary(previous, folded)
+            self.summaries += 1
+        except Exception as e:
+            print("Conversation summary failed:", str(e))
+            self.summary_failures += 1
+            # Keep memory bounded anyway: remember the questions, newest last
+            summary = "; ".join(filter(None, [previous] + [t["user"] for t in folded]))
+        if len(summary) > self.summary_chars:
+            summary = "..." + summary[-(self.summary_chars - 3):]
+        with self._lock:
+            state["summary"] = summary
+            # Only this thread removes turns, and only from the front, so the folded ones are still first
+            del state["turns"][:len(folded)]
+            state["summarizing"] = False
+        self._persist(conversation_id, user_id, state)
+
+    def _generate_summary(self, previous, turns):
+        model = model_registry.get("chat")
+        if not model:
+            raise RuntimeError("chat model not configured")
+        rendered = "\n".join(f"Farmer: {t['user']}\nAgriBuddy: {t['assistant']}" for t in turns)
+        prompt = SUMMARY_PROMPT.format(limit=self.summary_chars, summary=previous or "(none)", turns=rendered)
+        # Background work: counts against the global quota only
+        with gemini_admission.slot(), track("gemini_summarize"):
+            response = model.generate_content(prompt)
+        text = (getattr(response, "text", None) or "").strip()
+        if not text:
+            raise ValueError("empty summary")
+        return text
+
+    def _missing_columns(self, e):
+        if "summary" not in str(e) and "recent_turns" not in str(e):
+            return False
+        if self.persistent:
+            print("Conversation memory columns missing; run update_conversations_memory.sql to persist it")
+        self.persistent = False
+        self._columns_checked = True
+        return True
+
+    def _check_columns(self, user_id):
+        """One probe per process, so a new conversation is never upserted into columns that do not exist."""
+        try:
+            with track("supabase_conversation_memory_probe"):
+                user_db(user_id).table("conversations").select("summary,recent_turns").limit(1).execute()
+            self._columns_checked = True
+        except Exception as e:
+            # Anything else (network, expired token) is retried on the next write
+            self._missing_columns(e)
+
+    def _persist(self, conversation_id, user_id, state):
+        if self.persistent and not self._columns_checked:
+            self._check_columns(user_id)
+        if not self.persistent:
+            return
+        with self._lock:
+            row = {
+                "id": conversation_id,
+                "user_id": user_id,
+                "summary": state["summary"],
+                "recent_turns": list(state["turns"]),
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            }
+        message_writer.enqueue(user_id, "conversations", row, upsert=True)
+
+    def reset_pool(self):
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="agribuddy-summary")
+
+    def close(self):
+        """Wait for running summaries; their results are queued for the writer."""
+        self._pool.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            "conversations": len(self._states),
+            "window": self.window,
+            "persistent": self.persistent,
+            "loads": self.loads,
+            "summaries": self.summaries,
+            "summary_failures": self.summary_failures,
+        }
+
+
+conversation_memory = ConversationMemory(
+    HISTORY_TURNS, HISTORY_SUMMARY_EVERY, HISTORY_TURN_CHARS, HISTORY_SUMMARY_CHARS, HISTORY_CACHE_SIZE,
+)
+
+# ---------- AUTH SESSIONS ----------
+
+class TokenInvalid(Exception):
+    """Raised for access tokens that are malformed or not signed by this project."""
+
+
+class RefreshTokenStore:
+    """Session id -> (user id, refresh token), kept server-side in a SQLite file.
+
+    The signed cookie is readable by anyone who holds it, so it only carries an
+    opaque session id; the long-lived refresh token never leaves the server.
+    Workers on one host share the file, so a token rotated by one worker is seen
+    by the others. Entries idle for ``ttl`` seconds are pruned.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS refresh_tokens ("
+                        "sid TEXT PRIMARY KEY, user_id TEXT NOT NULL, token TEXT NOT NULL, updated_at REAL NOT NULL"
+                        ") WITHOUT ROWID"
+                    )
+                    conn.execute("DELETE FROM refresh_tokens WHERE updated_at < ?", (time.time() - self.ttl,))
+                    self._conn = conn
+        return self._conn
+
+    def get(self, sid, user_id):
+        if not sid:
+            return None
+        try:
+            conn = self._connect()
+            with self._lock:
+                row = conn.execute("SELECT token, updated_at FROM refresh_tokens WHERE sid = ? AND user_id = ?",
+                                   (sid, user_id)).fetchone()
+        except sqlite3.Error as e:
+            print("Session store lookup failed:", str(e))
+            return None
+        if row is None or row[1] < time.time() - self.ttl:
+            return None
+        return row[0]
+
+    def put(self, sid, user_id, token):
+        try:
+            conn = self._connect()
+            with self._lock:
+                conn.execute("INSERT OR REPLACE INTO refresh_tokens (sid, user_id, token, updated_at) "
+                             "VALUES (?, ?, ?, ?)", (sid, user_id, token, time.time()))
+        except sqlite3.Error as e:
+            print("Session store write failed:", str(e))
+
+    def delete(self, sid):
+        if not sid:
+            return
+        try:
+            conn = self._connect()
+            with self._lock:
+                conn.execute("DELETE FROM refresh_tokens WHERE sid = ?", (sid,))
+        except sqlite3.Error as e:
+            print("Session store delete failed:", str(e))
+
+
+class AuthSessions:
+    """Verifies Supabase access tokens locally and keeps them fresh.
+
+    Tokens are checked against ``SUPABASE_JWT_SECRET`` (HS256) or the project's
+    JWKS (fetched once and cached), and verified claims are cached until the
+    token expires, so a request costs a dictionary lookup. Claims that could not
+    be checked (HS256 without the secret, JWKS unreachable) are only reused for
+    ``UNVERIFIED_TTL`` seconds. Tokens close to
+    expiry are refreshed before the request runs, once per refresh token even
+    when concurrent requests carry the same cookie; refresh tokens live in a
+    ``RefreshTokenStore``, never in the cookie. Each user also gets a
+    pooled PostgREST client carrying their own token, so RLS applies and
+    queries don't fail late on an expired JWT.
+    """
+
+    ALGORITHMS = ("HS256", "RS256", "ES256")
+    UNVERIFIED_TTL = 60
+
+    def __init__(self, url, anon_key, jwt_secret, refresh_margin, jwks_ttl, pool_size, token_store):
+        self.url = url.rstrip("/")
+        self.tokens = token_store
+        self.anon_key = anon_key
+        self.jwt_secret = jwt_secret
+        self.refresh_margin = refresh_margin
+        self._claims = TTLCache(20000, 3600)
+        self._refreshed = TTLCache(20000, 60)  # spent refresh token -> new tokens, for concurrent requests
+        self._clients = TTLCache(pool_size, 24 * 3600)  # user id -> {"token", "client"}
+        import jwt
+        self._jwks = jwt.PyJWKClient(f"{self.url}/auth/v1/.well-known/jwks.json", cache_keys=True, lifespan=jwks_ttl)
+        self._http, _ = _build_http_session(8, 0)
+        self._refresh_locks = [threading.Lock() for _ in range(64)]
+        self._warned_no_secret = False
+        self.stats_counts = {"verified": 0, "cache_hits": 0, "unverified": 0, "rejected": 0,
+                             "refreshed": 0, "refresh_failures": 0}
+
+    def verify(self, token):
+        """Claims of a token signed by this project; expiry is left to the caller."""
+        claims = self._claims.get(token)
+        if claims is not None:
+            self.stats_counts["cache_hits"] += 1
+            return claims
+        import jwt
+        try:
+            alg = jwt.get_unverified_header(token).get("alg")
+            if alg not in self.ALGORITHMS:
+                raise TokenInvalid(f"unsupported algorithm {alg!r}")
+            key = self._signing_key(token, alg)
+            if key is None:
+                # Signature can't be checked here; Supabase still checks it on every query
+                claims = jwt.decode(token, options={"verify_signature": False})
+                self.stats_counts["unverified"] += 1
+            else:
+                claims = jwt.decode(token, key, algorithms=[alg], audience="authenticated",
+                                    options={"verify_exp": False})
+                self.stats_counts["verified"] += 1
+        except jwt.PyJWTError as e:
+            self.stats_counts["rejected"] += 1
+            raise TokenInvalid(str(e))
+        remaining = claims.get("exp", 0) - time.time()
+        if key is None:
+            remaining = min(remaining, self.UNVERIFIED_TTL)
+        if remaining > 0:
+            self._claims.set(token, claims, ttl=remaining)
+        return claims
+
+    def _signing_key(self, token, alg):
+        if alg == "HS256":
+            if not self.jwt_secret and not self._warned_no_secret:
+                self._warned_no_secret = True
+                print("WARNING: SUPABASE_JWT_SECRET is not set, so HS256 access tokens are accepted without a "
+                      "local signature check (Supabase still checks them on every query). Set it from "
+                      "Settings > API > JWT secret.")
+            return self.jwt_secret
+        import jwt
+        try:
+            with track("supabase_jwks"):
+                return self._jwks.get_signing_key_from_jwt(token).key
+        except jwt.PyJWKClientConnectionError as e:
+            print("JWKS unavailable, skipping local signature check:", str(e))
+            return None
+
+    def ensure_fresh(self, sess):
+        """Checks the session's tokens and refreshes them when close to expiry.
+
+        Returns False when the session can no longer be used and should be dropped.
+        """
+        token = sess.get("access_token")
+        if not token:
+            return True
+        if "refresh_token" in sess:
+            # Cookie from before refresh tokens moved server-side
+            self.remember(sess, sess.pop("refresh_token"))
+        try:
+            claims = self.verify(token)
+        except TokenInvalid as e:
+            print("Rejected session token:", str(e))
+            return False
+        if claims.get("sub") != sess.get("user_id"):
+            return False
+        remaining = claims.get("exp", 0) - time.time()
+        if remaining > self.refresh_margin:
+            self.bind(sess["user_id"], token)
+            return True
+        refresh_token = self.tokens.get(sess.get("sid"), sess["user_id"])
+        tokens = self.refresh(refresh_token)
+        if tokens is None:
+            latest = self.tokens.get(sess.get("sid"), sess["user_id"])
+            if latest and latest != refresh_token:
+                # Another worker rotated it first; refresh tokens are single use
+                tokens = self.refresh(latest)
+        if tokens is None:
+            # Keep using the current token while it lasts; the next request tries again
+            if remaining > 0:
+                self.bind(sess["user_id"], token)
+            return remaining > 0
+        sess["access_token"] = tokens["access_token"]
+        self.tokens.put(sess["sid"], sess["user_id"], tokens["refresh_token"])
+        self.bind(sess["user_id"], tokens["access_token"])
+        return True
+
+    def remember(self, sess, refresh_token):
+        """Keeps the refresh token server-side under a new opaque session id stored in ``sess``."""
+        sess["sid"] = uuid.uuid4().hex
+        if refresh_token:
+            self.tokens.put(sess["sid"], sess["user_id"], refresh_token)
+
+    def refresh(self, refresh_token):
+        """New ``{"access_token", "refresh_token"}`` for a refresh token, or None if refreshing failed."""
+        if not refresh_token:
+            return None
+        with self._refresh_locks[hash(refresh_token) % len(self._refresh_locks)]:
+            tokens = self._refreshed.get(refresh_token)
+            if tokens is not None:
+                return tokens
+            try:
+                with track("supabase_auth_refresh"):
+                    res = self._http.post(
+                        f"{self.url}/auth/v1/token?grant_type=refresh_token",
+                        json={"refresh_token": refresh_token},
+                        headers={"apikey": self.anon_key, "Authorization": f"Bearer {self.anon_key}"},
+                        timeout=(2, 5),
+                    )
+                res.raise_for_status()
+                data = res.json()
+                tokens = {"access_token": data["access_token"], "refresh_token": data["refresh_token"]}
+            except Exception as e:
+                print("Token refresh failed:", str(e))
+                self.stats_counts["refresh_failures"] += 1
+                return None
+            self._refreshed.set(refresh_token, tokens)
+            self.stats_counts["refreshed"] += 1
+            return tokens
+
+    def bind(self, user_id, token):
+        """Pooled PostgREST client for the user, switched to ``token`` if it changed."""
+        entry = self._clients.get(user_id)
+        if entry is None:
+            from postgrest import SyncPostgrestClient
+            client = SyncPostgrestClient(f"{self.url}/rest/v1", headers={
+                "apikey": self.anon_key,
+                "Authorization": f"Bearer {token}",
+            })
+            entry = {"token": token, "client": client}
+            self._clients.set(user_id, entry)
+        elif entry["token"] != token:
+            entry["client"].auth(token)
+            entry["token"] = token
+        return entry["client"]
+
+    def client(self, user_id):
+        entry = self._clients.get(user_id)
+        return entry["client"] if entry else None
+
+    def sign_out(self, user_id, token, sid=None):
+        """Revokes the user's refresh tokens and drops their pooled client."""
+        self._clients.pop(user_id)
+        self.tokens.delete(sid)
+        if not token:
+            return
+        with track("supabase_auth_sign_out"):
+            self._http.post(f"{self.url}/auth/v1/logout", headers={
+                "apikey": self.anon_key,
+                "Authorization": f"Bearer {token}",
+            }, timeout=(2, 5))
+
+    def stats(self):
+        return dict(self.stats_counts, pooled_clients=len(self._clients))
+
+
+def _create_auth_sessions():
+    if not (SUPABASE_URL and SUPABASE_KEY):
+        return None
+    return AuthSessions(SUPABASE_URL, SUPABASE_KEY, SUPABASE_JWT_SECRET, TOKEN_REFRESH_MARGIN,
+                        JWKS_CACHE_TTL, SUPABASE_CLIENT_POOL_SIZE,
+                        RefreshTokenStore(SESSION_STORE_PATH, SESSION_STORE_TTL))
+
+# Created per process on first use once Supabase is configured
+auth_sessions = Lazy("auth_sessions", _create_auth_sessions)
+
+def user_db(user_id):
+    """PostgREST client acting as the user (so RLS applies), or the shared client if none is bound."""
+    sessions = auth_sessions.get() if user_id else None
+    client = sessions.client(user_id) if sessions else None
+    return client or get_supabase()
+
+@app.before_request
+def _verify_session():
+    # Static files never touch Supabase
+    if not session.get('logged_in') or request.endpoint in ("static", "static_asset"):
+        return
+    sessions = auth_sessions.get()
+    if sessions is not None and not sessions.ensure_fresh(session):
+        _expire_session()
+
+# ---------- PAGE CACHE ----------
+
+# Text-like types worth compressing; woff2 and images are already compressed
+_COMPRESSIBLE_TYPES = {"application/javascript", "text/javascript", "application/json",
+                       "image/svg+xml", "image/x-icon", "image/vnd.microsoft.icon", "font/ttf"}
+
+def _encode_variants(body, mimetype):
+    """Compress a body once up front so each later hit only has to pick a variant."""
+    variants = {"identity": body}
+    compressible = mimetype.startswith("text/") or mimetype in _COMPRESSIBLE_TYPES
+    if compressible and len(body) >= COMPRESS_MIN_BYTES:
+        variants["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+        if brotli is not None:
+            variants["br"] = brotli.compress(body, quality=11)
+    return variants
+
+def _pick_encoding(variants):
+    accepted = request.accept_encodings
+    for encoding in ("br", "gzip"):
+        if encoding in variants and accepted[encoding]:
+            return encoding
+    return "identity"
+
+def send_variants(variants, digest, mimetype, cache_control):
+    """Serve the best encoding the client accepts, or a bodyless 304 if its copy is current."""
+    encoding = _pick_encoding(variants)
+    # Each encoding is a distinct representation, so each gets its own strong ETag
+    etag = digest if encoding == "identity" else f"{digest}-{encoding}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(variants[encoding], mimetype=mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+RenderedPage = namedtuple("RenderedPage", ["digest", "variants"])
+
+class PageCache:
+    """Rendered templates held as pre-compressed bytes, keyed by template and signed-in email.
+
+    The page templates are static apart from the user's email, so a render is reused until the
+    process restarts. Pages are sent with ``no-cache`` so browsers revalidate every time, which
+    costs a 304 with no body when nothing changed.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self._pages = TTLCache(maxsize, ttl)
+
+    def render(self, template):
+        key = (template, session.get("user_email"))
+        # Debug mode reloads templates from disk, so never serve a stale render there
+        reloading = app.jinja_env.auto_reload
+        page = None if reloading else self._pages.get(key)
+        if page is None:
+            with track("page_render"):
+                body = render_template(template).encode("utf-8")
+            page = RenderedPage(hashlib.sha256(body).hexdigest()[:32], _encode_variants(body, "text/html"))
+            if not reloading:
+                self._pages.set(key, page)
+        return send_variants(page.variants, page.digest, "text/html", "private, no-cache")
+
+    def stats(self):
+        return self._pages.stats()
+
+
+page_cache = PageCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+
+def render_page(template):
+    """render_template() for pages whose only per-user input is ``session.user_email``."""
+    return page_cache.render(template)
+
+
+def _css_references(filename, body):
+    """Static paths of the relative ``url()`` references in a stylesheet."""
+    base = posixpath.dirname(filename)
+    refs = set()
+    for ref in re.findall(rb"url\(\s*['\"]?([^'\")]+)", body):
+        ref = ref.decode("utf-8", "replace").split("#")[0].split("?")[0].strip()
+        if ref and not ref.startswith(("/", "data:")) and "://" not in ref:
+            refs.add(posixpath.normpath(posixpath.join(base, ref)))
+    return frozenset(refs)
+
+StaticAsset = namedtuple("StaticAsset", ["mtime", "digest", "mimetype", "variants", "encoded"])
+
+class StaticAssets:
+    """Content-hashed URLs for files under static/, served pre-compressed and immutable.
+
+    ``asset_url('style.css')`` becomes ``/assets/<digest>/style.css``; a new deploy changes the
+    digest, so browsers can keep the old URL forever. Relative URLs inside a stylesheet (the
+    Font Awesome webfonts) resolve under the stylesheet's digest and are served the same way,
+    so a file is valid under its own digest or that of a stylesheet referencing it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._assets = {}
+        self._references = {}  # stylesheet digest -> files its relative url()s point at
+        self._lock = threading.Lock()
+
+    def get(self, filename, encode=True):
+        """The file's fingerprint; ``encode`` also compresses it, which only serving the file needs."""
+        path = safe_join(self.root, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        mtime = os.path.getmtime(path)
+        asset = current = self._assets.get(filename)
+        if asset is None or asset.mtime != mtime:
+            with open(path, "rb") as f:
+                body = f.read()
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            asset = StaticAsset(mtime, hashlib.sha256(body).hexdigest()[:12], mimetype, {"identity": body}, False)
+            if mimetype == "text/css":
+                with self._lock:
+                    if current is not None:
+                        self._references.pop(current.digest, None)
+                    self._references[asset.digest] = _css_references(filename, body)
+        if encode and not asset.encoded:
+            # Brotli at quality 11 takes a good fraction of a second on the stylesheets;
+            # keep it off the first page render, which only needs the digest
+            asset = asset._replace(variants=_encode_variants(asset.variants["identity"], asset.mimetype),
+                                   encoded=True)
+        if asset is not current:
+            with self._lock:
+                self._assets[filename] = asset
+        return asset
+
+    def valid_digest(self, digest, filename, asset):
+        return digest == asset.digest or filename in self._references.get(digest, ())
+
+    def url(self, filename):
+        asset = self.get(filename, encode=False)
+        if asset is None:
+            return url_for("static", filename=filename)
+        return url_for("static_asset", digest=asset.digest, filename=filename)
+
+    def stats(self):
+        with self._lock:
+            assets = list(self._assets.values())
+        return {
+            "files": len(assets),
+            "bytes": sum(len(a.variants["identity"]) for a in assets),
+            "compressed_bytes": sum(len(v) for a in assets for k, v in a.variants.items() if k != "identity"),
+        }
+
+
+static_assets = StaticAssets(app.static_folder)
+
+@app.template_global()
+def asset_url(filename):
+    return static_assets.url(filename)
+
+@app.route("/assets/<digest>/<path:filename>")
+def static_asset(digest, filename):
+    asset = static_assets.get(filename)
+    if asset is None:
+        raise NotFound()
+    if not static_assets.valid_digest(digest, filename, asset):
+        # A stale or made-up fingerprint must not be cached forever with today's content
+        return redirect(url_for("static_asset", digest=asset.digest, filename=filename))
+    return send_variants(asset.variants, asset.digest, asset.mimetype,
+                         f"public, max-age={STATIC_MAX_AGE}, immutable")
 
 @app.route("/")
 def home():
@@ -63,25 +2174,24 @@ def home():
 def login():
     # Always clear session on login page to prevent automatic login
     session.clear()
-    return render_template("login.html")
+    return render_page("login.html")
 
 @app.route("/login", methods=["POST"])
 def login_post():
     email = request.form.get('email')
     password = request.form.get('password')
     
+    supabase = get_supabase()
     if not supabase:
         return render_template("login.html", error="Authentication service not configured.")
     
     try:
         # Attempt to sign in directly - Supabase will handle validation
-        response = supabase.auth.sign_in_with_password({
-            "email": email,
-            "password": password
-        })
-        
-        # Debug: Print the response to see what we're getting
-        print("Supabase login response:", response)
+        with track("supabase_auth_sign_in"):
+            response = supabase.auth.sign_in_with_password({
+                "email": email,
+                "password": password
+            })
         
         # Depending on supabase client version, "user" may be in different places
         user_obj = getattr(response, 'user', None) or (response.get('user') if isinstance(response, dict) else None)
@@ -96,11 +2206,18 @@ def login_post():
             # Set session variables
             session['logged_in'] = True
             session['user_id'] = getattr(user_obj, 'id', None) or user_obj.get('id')
+            invalidate_profile_cache(session['user_id'])
             session['user_email'] = getattr(user_obj, 'email', None) or user_obj.get('email')
             
             # If we have a session token, store it as well
             if session_obj:
                 session['access_token'] = getattr(session_obj, 'access_token', None) or session_obj.get('access_token')
+                refresh_token = getattr(session_obj, 'refresh_token', None) or session_obj.get('refresh_token')
+                sessions = auth_sessions.get()
+                if sessions and session['access_token']:
+                    # Only an opaque id goes into the (readable) cookie; the refresh token stays server-side
+                    sessions.remember(session, refresh_token)
+                    sessions.bind(session['user_id'], session['access_token'])
             
             print("Login successful for user:", session['user_email'])
             return redirect(url_for('chat_interface'))
@@ -123,67 +2240,43 @@ def chat_interface():
     # Check if user is logged in properly
     if not session.get('logged_in') or not session.get('user_id'):
         return redirect(url_for('login'))
-    return render_template("index.html")
+    return render_page("index.html")
 
 @app.route("/weather")
 def weather():
     city = request.args.get('city')
     zip_code = request.args.get('zip')
+    weather_prefetcher.note_user(session.get('user_id'), city=city, zip_code=zip_code)
     
     if zip_code:
         lat, lon, city_name = get_coordinates_by_zip(zip_code)
         if lat and lon:
             weather_info = get_weather_by_coordinates(lat, lon)
-            # Add simulated forecast data
-            forecast_data = generate_forecast_data()
-            return jsonify({"city": city_name, "weather": weather_info, "forecast": forecast_data})
+            forecast = get_forecast("coord", (lat, lon))
+            return jsonify(dict({"city": city_name, "weather": weather_json(weather_info)}, **_forecast_fields(forecast)))
         else:
             # Graceful fallback: try direct weather API using ZIP if location fails
             weather_info = get_weather_by_zip(zip_code)
             if weather_info:
-                # Add simulated forecast data
-                forecast_data = generate_forecast_data()
-                return jsonify({"zip": zip_code, "weather": weather_info, "forecast": forecast_data})
+                forecast = get_forecast("zip", zip_code)
+                return jsonify(dict({"zip": zip_code, "weather": weather_json(weather_info)}, **_forecast_fields(forecast)))
             return jsonify({"error": "Could not find location for ZIP code"}), 404
     elif city:
         weather_info = get_weather(city)
-        # Add simulated forecast data
-        forecast_data = generate_forecast_data()
-        return jsonify({"city": city, "weather": weather_info, "forecast": forecast_data})
+        forecast = get_forecast("city", city)
+        return jsonify(dict({"city": city, "weather": weather_json(weather_info)}, **_forecast_fields(forecast)))
     else:
         return jsonify({"error": "City or ZIP code required"}), 400
 
-def generate_forecast_data():
-    """Generate simulated 5-day forecast data"""
-    import random
-    days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri']
-    conditions = [
-        {'icon': 'fas fa-sun', 'desc': 'Sunny'},
-        {'icon': 'fas fa-cloud-sun', 'desc': 'Partly Cloudy'},
-        {'icon': 'fas fa-cloud', 'desc': 'Cloudy'},
-        {'icon': 'fas fa-cloud-showers-heavy', 'desc': 'Rainy'},
-        {'icon': 'fas fa-bolt', 'desc': 'Thunderstorms'}
-    ]
-    
-    forecast = []
-    base_temp = random.randint(25, 35)  # Base temperature for the week
-    
-    for i, day in enumerate(days):
-        condition = random.choice(conditions)
-        temp_variation = random.randint(-5, 5)
-        temp = base_temp + temp_variation
-        forecast.append({
-            'day': day,
-            'icon': condition['icon'],
-            'temp': f'{temp}°C',
-            'desc': condition['desc']
-        })
-    
-    return forecast
+def _forecast_fields(forecast):
+    """Daily cards plus the hourly/daily series the dashboard charts read; empty if unavailable."""
+    if not forecast:
+        return {"forecast": []}
+    return {"forecast": forecast["days"], "hourly": forecast["hourly"], "daily": forecast["days"]}
 
 @app.route("/signup")
 def signup():
-    return render_template("signup.html")
+    return render_page("signup.html")
 
 @app.route("/signup", methods=["POST"])
 def signup_post():
@@ -196,20 +2289,22 @@ def signup_post():
     if password != confirm_password:
         return render_template("signup.html", error="Passwords do not match")
     
+    supabase = get_supabase()
     if not supabase:
         return render_template("signup.html", error="Signup service not configured.")
     
     try:
-        response = supabase.auth.sign_up({
-            "email": email,
-            "password": password,
-            "options": {
-                "data": {
-                    "first_name": first_name,
-                    "last_name": last_name
+        with track("supabase_auth_sign_up"):
+            response = supabase.auth.sign_up({
+                "email": email,
+                "password": password,
+                "options": {
+                    "data": {
+                        "first_name": first_name,
+                        "last_name": last_name
+                    }
                 }
-            }
-        })
+            })
         
         user_obj = getattr(response, 'user', None) or (response.get('user') if isinstance(response, dict) else None)
         if user_obj:
@@ -224,9 +2319,11 @@ def signup_post():
 
 @app.route("/logout")
 def logout():
+    invalidate_profile_cache(session.get('user_id'))
     try:
-        if supabase:
-            supabase.auth.sign_out()
+        sessions = auth_sessions.get()
+        if sessions:
+            sessions.sign_out(session.get('user_id'), session.get('access_token'), session.get('sid'))
     except Exception:
         pass
     # Clear all session data
@@ -237,57 +2334,80 @@ def logout():
     response.set_cookie('remember_token', '', expires=0)
     return response
 
-@app.route("/chat", methods=["POST"])
-def chat():
-    if 'logged_in' not in session:
-        return jsonify({"reply": "Please log in first"}), 401
-    
-    # Check if Supabase client is available
-    if not supabase:
-        return jsonify({"reply": "Database connection error. Please try again later."}), 500
-    
-    data = request.json
-    if data is None:
-        return jsonify({"reply": "Invalid request data"}), 400
-    
-    user_message = data.get("message", "")
-    location = data.get("location", "")
-    zip_code = data.get("zipCode", "")
-    
-    # Get user profile information
-    profile_info = ""
+def _is_auth_error(e):
+    error_str = str(e).lower()
+    return "jwt" in error_str or "token" in error_str or "signature" in error_str or "malformed" in error_str
+
+def _expire_session():
+    session.pop('logged_in', None)
+    session.pop('user_id', None)
+    session.pop('user_email', None)
+    session.pop('access_token', None)
+    session.pop('refresh_token', None)
+    sid = session.pop('sid', None)
+    sessions = auth_sessions.peek()
+    if sessions:
+        sessions.tokens.delete(sid)
+
+# Only the columns the chat prompt renders
+PROFILE_PROMPT_COLUMNS = (
+    "full_name,phone_number,past_cultivation,future_plans,land_area,land_unit,"
+    "soil_type,current_crops,preferred_crops,city,state"
+)
+
+def render_profile_info(profile_record):
+    profile_info = f"Farmer Name: {profile_record.get('full_name', '')}"
+    if profile_record.get('phone_number'):
+        profile_info += f", Phone: {profile_record.get('phone_number')}"
+    if profile_record.get('past_cultivation'):
+        profile_info += f", Farm Info: {profile_record.get('past_cultivation')}"
+    if profile_record.get('future_plans'):
+        profile_info += f", Future Plans: {profile_record.get('future_plans')}"
+    if profile_record.get('land_area'):
+        profile_info += f", Land Size: {profile_record.get('land_area')} {profile_record.get('land_unit', 'acre')}"
+    if profile_record.get('soil_type'):
+        profile_info += f", Soil Type: {profile_record.get('soil_type')}"
+    if profile_record.get('current_crops'):
+        profile_info += f", Currently Grown Crops: {profile_record.get('current_crops')}"
+    if profile_record.get('preferred_crops'):
+        profile_info += f", Preferred Crops: {profile_record.get('preferred_crops')}"
+    if profile_record.get('city') and profile_record.get('state'):
+        profile_info += f", Location: {profile_record.get('city')}, {profile_record.get('state')}"
+    return profile_info
+
+def get_profile_context(user_id):
+    """Cached profile context for the chat prompt. Auth errors propagate to the caller.
+
+    Returns a dict with the rendered ``info`` string plus the raw ``city``,
+    ``state`` and ``soil_type`` values for callers that bucket by location.
+    """
+    cached = profile_cache.get(user_id)
+    if cached is not None:
+        return cached
     try:
-        profile_data = supabase.table("profiles").select("*").eq("user_id", session['user_id']).execute()
-        if profile_data.data:
-            profile_record = profile_data.data[0]
-            profile_info = f"Farmer Name: {profile_record.get('full_name', '')}"
-            if profile_record.get('phone_number'):
-                profile_info += f", Phone: {profile_record.get('phone_number')}"
-            if profile_record.get('past_cultivation'):
-                profile_info += f", Farm Info: {profile_record.get('past_cultivation')}"
-            if profile_record.get('future_plans'):
-                profile_info += f", Future Plans: {profile_record.get('future_plans')}"
-            if profile_record.get('land_area'):
-                profile_info += f", Land Size: {profile_record.get('land_area')} {profile_record.get('land_unit', 'acre')}"
-            if profile_record.get('soil_type'):
-                profile_info += f", Soil Type: {profile_record.get('soil_type')}"
-            if profile_record.get('current_crops'):
-                profile_info += f", Currently Grown Crops: {profile_record.get('current_crops')}"
-            if profile_record.get('preferred_crops'):
-                profile_info += f", Preferred Crops: {profile_record.get('preferred_crops')}"
-            if profile_record.get('city') and profile_record.get('state'):
-                profile_info += f", Location: {profile_record.get('city')}, {profile_record.get('state')}"
+        with track("supabase_profiles_select"):
+            profile_data = user_db(user_id).table("profiles").select(PROFILE_PROMPT_COLUMNS).eq("user_id", user_id).limit(1).execute()
     except Exception as e:
-        # Handle JWT/token errors specifically - only for auth-related issues
-        error_str = str(e).lower()
-        if "jwt" in error_str or "token" in error_str or "signature" in error_str or "malformed" in error_str:
-            # Clear session and redirect to login only for auth errors
-            session.pop('logged_in', None)
-            session.pop('user_id', None)
-            session.pop('user_email', None)
-            return jsonify({"reply": "Session expired. Please log in again."}), 401
+        if _is_auth_error(e):
+            raise
         print("Failed to fetch profile details:", str(e))
-    
+        return {"info": "", "city": None, "state": None, "soil_type": None}
+    profile_record = profile_data.data[0] if profile_data.data else {}
+    context = {
+        "info": render_profile_info(profile_record) if profile_record else "",
+        "city": profile_record.get("city"),
+        "state": profile_record.get("state"),
+        "soil_type": profile_record.get("soil_type"),
+    }
+    profile_cache.set(user_id, context)
+    return context
+
+def invalidate_profile_cache(user_id):
+    if user_id:
+        profile_cache.pop(user_id)
+
+def lookup_chat_weather(location, zip_code):
+    """Returns (weather_info, location) for the chat prompt."""
     weather_info = ""
     if zip_code:
         lat, lon, city_name = get_coordinates_by_zip(zip_code)
@@ -296,113 +2416,765 @@ def chat():
             location = city_name
     elif location:
         weather_info = get_weather(location)
-        
-    prompt = f"You are AgriBuddy, a helpful farmer assistant. {profile_info}. User says: '{user_message}'. "
+    # During an OpenWeather outage (no fresh or stale data) answer without weather
+    if not isinstance(weather_info, WeatherSnapshot):
+        weather_info = ""
+    return weather_info, location
+
+def build_chat_prompt(profile_info, user_message, location, weather_info, history=""):
+    prompt = f"You are AgriBuddy, a helpful farmer assistant. {profile_info}. "
+    if history:
+        prompt += f"\n{history}\n"
+    prompt += f"User says: '{user_message}'. "
     if weather_info:
         prompt += f"Current weather in {location}: {weather_info}. "
+    return prompt
+
+def generate_reply(prompt, user_id=None):
+    """Returns (reply_text, ok) where ok is False for configuration or generation failures.
+
+    Raises Overloaded when the call cannot be admitted (see gemini_call).
+    """
+    model = model_registry.get("chat")
+    # Fallback if model isn't configured
+    if not model:
+        return "AI assistant not configured. Please set GEMINI_API_KEY in environment.", False
+
+    def call():
+        try:
+            with track("gemini_generate"):
+                response = model.generate_content(prompt)
+            return getattr(response, 'text', None) or (response.get('text') if isinstance(response, dict) else str(response)), True
+        except Exception:
+            # Retry once; transient upstream errors are common on the free tier
+            try:
+                with track("gemini_generate"):
+                    resp = model.generate_content(prompt)
+                return getattr(resp, 'text', None) or (resp.get('text') if isinstance(resp, dict) else str(resp)), True
+            except Exception as e:
+                return "Failed to generate response: " + str(e), False
+
+    return gemini_call(("chat", hashlib.sha256(prompt.encode("utf-8")).hexdigest()), call, user_id)
+
+def find_conversation_id(user_id):
+    """Latest conversation for the user, or None if they have not chatted yet."""
+    cached = conversation_cache.get(user_id)
+    if cached is not None:
+        return cached
+    with track("supabase_conversations_select"):
+        conversations = user_db(user_id).table("conversations").select("id").eq("user_id", user_id).order("updated_at", desc=True).limit(1).execute()
+    if not conversations.data:
+        return None
+    conversation_id = conversations.data[0]["id"]
+    conversation_cache.set(user_id, conversation_id)
+    return conversation_id
+
+def load_conversation(user_id):
+    """(conversation_id, memory state) for the user's latest conversation; both None for a first chat."""
+    conversation_id = find_conversation_id(user_id)
+    return conversation_id, conversation_memory.load(conversation_id, user_id)
+
+def save_chat_turn(user_id, user_message, reply_text, conversation_id=None):
+    """Queue the turn for write-behind persistence; returns the conversation id."""
+    # Create or get existing conversation
+    if conversation_id is None:
+        conversation_id = find_conversation_id(user_id)
+
+    if conversation_id is None:
+        # Create new conversation; the id is generated here so messages can reference it before it is flushed
+        conversation_id = str(uuid.uuid4())
+        conversation_owner_cache.set(conversation_id, user_id)
+        message_writer.enqueue(user_id, "conversations", {
+            "id": conversation_id,
+            "user_id": user_id,
+            "title": user_message[:50] + "..." if len(user_message) > 50 else user_message
+        })
+        conversation_cache.set(user_id, conversation_id)
+
+    # Save user message and AI response in one bulk insert; explicit timestamps keep the
+    # pair in order for history paging (rows of one insert would share now())
+    asked_at = datetime.now(timezone.utc)
+    message_writer.enqueue(user_id, "messages", [
+        {"conversation_id": conversation_id, "role": "user", "content": user_message,
+         "created_at": asked_at.isoformat()},
+        {"conversation_id": conversation_id, "role": "assistant", "content": reply_text,
+         "created_at": (asked_at + timedelta(microseconds=1)).isoformat()},
+    ])
+    conversation_memory.record(conversation_id, user_id, user_message, reply_text)
+    return conversation_id
+
+def _prepare_chat_request():
+    """Shared validation and prompt building for /chat and /chat/stream.
+
+    Returns (context, None) on success or (None, error_response) on failure.
+    """
+    if 'logged_in' not in session:
+        return None, (jsonify({"reply": "Please log in first"}), 401)
+
+    # Check if Supabase client is available
+    if not get_supabase():
+        return None, (jsonify({"reply": "Database connection error. Please try again later."}), 500)
+
+    data = request.json
+    if data is None:
+        return None, (jsonify({"reply": "Invalid request data"}), 400)
+
+    user_message = data.get("message", "")
+    location = data.get("location", "")
+    zip_code = data.get("zipCode", "")
+
+    # Profile, weather and conversation lookups are independent, so run them side by side
+    user_id = session['user_id']
+    timings = {}
+    stages = {
+        "profile": io_pool.submit(_timed, timings, "profile", get_profile_context, user_id),
+        "weather": io_pool.submit(_timed, timings, "weather", lookup_chat_weather, location, zip_code),
+        "conversation": io_pool.submit(_timed, timings, "conversation", load_conversation, user_id),
+    }
+    deadline = time.perf_counter() + CHAT_STAGE_TIMEOUT
+    results = {}
+    for name, future in stages.items():
+        try:
+            results[name] = future.result(timeout=max(0.0, deadline - time.perf_counter()))
+        except FutureTimeoutError:
+            print(f"Chat stage '{name}' timed out after {CHAT_STAGE_TIMEOUT}s")
+            results[name] = None
+        except Exception as e:
+            if name == "profile":
+                # Only auth errors escape get_profile_context; clear session and redirect to login
+                _expire_session()
+                return None, (jsonify({"reply": "Session expired. Please log in again."}), 401)
+            print(f"Chat stage '{name}' failed:", str(e))
+            results[name] = None
+
+    for name in stages:
+        if name in timings:
+            add_server_timing(f"fanout_{name}", timings[name])
+
+    profile = results["profile"] or {}
+    profile_info = profile.get("info", "")
+    weather_prefetcher.note_user(user_id, city=profile.get("city"), zip_code=zip_code or None)
+    weather_info, location = results["weather"] or ("", location)
+    conversation_id, memory = results["conversation"] or (None, None)
+    history = conversation_memory.render(memory)
+    # Follow-up questions depend on the conversation, so only opening questions are shared
+    cache_bucket = response_cache_bucket(profile, weather_info) if RESPONSE_CACHE_ENABLED and not history else None
+    if cache_bucket is not None:
+        prompt = build_shared_prompt(user_message, cache_bucket)
+    else:
+        prompt = build_chat_prompt(profile_info, user_message, location, weather_info, history)
+    return {
+        "user_id": user_id,
+        "user_message": user_message,
+        "prompt": prompt,
+        "cache_bucket": cache_bucket,
+        "conversation_id": conversation_id,
+        "timings": timings,
+    }, None
+
+def _timed(timings, name, func, *args):
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings[name] = time.perf_counter() - started
+
+def _log_stage_timings(route, timings):
+    stages = " ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in timings.items())
+    print(f"{route} stages: {stages}")
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    started = time.perf_counter()
+    ctx, error = _prepare_chat_request()
+    if error:
+        return error
+
+    timings = ctx["timings"]
+    timings["pre_llm"] = time.perf_counter() - started
+    reply_text = cached_reply(ctx)
+    if reply_text is None:
+        reply_text, ok = _timed(timings, "llm", generate_reply, ctx["prompt"], ctx["user_id"])
+        if ok:
+            remember_reply(ctx, reply_text)
+    # Without streaming the first token arrives with the full answer
+    elapsed = time.perf_counter() - started
+    chat_ttft.observe(elapsed)
+    chat_latency.observe(elapsed)
+    metrics.observe("agribuddy_chat_ttft_seconds", elapsed, route="/chat")
+
+    try:
+        _timed(timings, "save", save_chat_turn, ctx["user_id"], ctx["user_message"], reply_text, ctx["conversation_id"])
+        return jsonify({"reply": reply_text})
+    except Exception as e:
+        # Handle JWT/token errors specifically - only for auth-related issues
+        if _is_auth_error(e):
+            # Clear session and redirect to login only for auth errors
+            _expire_session()
+            return jsonify({"reply": "Session expired. Please log in again."}), 401
+        print("Failed to save conversation:", str(e))
+        return jsonify({"reply": reply_text})
+    finally:
+        _log_stage_timings("/chat", timings)
+
+def cached_reply(ctx):
+    if ctx["cache_bucket"] is None:
+        return None
+    return response_cache.lookup(ctx["user_message"], ctx["cache_bucket"])
+
+def remember_reply(ctx, reply_text):
+    if ctx["cache_bucket"] is not None and reply_text:
+        response_cache.store(ctx["user_message"], ctx["cache_bucket"], reply_text)
+
+def _sse(payload, event=None):
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(payload)}\n\n"
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    started = time.perf_counter()
+    ctx, error = _prepare_chat_request()
+    if error:
+        return error
+
+    timings = ctx["timings"]
+    timings["pre_llm"] = time.perf_counter() - started
+
+    model = model_registry.get("chat")
+    cached = cached_reply(ctx)
+    # Take the Gemini slot before any bytes are sent so an overload is still a clean 503
+    admitted = cached is None and model is not None
+    if admitted:
+        gemini_admission.acquire(ctx["user_id"])
+
+    def generate():
+        parts = []
+        first_token_at = None
+        if cached is not None:
+            chat_ttft.observe(time.perf_counter() - started)
+            parts.append(cached)
+            yield _sse({"delta": cached, "cached": True})
+        elif not model:
+            parts.append("AI assistant not configured. Please set GEMINI_API_KEY in environment.")
+            yield _sse({"delta": parts[0]})
+        else:
+            stream_started = time.perf_counter()
+            metrics.gauge_add("agribuddy_stage_in_flight", 1, stage="gemini_stream")
+            try:
+                for chunk in model.generate_content(ctx["prompt"], stream=True):
+                    try:
+                        text = chunk.text
+                    except (ValueError, AttributeError):
+                        # Chunks without text parts (e.g. safety metadata) carry nothing to forward
+                        continue
+                    if not text:
+                        continue
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        chat_ttft.observe(first_token_at - started)
+                        metrics.observe("agribuddy_chat_ttft_seconds", first_token_at - started, route="/chat/stream")
+                        timings["ttft"] = first_token_at - started
+                    parts.append(text)
+                    yield _sse({"delta": text})
+                if parts:
+                    remember_reply(ctx, "".join(parts))
+            except Exception as e:
+                metrics.inc("agribuddy_stage_errors_total", stage="gemini_stream")
+                print("Streaming generation failed:", str(e))
+                if not parts:
+                    parts.append("Failed to generate response: " + str(e))
+                    yield _sse({"delta": parts[0]})
+                else:
+                    yield _sse({"error": "Response was interrupted"}, event="error")
+            finally:
+                metrics.gauge_add("agribuddy_stage_in_flight", -1, stage="gemini_stream")
+                metrics.observe("agribuddy_stage_duration_seconds", time.perf_counter() - stream_started, stage="gemini_stream")
+        elapsed = time.perf_counter() - started
+        timings["llm"] = elapsed - timings["pre_llm"]
+        chat_latency.observe(elapsed)
+
+        # Persist once the full answer is known
+        reply_text = "".join(parts)
+        try:
+            _timed(timings, "save", save_chat_turn, ctx["user_id"], ctx["user_message"], reply_text, ctx["conversation_id"])
+        except Exception as e:
+            print("Failed to save conversation:", str(e))
+        _log_stage_timings("/chat/stream", timings)
+        yield _sse({"done": True}, event="done")
+
+    response = streaming_response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # keep reverse proxies from buffering the stream
+    })
+    if admitted:
+        # Released even if the client goes away before the generator starts
+        admitted_at = time.monotonic()
+        response.call_on_close(lambda: gemini_admission.release(ctx["user_id"], time.monotonic() - admitted_at))
+    return response
+
+@app.route("/chat/stats")
+def chat_stats():
+    return jsonify({
+        "time_to_first_token": chat_ttft.summary(),
+        "total": chat_latency.summary(),
+        "persistence": message_writer.stats(),
+        "response_cache": response_cache.stats(),
+        "memory": conversation_memory.stats(),
+        "admission": gemini_admission.stats(),
+        "coalesced": gemini_flight.coalesced,
+    })
+
+@app.route("/profile/refresh", methods=["POST"])
+def profile_refresh():
+    """Called by profile editors after saving so the next chat turn sees the change."""
+    if 'logged_in' not in session:
+        return jsonify({"error": "Please log in first"}), 401
+    invalidate_profile_cache(session.get('user_id'))
+    return jsonify({"status": "ok"})
+
+# ---------- CONVERSATION HISTORY ----------
 
-    # Fallback if model isn't configured
-    if not model:
-        reply_text = "AI assistant not configured. Please set GEMINI_API_KEY in environment."
-    else:
-        try:
-            # use generate_content on the model if available; otherwise try genai.generate_text
-            response = None
-            try:
-                response = model.generate_content(prompt)
-                reply_text = getattr(response, 'text', None) or (response.get('text') if isinstance(response, dict) else str(response))
-            except Exception:
-                # fallback to genai.generate_text (depending on library version)
-                try:
-                    # The genai.generate_text method doesn't take positional arguments
-                    # We need to use the correct method signature
-                    resp = model.generate_content(prompt) if model else None
-                    if resp:
-                        reply_text = getattr(resp, 'text', None) or (resp.get('text') if isinstance(resp, dict) else str(resp))
-                    else:
-                        reply_text = "AI model not available for text generation"
-                except Exception as e:
-                    reply_text = "Failed to generate response: " + str(e)
-        except Exception as e:
-            reply_text = "Failed to generate response: " + str(e)
-    
+# Conversation id -> owner, so paging through messages checks ownership once
+conversation_owner_cache = TTLCache(10000, 3600)
+
+def _encode_cursor(timestamp, row_id):
+    return base64.urlsafe_b64encode(json.dumps([timestamp, row_id]).encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor):
+    """(timestamp, id) from an opaque ``before`` cursor; raises ValueError if it was tampered with."""
     try:
-        # Create or get existing conversation
-        conversations = supabase.table("conversations").select("*").eq("user_id", session['user_id']).order("updated_at", desc=True).limit(1).execute()
-        
-        if conversations.data:
-            conversation_id = conversations.data[0]["id"]
-        else:
-            # Create new conversation
-            new_conversation = supabase.table("conversations").insert({
-                "user_id": session['user_id'],
-                "title": user_message[:50] + "..." if len(user_message) > 50 else user_message
-            }).execute()
-            conversation_id = new_conversation.data[0]["id"]
-        
-        # Save user message
-        supabase.table("messages").insert({
-            "conversation_id": conversation_id,
-            "role": "user",
-            "content": user_message
-        }).execute()
-        
-        # Save AI response
-        supabase.table("messages").insert({
-            "conversation_id": conversation_id,
-            "role": "assistant",
-            "content": reply_text
-        }).execute()
-        
-        return jsonify({"reply": reply_text})
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+        uuid.UUID(row_id)
+    except Exception:
+        raise ValueError("invalid cursor")
+    return timestamp, row_id
+
+def _page_limit():
+    try:
+        limit = int(request.args.get("limit", HISTORY_PAGE_SIZE))
+    except ValueError:
+        limit = HISTORY_PAGE_SIZE
+    return max(1, min(limit, HISTORY_PAGE_MAX))
+
+def _keyset_page(query, column, limit):
+    """Newest-first page of ``query`` ordered by (column, id), resuming before the ``before`` cursor.
+
+    Seeks with a row comparison instead of OFFSET, so every page is one index
+    range scan however deep into the history it is.
+    """
+    before = request.args.get("before")
+    if before:
+        timestamp, row_id = _decode_cursor(before)
+        query = query.or_(f'{column}.lt."{timestamp}",and({column}.eq."{timestamp}",id.lt.{row_id})')
+    rows = query.order(column, desc=True).order("id", desc=True).limit(limit + 1).execute().data or []
+    next_before = _encode_cursor(rows[limit - 1][column], rows[limit - 1]["id"]) if len(rows) > limit else None
+    return rows[:limit], next_before
+
+def _owns_conversation(user_id, conversation_id):
+    owner = conversation_owner_cache.get(conversation_id)
+    if owner is None:
+        with track("supabase_conversation_owner_select"):
+            res = user_db(user_id).table("conversations").select("user_id").eq("id", conversation_id).limit(1).execute()
+        if not res.data:
+            return False
+        owner = res.data[0]["user_id"]
+        conversation_owner_cache.set(conversation_id, owner)
+    return owner == user_id
+
+@app.route("/conversations")
+def list_conversations():
+    """The user's conversations, most recently active first."""
+    if 'logged_in' not in session:
+        return jsonify({"error": "Please log in first"}), 401
+    if not get_supabase():
+        return jsonify({"error": "Database connection error. Please try again later."}), 500
+    user_id = session['user_id']
+    try:
+        query = user_db(user_id).table("conversations").select("id,title,created_at,updated_at").eq("user_id", user_id)
+        with track("supabase_conversations_page"):
+            rows, next_before = _keyset_page(query, "updated_at", _page_limit())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        # Handle JWT/token errors specifically - only for auth-related issues
-        error_str = str(e).lower()
-        if "jwt" in error_str or "token" in error_str or "signature" in error_str or "malformed" in error_str:
-            # Clear session and redirect to login only for auth errors
-            session.pop('logged_in', None)
-            session.pop('user_id', None)
-            session.pop('user_email', None)
-            return jsonify({"reply": "Session expired. Please log in again."}), 401
-        print("Failed to save conversation:", str(e))
-        return jsonify({"reply": reply_text})
+        if _is_auth_error(e):
+            _expire_session()
+            return jsonify({"error": "Session expired. Please log in again."}), 401
+        print("Failed to list conversations:", str(e))
+        return jsonify({"error": "Could not load conversations"}), 502
+    for row in rows:
+        conversation_owner_cache.set(row["id"], user_id)
+    return jsonify({"conversations": rows, "next_before": next_before})
+
+@app.route("/conversations/<conversation_id>/messages")
+def conversation_messages(conversation_id):
+    """One page of a conversation, oldest first; pass ``next_before`` back as ``before`` for older messages."""
+    if 'logged_in' not in session:
+        return jsonify({"error": "Please log in first"}), 401
+    if not get_supabase():
+        return jsonify({"error": "Database connection error. Please try again later."}), 500
+    try:
+        uuid.UUID(conversation_id)
+    except ValueError:
+        return jsonify({"error": "Conversation not found"}), 404
+    try:
+        if not _owns_conversation(session['user_id'], conversation_id):
+            return jsonify({"error": "Conversation not found"}), 404
+        query = user_db(session['user_id']).table("messages").select("id,role,content,created_at").eq("conversation_id", conversation_id)
+        with track("supabase_messages_page"):
+            rows, next_before = _keyset_page(query, "created_at", _page_limit())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        if _is_auth_error(e):
+            _expire_session()
+            return jsonify({"error": "Session expired. Please log in again."}), 401
+        print("Failed to load messages:", str(e))
+        return jsonify({"error": "Could not load messages"}), 502
+    rows.reverse()
+    return jsonify({"conversation_id": conversation_id, "messages": rows, "next_before": next_before})
 
 @app.route("/farming-guide")
 def farming_guide():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
-    return render_template("farming_guide.html")
+    return render_page("farming_guide.html")
 
 @app.route("/tutorials")
 def tutorials():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
-    return render_template("tutorials.html")
+    return render_page("tutorials.html")
 
 
 @app.route("/pest-control")
 def pest_control():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
-    return render_template("pest_control.html")
+    return render_page("pest_control.html")
 
 @app.route("/soil-analysis")
 def soil_analysis():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
-    return render_template("soil_analysis.html")
+    return render_page("soil_analysis.html")
 
 @app.route("/crop-recommendations")
 def crop_recommendations():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
-    return render_template("crop_recommendations.html")
+    return render_page("crop_recommendations.html")
 
 @app.route("/pest-checker")
 def pest_checker():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
-    return render_template("pest_checker.html")
+    return render_page("pest_checker.html")
+
+# ---------- PEST CHECKER ----------
+
+PEST_ANALYSIS_PROMPT = (
+    "You are an agricultural expert AI assistant specialized in plant pest and disease identification. "
+    "Analyze the provided image and return a JSON object with fields: is_agricultural (bool), is_relevant (bool), "
+    "identified_as (string), name (string), type (Pest/Disease/Other), description (string), severity (Low/Medium/High/Critical), "
+    "affected_crops (string), solutions (array of strings), prevention (array of strings)."
+)
+
+class UploadRejected(Exception):
+    """Raised when an upload cannot be turned into a model-ready image."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+PreparedImage = namedtuple("PreparedImage", "data mime_type sha256 phash width height original_size screening")
+
+def read_upload(file, limit=None):
+    """Read an uploaded file in chunks, refusing anything larger than the limit."""
+    return _read_limited(file.stream, limit or MAX_IMAGE_BYTES)
+
+def _read_limited(stream, limit):
+    chunks, total = [], 0
+    while True:
+        chunk = stream.read(64 * 1024)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > limit:
+            raise UploadRejected(f"Image too large. Maximum size is {limit // (1024 * 1024)} MB", status=413)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def _dhash(img, size=8):
+    """64-bit difference hash; near-identical photos differ by only a few bits."""
+    small = img.convert("L").resize((size + 1, size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            bits = (bits << 1) | (left > pixels[row * (size + 1) + col + 1])
+    return bits
+
+def _lut(test):
+    return [255 if test(x) else 0 for x in range(256)]
+
+# Pillow's HSV hue runs 0-255 over the colour wheel: 25-135 spans yellow-green to teal,
+# <25 and >245 the oranges, browns and reds of soil, dry or diseased leaves. Skin tones
+# fall in the same range, so the skin mask is reported but never held against a photo.
+_GREEN_HUE = _lut(lambda h: 25 <= h <= 135)
+_EARTH_HUE = _lut(lambda h: h < 25 or h > 245)
+_VIVID_SAT = _lut(lambda s: s > 50)
+_LIT = _lut(lambda v: v > 30)
+_SKIN_LIT = _lut(lambda v: v > 60)
+_SKIN_CB = _lut(lambda cb: 77 <= cb <= 127)
+_SKIN_CR = _lut(lambda cr: 133 <= cr <= 173)
+_SAME = _lut(lambda d: d == 0)
+
+Screening = namedtuple("Screening", "passed score reasons sharpness brightness features elapsed_ms")
+
+class ImagePrefilter:
+    """Millisecond CPU screen for pest checker uploads, run before any vision model call.
+
+    Colour and texture heuristics on a 128 px thumbnail give a 0-1 plant score: the share
+    of green foliage plus a little for soil and brown leaf tones. Images where most pixels
+    exactly repeat their neighbour's colour (screenshots, logos, flat graphics) are scaled
+    towards zero; that is measured on unaveraged pixels, since downscaling with a filter
+    smooths photo texture into flat areas.
+    Separately, very dark, blown-out or blurry photos are marked unusable. With mode
+    ``reject`` a failing upload is answered locally; ``flag`` only annotates the model's
+    answer (the default until the thresholds are validated on real crop photos).
+    ``bench/prefilter_eval.py`` measures them against labelled folders.
+    """
+
+    def __init__(self, mode, threshold, min_sharpness):
+        self.mode = mode
+        self.threshold = threshold
+        self.min_sharpness = min_sharpness
+        self._lock = threading.Lock()
+        self.screened = 0
+        self.rejected = Counter()
+        self.flagged = 0
+        self.calls_saved = 0
+        self._total_ms = 0.0
+
+    def screen(self, img):
+        """Score an RGB image; returns a Screening (never raises on odd input)."""
+        started = time.perf_counter()
+        # Sharpness is judged at 384 px, colour at 128 px; both come from one downscale
+        mid = img.copy()
+        mid.thumbnail((384, 384), Image.BILINEAR)
+        small = mid.copy()
+        small.thumbnail((128, 128), Image.BILINEAR)
+        hue, sat, val = small.convert("HSV").split()
+        _, cb, cr = small.convert("YCbCr").split()
+        vivid = ImageChops.multiply(sat.point(_VIVID_SAT), val.point(_LIT))
+        skin = ImageChops.multiply(ImageChops.multiply(cb.point(_SKIN_CB), cr.point(_SKIN_CR)), val.point(_SKIN_LIT))
+
+        def share(mask):
+            return ImageStat.Stat(mask).mean[0] / 255
+
+        green = share(ImageChops.multiply(vivid, hue.point(_GREEN_HUE)))
+        earth = share(ImageChops.multiply(vivid, hue.point(_EARTH_HUE)))
+        skin_share = share(skin)
+        # Nearest-neighbour sampling keeps original pixel values; filtering would blend texture away
+        sample = img.resize(mid.size, Image.NEAREST) if img.size != mid.size else img
+        diff = ImageChops.lighter(ImageChops.difference(sample, ImageChops.offset(sample, 1, 0)),
+                                  ImageChops.difference(sample, ImageChops.offset(sample, 0, 1)))
+        r, g, b = diff.split()
+        flat = share(ImageChops.lighter(ImageChops.lighter(r, g), b).point(_SAME))
+        # Sensor noise makes exact repeats rare in photos (< 5% even when smooth); UI and graphics are mostly repeats
+        synthetic = min(1.0, max(0.0, (flat - 0.15) / 0.25))
+        score = min(1.0, green / 0.25 + 0.4 * earth) * (1 - synthetic)
+
+        gray = mid.convert("L")
+        sharpness = ImageStat.Stat(gray.filter(ImageFilter.FIND_EDGES)).var[0]
+        brightness = ImageStat.Stat(gray).mean[0]
+
+        reasons = []
+        if score < self.threshold:
+            reasons.append("graphic" if synthetic >= 0.5 else "not_a_plant")
+        if brightness < 15:
+            reasons.append("too_dark")
+        elif brightness > 245:
+            reasons.append("overexposed")
+        elif sharpness < self.min_sharpness:
+            reasons.append("too_blurry")
+        features = {"green": round(green, 3), "earth": round(earth, 3), "skin": round(skin_share, 3),
+                    "flat": round(flat, 3)}
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.screened += 1
+            self._total_ms += elapsed_ms
+        return Screening(not reasons, round(score, 3), reasons, round(sharpness, 1), round(brightness, 1),
+                         features, round(elapsed_ms, 2))
+
+    def record(self, screening):
+        """Count a failed screening; returns True when the upload should skip the model."""
+        with self._lock:
+            if self.mode == "reject":
+                self.rejected[screening.reasons[0]] += 1
+                self.calls_saved += 1
+            else:
+                self.flagged += 1
+        metrics.inc("agribuddy_prefilter_total", outcome="rejected" if self.mode == "reject" else "flagged",
+                    reason=screening.reasons[0])
+        return self.mode == "reject"
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "threshold": self.threshold,
+                "min_sharpness": self.min_sharpness,
+                "screened": self.screened,
+                "rejected": dict(self.rejected),
+                "flagged": self.flagged,
+                "model_calls_saved": self.calls_saved,
+                "avg_ms": round(self._total_ms / self.screened, 2) if self.screened else 0.0,
+            }
+
+
+image_prefilter = ImagePrefilter(PREFILTER_MODE, PREFILTER_THRESHOLD, PREFILTER_MIN_SHARPNESS)
+
+_PREFILTER_MESSAGES = {
+    "not_a_plant": ("Not a crop photo", "This photo does not appear to show a plant, leaf or crop."),
+    "graphic": ("Screenshot or graphic", "This looks like a screenshot or graphic rather than a photo of a plant."),
+    "too_dark": ("Photo too dark", "The photo is too dark to see the plant clearly."),
+    "overexposed": ("Photo too bright", "The photo is washed out, so the leaf details are not visible."),
+    "too_blurry": ("Photo too blurry", "The photo is too blurry to identify pests or disease."),
+}
+
+def prefilter_result(screening):
+    """Diagnosis-shaped answer for an upload the pre-filter turned away."""
+    reason = screening.reasons[0]
+    name, description = _PREFILTER_MESSAGES[reason]
+    return {
+        "is_agricultural": reason not in ("not_a_plant", "graphic"),
+        "is_relevant": False,
+        "name": name,
+        "identified_as": name,
+        "type": "Other",
+        "description": description + " Please upload a clear, close-up photo of the affected leaf, stem or fruit.",
+        "severity": "N/A",
+        "affected_crops": "N/A",
+        "solutions": [
+            "Photograph the affected part of the plant from about 20-30 cm away",
+            "Use daylight and avoid strong shadows or direct glare",
+            "Hold the phone steady and tap the screen to focus before taking the photo",
+        ],
+        "prevention": [],
+        "prefilter": screening._asdict(),
+    }
+
+def prepare_image(raw):
+    """Downscale, orient and re-encode an upload as a metadata-free JPEG."""
+    try:
+        img = Image.open(io.BytesIO(raw))
+        # JPEG decoders can scale down while decoding, which is much cheaper than a full decode
+        img.draft("RGB", (VISION_MAX_SIDE, VISION_MAX_SIDE))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    except Exception as e:
+        raise UploadRejected("Invalid image file. Please upload a JPEG or PNG photo") from e
+    img.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.LANCZOS)
+    out = io.BytesIO()
+    # Saving without an exif argument drops EXIF (GPS, device) metadata
+    img.save(out, "JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    return PreparedImage(
+        data=out.getvalue(),
+        mime_type="image/jpeg",
+        sha256=hashlib.sha256(raw).hexdigest(),
+        phash=_dhash(img),
+        width=img.width,
+        height=img.height,
+        original_size=len(raw),
+        screening=image_prefilter.screen(img) if image_prefilter.mode != "off" else None,
+    )
+
+def _fallback_diagnosis(description):
+    return {
+        "is_agricultural": True,
+        "is_relevant": True,
+        "name": "Analysis Completed",
+        "type": "Information",
+        "description": description,
+        "severity": "N/A",
+        "affected_crops": "Various",
+        "solutions": ["Please consult with an agricultural expert for detailed analysis"],
+        "prevention": ["Regular monitoring of crops", "Maintain proper hygiene in farming areas"]
+    }
+
+def parse_diagnosis(resp_text):
+    """Returns (result, parsed) where parsed is False for the structured fallback."""
+    # Ensure resp_text is valid before attempting to parse JSON
+    if not resp_text or not isinstance(resp_text, (str, bytes, bytearray)):
+        return _fallback_diagnosis("No valid response text received from AI analysis"), False
+
+    try:
+        # Clean up the response text to extract JSON
+        cleaned_resp_text = resp_text.strip()
+
+        # Remove markdown code block wrappers if present
+        if cleaned_resp_text[:7] == "```json":
+            cleaned_resp_text = cleaned_resp_text[7:]  # Remove ```json
+        if cleaned_resp_text[:3] == "```":
+            cleaned_resp_text = cleaned_resp_text[3:]  # Remove ```
+        if cleaned_resp_text[-3:] == "```":
+            cleaned_resp_text = cleaned_resp_text[:-3]  # Remove ```
+
+        # Parse the JSON
+        with track("parse_diagnosis_json"):
+            result = json.loads(cleaned_resp_text)
+    except json.JSONDecodeError:
+        # Return a structured fallback with the raw response
+        return _fallback_diagnosis(f"Raw response from AI: {resp_text}"), False
+
+    # Ensure solutions and prevention are lists
+    if 'solutions' in result and isinstance(result['solutions'], str):
+        result['solutions'] = [result['solutions']]
+    if 'prevention' in result and isinstance(result['prevention'], str):
+        result['prevention'] = [result['prevention']]
+    return result, True
+
+def diagnose_image(vision_model, prepared, user_id=None):
+    """Run the vision model on a prepared image; returns (result, parsed)."""
+    image_part = {
+        'mime_type': prepared.mime_type,
+        'data': prepared.data
+    }
+
+    def call():
+        with track("gemini_vision"):
+            response = vision_model.generate_content([PEST_ANALYSIS_PROMPT, image_part])
+        resp_text = getattr(response, 'text', None) or (response.get('text') if isinstance(response, dict) else str(response))
+        return parse_diagnosis(resp_text)
+
+    # The same photo uploaded twice at once is diagnosed once
+    return gemini_call(("vision", prepared.sha256), call, user_id)
+
+def cached_diagnosis(vision_model, prepared, user_id=None):
+    """Diagnose via the cache when the same (or a near-identical) photo was seen; returns (result, cached)."""
+    result = diagnosis_cache.get(prepared)
+    if result is not None:
+        return result, True
+    screening = prepared.screening
+    if screening is not None and not screening.passed and image_prefilter.record(screening):
+        return prefilter_result(screening), False
+    result, parsed = diagnose_image(vision_model, prepared, user_id)
+    if screening is not None and not screening.passed:
+        result = dict(result, prefilter=screening._asdict())
+    # Fallback results carry no diagnosis worth reusing
+    if parsed:
+        diagnosis_cache.set(prepared, result)
+    return result, False
+
+@app.route("/pest-checker/stats")
+def pest_checker_stats():
+    return jsonify({
+        "diagnosis_cache": diagnosis_cache.stats(),
+        "prefilter": image_prefilter.stats(),
+        "admission": gemini_admission.stats(),
+    })
 
 @app.route("/pest-checker", methods=["POST"])
 def pest_checker_post():
@@ -428,222 +3200,938 @@ def pest_checker_post():
     if not content_type or not content_type.startswith('image/'):
         return jsonify({"error": "Invalid file type. Please upload an image file"}), 400
     
+    # Vision model is resolved once at startup (see VISION_MODELS)
+    vision_model = model_registry.get("vision")
+    if not vision_model:
+        return jsonify({"error": "Vision model not available in configured GenAI library."}), 500
+
     try:
-        # Read image file
-        image_data = file.read()
-        
-        # Create prompt for Gemini API
-        prompt = (
-            "You are an agricultural expert AI assistant specialized in plant pest and disease identification. "
-            "Analyze the provided image and return a JSON object with fields: is_agricultural (bool), is_relevant (bool), "
-            "identified_as (string), name (string), type (Pest/Disease/Other), description (string), severity (Low/Medium/High/Critical), "
-            "affected_crops (string), solutions (array of strings), prevention (array of strings)."
-        )
-        
-        # Call Gemini 2.0 Vision model
-        try:
-            # Use Gemini 2.0 Flash model
-            vision_model = genai.GenerativeModel('gemini-2.0-flash')
-        except Exception:
-            # Fallback to gemini-1.5-flash if gemini-2.0-flash is not available
-            try:
-                vision_model = genai.GenerativeModel('gemini-1.5-flash')
-            except Exception:
-                # Fallback to gemini-pro-vision if newer models are not available
-                try:
-                    vision_model = genai.GenerativeModel('gemini-pro-vision')
-                except Exception:
-                    vision_model = None
-        
-        if not vision_model:
-            return jsonify({"error": "Vision model not available in configured GenAI library."}), 500
-        
-        # Prepare the content for Gemini API
-        image_part = {
-            'mime_type': content_type,
-            'data': image_data
-        }
-        
-        # Generate content using Gemini
-        response = vision_model.generate_content([prompt, image_part])
-        
-        # Attempt to parse JSON from response text
-        resp_text = getattr(response, 'text', None) or (response.get('text') if isinstance(response, dict) else str(response))
-        
-        # Ensure resp_text is valid before attempting to parse JSON
-        if not resp_text or not isinstance(resp_text, (str, bytes, bytearray)):
-            return jsonify({
-                "is_agricultural": True,
-                "is_relevant": True,
-                "name": "Analysis Completed",
-                "type": "Information",
-                "description": "No valid response text received from AI analysis",
-                "severity": "N/A",
-                "affected_crops": "Various",
-                "solutions": ["Please consult with an agricultural expert for detailed analysis"],
-                "prevention": ["Regular monitoring of crops", "Maintain proper hygiene in farming areas"]
-            })
-        
-        try:
-            # Clean up the response text to extract JSON
-            cleaned_resp_text = resp_text.strip()
-            
-            # Remove markdown code block wrappers if present
-            if cleaned_resp_text[:7] == "```json":
-                cleaned_resp_text = cleaned_resp_text[7:]  # Remove ```json
-            if cleaned_resp_text[:3] == "```":
-                cleaned_resp_text = cleaned_resp_text[3:]  # Remove ```
-            if cleaned_resp_text[-3:] == "```":
-                cleaned_resp_text = cleaned_resp_text[:-3]  # Remove ```
-            
-            # Parse the JSON
-            result = json.loads(cleaned_resp_text)
-            
-            # Ensure solutions and prevention are lists
-            if 'solutions' in result and isinstance(result['solutions'], str):
-                result['solutions'] = [result['solutions']]
-            if 'prevention' in result and isinstance(result['prevention'], str):
-                result['prevention'] = [result['prevention']]
-                
-            return jsonify(result)
-        except json.JSONDecodeError as e:
-            # Return a structured fallback with the raw response
-            return jsonify({
-                "is_agricultural": True,
-                "is_relevant": True,
-                "name": "Analysis Completed",
-                "type": "Information",
-                "description": f"Raw response from AI: {resp_text}",
-                "severity": "N/A",
-                "affected_crops": "Various",
-                "solutions": ["Please consult with an agricultural expert for detailed analysis"],
-                "prevention": ["Regular monitoring of crops", "Maintain proper hygiene in farming areas"]
-            })
+        prepared = prepare_image(read_upload(file))
+    except UploadRejected as e:
+        return jsonify({"error": str(e)}), e.status
+
+    try:
+        result, cached = cached_diagnosis(vision_model, prepared, session.get('user_id'))
+        return jsonify(dict(result, cached=cached))
+    except Overloaded:
+        raise
     except Exception as e:
         print(f"Error processing image: {str(e)}")
         return jsonify({"error": "Failed to process image. Please try again.", "detail": str(e)}), 500
 
-@app.route("/test-session")
-def test_session():
-    return jsonify({
-        "session": dict(session),
-        "logged_in": session.get('logged_in', False),
-        "user_id": session.get('user_id', None),
-        "user_email": session.get('user_email', None)
-    })
+_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".heic", ".tif", ".tiff")
+_SEVERITY_ORDER = {"low": 1, "medium": 2, "high": 3, "critical": 4}
+
+def collect_batch_images(files):
+    """Flatten uploaded images and zip archives into a list of (filename, raw bytes)."""
+    images, total = [], 0
+
+    def add(name, raw):
+        nonlocal total
+        total += len(raw)
+        if total > BATCH_MAX_BYTES:
+            raise UploadRejected(f"Batch too large. Maximum total size is {BATCH_MAX_BYTES // (1024 * 1024)} MB", status=413)
+        if len(images) >= BATCH_MAX_IMAGES:
+            raise UploadRejected(f"Too many images. Maximum is {BATCH_MAX_IMAGES} per batch", status=413)
+        images.append((name, raw))
+
+    for file in files:
+        if not file or file.filename == '':
+            continue
+        is_zip = file.filename.lower().endswith(".zip") or (file.content_type or "") in ("application/zip", "application/x-zip-compressed")
+        if not is_zip:
+            add(file.filename, read_upload(file))
+            continue
+        try:
+            with zipfile.ZipFile(io.BytesIO(_read_limited(file.stream, BATCH_MAX_BYTES))) as archive:
+                for info in archive.infolist():
+                    name = info.filename
+                    base = os.path.basename(name)
+                    if info.is_dir() or base.startswith(".") or "__MACOSX" in name or not base.lower().endswith(_IMAGE_EXTENSIONS):
+                        continue
+                    if info.file_size > MAX_IMAGE_BYTES:
+                        raise UploadRejected(f"{name} is too large. Maximum size is {MAX_IMAGE_BYTES // (1024 * 1024)} MB", status=413)
+                    with archive.open(info) as member:
+                        add(name, _read_limited(member, MAX_IMAGE_BYTES))
+        except zipfile.BadZipFile:
+            raise UploadRejected(f"{file.filename} is not a valid zip archive")
+    return images
+
+def _diagnose_batch_item(vision_model, raw, user_id):
+    prepared = prepare_image(raw)
+    return cached_diagnosis(vision_model, prepared, user_id)
+
+# Users with a field survey streaming; one at a time each, so a user cannot multiply their vision share
+_active_batches = set()
+_active_batches_lock = threading.Lock()
+
+def _batch_busy_response():
+    retry_after = max(1, int(math.ceil(gemini_admission.stats()["avg_call_seconds"] * BATCH_REQUEST_WORKERS)))
+    response = jsonify({"error": "A field survey is already running for your account. Please wait for it to finish.",
+                        "reason": "user_limit"})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+def _end_batch(user_id):
+    with _active_batches_lock:
+        _active_batches.discard(user_id)
+
+def summarize_batch(results, failed, elapsed):
+    """Field-level roll-up of the per-image diagnoses."""
+    issues = Counter()
+    severities = Counter()
+    worst = None
+    for result in results:
+        if result.get("prefilter") and result.get("is_relevant") is False:
+            # Turned away locally: "Photo too blurry" is more useful than a generic label
+            issues[result["name"]] += 1
+            continue
+        if result.get("is_relevant") is False or result.get("is_agricultural") is False:
+            issues["Not a crop image"] += 1
+            continue
+        issues[result.get("name") or result.get("identified_as") or "Unknown"] += 1
+        severity = str(result.get("severity") or "").strip()
+        if severity.lower() in _SEVERITY_ORDER:
+            severities[severity.title()] += 1
+            if worst is None or _SEVERITY_ORDER[severity.lower()] > _SEVERITY_ORDER[worst.lower()]:
+                worst = severity.title()
+    return {
+        "images": len(results) + failed,
+        "succeeded": len(results),
+        "failed": failed,
+        "cached": sum(1 for result in results if result.get("cached")),
+        "issues": [{"name": name, "count": count} for name, count in issues.most_common()],
+        "severity_counts": dict(severities),
+        "highest_severity": worst,
+        "elapsed_ms": round(elapsed * 1000, 1),
+    }
+
+@app.route("/pest-checker/batch", methods=["POST"])
+def pest_checker_batch():
+    """Diagnose many images (or zip archives of images) and stream NDJSON results as they finish."""
+    if 'logged_in' not in session:
+        return jsonify({"error": "Please log in first"}), 401
+    if not GEMINI_API_KEY:
+        return jsonify({"error": "Gemini API key not configured"}), 500
+    vision_model = model_registry.get("vision")
+    if not vision_model:
+        return jsonify({"error": "Vision model not available in configured GenAI library."}), 500
+    user_id = session['user_id']
+    # Cheap check before the upload is read; the slot itself is claimed once the stream is ready
+    if user_id in _active_batches:
+        return _batch_busy_response()
+
+    try:
+        images = collect_batch_images(request.files.getlist('images') + request.files.getlist('archive'))
+    except UploadRejected as e:
+        return jsonify({"error": str(e)}), e.status
+    if not images:
+        return jsonify({"error": "No image files provided"}), 400
+    with _active_batches_lock:
+        if user_id in _active_batches:
+            return _batch_busy_response()
+        _active_batches.add(user_id)
+
+    batch_started = time.monotonic()
+    # More than the user's admission share would only trip their own per-user limit
+    width = max(1, min(BATCH_REQUEST_WORKERS, gemini_admission.per_user))
+    backlog = deque(enumerate(images))
+    running = {}  # future -> (index, submitted at)
+    abandoned = set()  # reported as timed out but still on a pool thread
+
+    def submit_next():
+        # Each batch keeps only a few images on the shared pool, so concurrent batches interleave
+        # instead of one survey queueing all of its images ahead of everyone else's
+        while backlog and len(running) < width:
+            index, (_, raw) = backlog.popleft()
+            running[vision_pool.submit(_diagnose_batch_item, vision_model, raw, user_id)] = (index, time.monotonic())
+
+    def generate():
+        results, failed = [], 0
+        try:
+            submit_next()
+            while backlog or len(running) > len(abandoned):
+                done, _ = wait(list(running), timeout=1.0, return_when=FIRST_COMPLETED)
+                lines = []
+                for future in done:
+                    index, _ = running.pop(future)
+                    if future in abandoned:
+                        abandoned.discard(future)
+                        continue
+                    item = {"index": index, "filename": images[index][0]}
+                    try:
+                        result, cached = future.result()
+                        result = dict(result, cached=cached)
+                        results.append(result)
+                        lines.append(dict(item, status="ok", result=result))
+                    except UploadRejected as e:
+                        failed += 1
+                        lines.append(dict(item, status="error", error=str(e)))
+                    except Overloaded as e:
+                        failed += 1
+                        lines.append(dict(item, status="error", error="Service busy, please retry", retry_after=e.retry_after))
+                    except Exception as e:
+                        failed += 1
+                        print(f"Batch item {index} failed: {str(e)}")
+                        lines.append(dict(item, status="error", error="Failed to process image"))
+                # Overdue images are reported and no longer waited for; one that is still running
+                # keeps its slot until it returns, so a stuck batch cannot take more of the pool
+                now = time.monotonic()
+                for future, (index, submitted) in running.items():
+                    if future not in abandoned and now - submitted > BATCH_ITEM_TIMEOUT:
+                        abandoned.add(future)
+                        future.cancel()
+                        failed += 1
+                        lines.append({"index": index, "filename": images[index][0], "status": "error", "error": "Timed out"})
+                submit_next()
+                for line in lines:
+                    yield json.dumps(line) + "\n"
+            yield json.dumps({"summary": summarize_batch(results, failed, time.monotonic() - batch_started)}) + "\n"
+        finally:
+            # Client gone or batch finished: drop whatever has not started yet
+            backlog.clear()
+            for future in running:
+                future.cancel()
+
+    response = streaming_response(generate(), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+    # Released even if the client goes away before the generator starts
+    response.call_on_close(lambda: _end_batch(user_id))
+    return response
+
+@app.route("/models")
+def models_status():
+    return jsonify(model_registry.status())
 
 @app.route("/weather-dashboard")
 def weather_dashboard():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
-    return render_template("weather_dashboard.html")
+    return render_page("weather_dashboard.html")
 
-# ---------- FIXED WEATHER FUNCTIONS ----------
+def lookup_weather(kind, query):
+    """Current weather for a city, ZIP or (lat, lon); returns (place name or None, result)."""
+    if kind == "zip":
+        lat, lon, name = get_coordinates_by_zip(query)
+        if lat and lon:
+            return name, get_weather_by_coordinates(lat, lon)
+        return None, get_weather_by_zip(query)
+    if kind == "coord":
+        return None, get_weather_by_coordinates(*query)
+    return query, get_weather(query)
+
+def _bulk_locations():
+    """(kind, query) pairs from a JSON body or repeated query args, in request order.
+
+    Raises ValueError for a body that is not an object of lists, or malformed coordinates.
+    """
+    if request.method == "POST":
+        data = request.get_json(silent=True)
+        if data is None:
+            data = {}
+        if not isinstance(data, dict):
+            raise ValueError("body must be a JSON object")
+        cities, zips, coordinates = data.get("cities") or [], data.get("zips") or [], data.get("coordinates") or []
+        for field, values in (("cities", cities), ("zips", zips), ("coordinates", coordinates)):
+            if not isinstance(values, list):
+                raise ValueError(f"{field} must be a list")
+    else:
+        cities, zips = request.args.getlist("city"), request.args.getlist("zip")
+        coordinates = [value.split(",", 1) for value in request.args.getlist("coord")]
+    locations = [("city", str(city).strip()) for city in cities if str(city).strip()]
+    locations += [("zip", _normalize_zip(zip_code)) for zip_code in zips if str(zip_code).strip()]
+    for point in coordinates:
+        lat, lon = (point.get("lat"), point.get("lon")) if isinstance(point, dict) else point
+        try:
+            lat, lon = float(lat), float(lon)
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid coordinates: {point!r}")
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError(f"coordinates out of range: {lat},{lon}")
+        locations.append(("coord", (lat, lon)))
+    return locations
+
+@app.route("/weather/bulk", methods=["GET", "POST"])
+def weather_bulk():
+    """Current weather for many cities, ZIPs and coordinates in one round trip.
+
+    Locations that share a cache entry (same city, PIN code or grid cell) are looked up
+    once, and the distinct ones run side by side on the I/O pool.
+    """
+    try:
+        locations = _bulk_locations()
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid request: {e}"}), 400
+    if not locations:
+        return jsonify({"error": "Provide cities, zips or coordinates"}), 400
+    if len(locations) > WEATHER_BULK_MAX:
+        return jsonify({"error": f"Too many locations. Maximum is {WEATHER_BULK_MAX} per request"}), 413
+
+    started = time.perf_counter()
+    unique = {}
+    for kind, query in locations:
+        unique.setdefault(_location_key(kind, query), (kind, query))
+    resolved, futures = {}, {}
+    todo = list(unique.items())
+    while todo or futures:
+        # Bounded so one dashboard cannot occupy every I/O worker
+        while todo and len(futures) < WEATHER_BULK_CONCURRENCY:
+            key, (kind, query) = todo.pop()
+            futures[io_pool.submit(lookup_weather, kind, query)] = key
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            key = futures.pop(future)
+            try:
+                resolved[key] = future.result()
+            except Exception as e:
+                print("Bulk weather lookup failed:", str(e))
+                resolved[key] = (None, "Error fetching weather.")
+
+    results = []
+    for kind, query in locations:
+        name, weather_info = resolved[_location_key(kind, query)]
+        item = {"city": query} if kind == "city" else {"zip": query} if kind == "zip" else {"lat": query[0], "lon": query[1]}
+        if name and kind != "city":
+            item["name"] = name
+        if isinstance(weather_info, WeatherSnapshot):
+            item["weather"] = weather_info.to_dict()
+        else:
+            item["error"] = weather_info or "Weather data not available."
+        results.append(item)
+    return jsonify({
+        "results": results,
+        "requested": len(locations),
+        "unique": len(unique),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    })
+
+@app.route("/weather/stats")
+def weather_stats():
+    return jsonify({
+        "cache": weather_cache.stats(),
+        "geocode_index": geocode_index.stats(),
+        "lookup_latency": weather_lookup_latency.summary(),
+        "prefetch": weather_prefetcher.stats(),
+        "openweather": dict(
+            openweather_stats,
+            latency=openweather_latency.summary(),
+            breaker=openweather_breaker.stats(),
+            connections=_connection_pool_stats(_openweather_adapter),
+        ),
+    })
+
+# ---------- WEATHER CACHE ----------
+
+def _normalize_city(city):
+    return " ".join(str(city).lower().split())
+
+def _normalize_zip(zip_code):
+    return re.sub(r"\s+", "", str(zip_code))
+
+def _grid_cell(lat, lon):
+    # Nearby coordinates share one cache entry; a cell is WEATHER_GRID_DEGREES wide
+    return (round(float(lat) / WEATHER_GRID_DEGREES), round(float(lon) / WEATHER_GRID_DEGREES))
+
+def _location_key(kind, query):
+    if kind == "city":
+        return ("city", _normalize_city(query))
+    if kind == "zip":
+        return ("zip", _normalize_zip(query))
+    return ("coord",) + _grid_cell(*query)
 
+def _timed_lookup(func):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with track(func.__name__):
+                return func(*args, **kwargs)
+        finally:
+            weather_lookup_latency.observe(time.perf_counter() - started)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+def _openweather_get(path, params):
+    """Single choke point for OpenWeather HTTP calls: pooled session, retries, circuit breaker.
+
+    ``params`` are encoded by requests, so user-supplied city names cannot add or override parameters.
+    """
+    if not openweather_breaker.allow():
+        raise CircuitOpenError("OpenWeather circuit open")
+    started = time.perf_counter()
+    with _openweather_stats_lock:
+        openweather_stats["calls"] += 1
+    try:
+        # e.g. "openweather_weather", "openweather_zip", "openweather_forecast"
+        with track("openweather_" + path.rsplit("/", 1)[-1]):
+            res = openweather_http.get(OPENWEATHER_BASE_URL + path, params=dict(params, appid=OPENWEATHER_API_KEY),
+                                       timeout=(OPENWEATHER_CONNECT_TIMEOUT, OPENWEATHER_READ_TIMEOUT))
+    except Exception:
+        with _openweather_stats_lock:
+            openweather_stats["errors"] += 1
+        openweather_breaker.record_failure()
+        raise
+    finally:
+        openweather_latency.observe(time.perf_counter() - started)
+    # 4xx (unknown city, bad ZIP) is a valid answer; only server errors count against the breaker
+    if res.status_code >= 500:
+        openweather_breaker.record_failure()
+    else:
+        openweather_breaker.record_success()
+    return res
+
+def _stale(key):
+    """Expired cache entry to serve while OpenWeather is failing, if there is one."""
+    value = weather_cache.get_stale(key)
+    return None if value is _NOT_FOUND else value
+
+@_timed_lookup
 def get_weather(city):
+    key = _location_key("city", city)
+    weather_prefetcher.touch("city", city)
+    cached = weather_cache.get(key)
+    if cached is not None:
+        return cached
+    result = _fetch_weather(city)
+    if isinstance(result, WeatherSnapshot):
+        weather_cache.set(key, result)
+        return result
+    return _stale(key) or result
+
+@_timed_lookup
+def _local_zip_coordinates(pin):
+    """Coordinates for a PIN code from the cache or geocode index, or None when only the API knows."""
+    key = ("geo", pin)
+    cached = weather_cache.get(key)
+    if cached is not None:
+        return cached if cached is not _NOT_FOUND else (None, None, None)
+    # PIN code coordinates never change, so the local index is authoritative once populated
+    indexed = geocode_index.lookup(pin)
+    if indexed is not None:
+        result = tuple(indexed)
+        weather_cache.set(key, result, ttl=max(WEATHER_CACHE_TTL, WEATHER_NEGATIVE_TTL))
+        return result
+    return None
+
+def get_coordinates_by_zip(zip_code):
+    pin = _normalize_zip(zip_code)
+    local = _local_zip_coordinates(pin)
+    if local is not None:
+        return local
+    key = ("geo", pin)
+    result, not_found = _fetch_coordinates_by_zip(pin)
+    if result[0] is not None:
+        geocode_index.store(pin, *result)
+        weather_cache.set(key, result, ttl=max(WEATHER_CACHE_TTL, WEATHER_NEGATIVE_TTL))
+    elif not_found:
+        weather_cache.set(key, _NOT_FOUND, ttl=WEATHER_NEGATIVE_TTL)
+    else:
+        return _stale(key) or result
+    return result
+
+@_timed_lookup
+def get_weather_by_coordinates(lat, lon):
+    key = _location_key("coord", (lat, lon))
+    weather_prefetcher.touch("coord", (lat, lon))
+    cached = weather_cache.get(key)
+    if cached is not None:
+        return cached
+    result = _fetch_weather_by_coordinates(lat, lon)
+    if isinstance(result, WeatherSnapshot):
+        weather_cache.set(key, result)
+        return result
+    return _stale(key) or result
+
+@_timed_lookup
+def get_weather_by_zip(zip_code):
+    """Fallback direct weather fetch if coordinates not found"""
+    key = _location_key("zip", zip_code)
+    cached = weather_cache.get(key)
+    if cached is not None:
+        return cached if cached is not _NOT_FOUND else None
+    result, not_found = _fetch_weather_by_zip(zip_code)
+    if result:
+        weather_cache.set(key, result)
+    elif not_found:
+        weather_cache.set(key, _NOT_FOUND, ttl=WEATHER_NEGATIVE_TTL)
+    else:
+        return _stale(key)
+    return result
+
+@_timed_lookup
+def get_forecast(kind, query):
+    """Daily (and 3-hourly) forecast for a city, ZIP or (lat, lon); None if unavailable."""
+    key = ("forecast",) + _location_key(kind, query)
+    weather_prefetcher.touch(kind, query)
+    cached = weather_cache.get(key)
+    if cached is not None:
+        return cached
+    forecast = _fetch_forecast(kind, query)
+    if forecast:
+        weather_cache.set(key, forecast, ttl=FORECAST_CACHE_TTL)
+        return forecast
+    return _stale(key)
+
+def refresh_location(kind, query, margin, acquire=None):
+    """Re-fetch current weather and forecast for a location if either expires within ``margin`` seconds.
+
+    ``acquire`` is called before each upstream call; when it returns False the
+    refresh stops and RateLimited is raised.
+    """
+    weather_key = _location_key(kind, query)
+    forecast_key = ("forecast",) + weather_key
+    refreshed = 0
+    remaining = weather_cache.ttl_remaining(weather_key)
+    if remaining is None or remaining < margin:
+        if acquire and not acquire():
+            raise RateLimited()
+        if kind == "city":
+            result = _fetch_weather(query)
+        elif kind == "zip":
+            result, _ = _fetch_weather_by_zip(query)
+        else:
+            result = _fetch_weather_by_coordinates(*query)
+        if isinstance(result, WeatherSnapshot):
+            weather_cache.set(weather_key, result)
+            refreshed += 1
+    remaining = weather_cache.ttl_remaining(forecast_key)
+    if remaining is None or remaining < margin:
+        if acquire and not acquire():
+            raise RateLimited()
+        forecast = _fetch_forecast(kind, query)
+        if forecast:
+            weather_cache.set(forecast_key, forecast, ttl=FORECAST_CACHE_TTL)
+            refreshed += 1
+    return refreshed
+
+class WeatherPrefetcher:
+    """Background thread that keeps weather warm for busy locations and active users.
+
+    Two sources feed each pass: locations requested recently (ranked by hit
+    count) and the profile/ZIP locations of users who chatted within
+    ``user_window``. Upstream calls are paced by a token bucket so prefetching
+    never eats more than ``OPENWEATHER_PREFETCH_RPM`` of the OpenWeather quota.
+    During the configured peak hours passes run every ``peak_interval`` seconds.
+    """
+
+    def __init__(self, interval, window, limit, user_window, rate_limiter, peak_hours=None, peak_interval=None):
+        self.interval = interval
+        self.window = window
+        self.limit = limit
+        self.user_window = user_window
+        self.rate_limiter = rate_limiter
+        self.peak_hours = peak_hours or set()
+        self.peak_interval = peak_interval or interval
+        self._locations = {}  # location key -> [kind, query, last_seen, hits]
+        self._users = {}  # user id -> (kind, query, last_seen)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.passes = 0
+        self.refreshed = 0
+        self.throttled = 0
+
+    def touch(self, kind, query):
+        if self.interval <= 0:
+            return
+        key = _location_key(kind, query)
+        with self._lock:
+            entry = self._locations.get(key)
+            if entry is None:
+                self._locations[key] = [kind, query, time.monotonic(), 1]
+            else:
+                entry[2] = time.monotonic()
+                entry[3] += 1
+        self.start()
+
+    def note_user(self, user_id, city=None, zip_code=None):
+        """Remember where an active user farms so their weather is ready on the next visit."""
+        if self.interval <= 0 or not user_id or not (city or zip_code):
+            return
+        with self._lock:
+            self._users[user_id] = ("zip", zip_code, time.monotonic()) if zip_code else ("city", city, time.monotonic())
+        self.start()
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="agribuddy-prefetch", daemon=True)
+                    self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def hot_locations(self):
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k, entry in self._locations.items() if entry[2] < now - self.window]:
+                del self._locations[key]
+            for user_id in [u for u, entry in self._users.items() if entry[2] < now - self.user_window]:
+                del self._users[user_id]
+            ranked = sorted(self._locations.values(), key=lambda entry: entry[3], reverse=True)
+            users = list(self._users.values())
+        locations = OrderedDict()
+        for kind, query, _, _ in ranked[:self.limit]:
+            locations.setdefault(_location_key(kind, query), (kind, query))
+        for kind, query, _ in users:
+            if kind == "zip":
+                # /weather and /chat read ZIP weather through the coordinate cell; a geocoding
+                # call counts against the prefetch quota like any other, and without a token
+                # the ZIP is refreshed as-is (and throttled there)
+                coordinates = _local_zip_coordinates(_normalize_zip(query))
+                if coordinates is None and self._acquire():
+                    coordinates = get_coordinates_by_zip(query)
+                lat, lon, _ = coordinates or (None, None, None)
+                if lat and lon:
+                    kind, query = "coord", (lat, lon)
+            locations.setdefault(_location_key(kind, query), (kind, query))
+        return list(locations.values())
+
+    def _acquire(self):
+        if self.rate_limiter.acquire(timeout=self.current_interval()):
+            return True
+        self.throttled += 1
+        return False
+
+    def run_once(self):
+        refreshed = 0
+        for kind, query in self.hot_locations():
+            if openweather_breaker.state != "closed":
+                break
+            try:
+                # Refresh anything that would expire before the next pass
+                refreshed += refresh_location(kind, query, margin=self.current_interval() * 1.5, acquire=self._acquire)
+            except RateLimited:
+                break
+            except Exception as e:
+                print(f"Weather prefetch failed for {kind} {query}:", str(e))
+        self.passes += 1
+        self.refreshed += refreshed
+        return refreshed
+
+    def current_interval(self):
+        local_hour = (datetime.now(timezone.utc) + PREFETCH_TZ_OFFSET).hour
+        return self.peak_interval if local_hour in self.peak_hours else self.interval
+
+    def _run(self):
+        while not self._stop.wait(self.current_interval()):
+            self.run_once()
+
+    def reset(self):
+        """Forget the parent's thread after fork(); the child starts its own when a location is touched."""
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def stats(self):
+        with self._lock:
+            tracked = len(self._locations)
+            users = len(self._users)
+        return {
+            "interval": self.current_interval(),
+            "tracked_locations": tracked,
+            "active_users": users,
+            "passes": self.passes,
+            "refreshed": self.refreshed,
+            "throttled": self.throttled,
+        }
+
+
+def _parse_hours(spec):
+    """'4-9,17-19' -> {4, 5, 6, 7, 8, 9, 17, 18, 19}"""
+    hours = set()
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        start, _, end = part.partition("-")
+        hours.update(range(int(start), int(end or start) + 1))
+    return hours
+
+
+weather_prefetcher = WeatherPrefetcher(
+    WEATHER_REFRESH_INTERVAL,
+    HOT_LOCATION_WINDOW,
+    HOT_LOCATION_LIMIT,
+    user_window=ACTIVE_USER_WINDOW,
+    rate_limiter=TokenBucket(OPENWEATHER_PREFETCH_RPM / 60.0, capacity=max(1, OPENWEATHER_PREFETCH_RPM // 6)),
+    peak_hours=_parse_hours(PREFETCH_PEAK_HOURS),
+    peak_interval=PREFETCH_PEAK_INTERVAL,
+)
+
+_BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+def _component_metrics():
+    """Export the stats the JSON endpoints already report as Prometheus samples."""
+    caches = {
+        "weather": weather_cache,
+        "profile": profile_cache,
+        "conversation": conversation_cache,
+        "response": response_cache,
+        "diagnosis": diagnosis_cache,
+        "page": page_cache,
+    }
+    for name, cache in caches.items():
+        stats = cache.stats()
+        hits = stats.get("hits", stats.get("exact_hits", 0) + stats.get("near_hits", 0))
+        yield "agribuddy_cache_hits_total", "counter", {"cache": name}, hits
+        yield "agribuddy_cache_misses_total", "counter", {"cache": name}, stats["misses"]
+        yield "agribuddy_cache_entries", "gauge", {"cache": name}, stats["size"]
+    for key, value in message_writer.stats().items():
+        kind = "gauge" if key == "pending" else "counter"
+        suffix = "" if kind == "gauge" else "_total"
+        yield f"agribuddy_writer_{key}{suffix}", kind, {}, value
+    breaker = openweather_breaker.stats()
+    yield "agribuddy_openweather_breaker_state", "gauge", {}, _BREAKER_STATES.get(breaker["state"], -1)
+    yield "agribuddy_openweather_breaker_trips_total", "counter", {}, breaker["trips"]
+    yield "agribuddy_openweather_calls_total", "counter", {}, openweather_stats["calls"]
+    yield "agribuddy_openweather_errors_total", "counter", {}, openweather_stats["errors"]
+    prefetch = weather_prefetcher.stats()
+    yield "agribuddy_prefetch_refreshed_total", "counter", {}, prefetch["refreshed"]
+    yield "agribuddy_prefetch_throttled_total", "counter", {}, prefetch["throttled"]
+    yield "agribuddy_prefetch_tracked_locations", "gauge", {}, prefetch["tracked_locations"]
+    yield "agribuddy_prefilter_calls_saved_total", "counter", {}, image_prefilter.calls_saved
+    admission = gemini_admission.stats()
+    yield "agribuddy_gemini_in_flight", "gauge", {}, admission["in_flight"]
+    yield "agribuddy_gemini_queue_depth", "gauge", {}, admission["queued"]
+    yield "agribuddy_gemini_admitted_total", "counter", {}, admission["admitted"]
+    for lazy in Lazy.instances:
+        if lazy.init_seconds is not None:
+            yield "agribuddy_client_init_seconds", "gauge", {"client": lazy.name}, lazy.init_seconds
+    sessions = auth_sessions.peek()
+    if sessions:
+        for key, value in sessions.stats().items():
+            if key == "pooled_clients":
+                yield "agribuddy_auth_pooled_clients", "gauge", {}, value
+            else:
+                yield "agribuddy_auth_tokens_total", "counter", {"outcome": key}, value
+
+
+metrics.register_collector(_component_metrics)
+
+# ---------- FORECAST ----------
+
+_FORECAST_ICONS = {
+    "Clear": "fas fa-sun",
+    "Clouds": "fas fa-cloud",
+    "Rain": "fas fa-cloud-showers-heavy",
+    "Drizzle": "fas fa-cloud-rain",
+    "Thunderstorm": "fas fa-bolt",
+    "Snow": "fas fa-snowflake",
+}
+
+def _fetch_forecast(kind, query):
+    if not OPENWEATHER_API_KEY:
+        return None
+    if kind == "city":
+        location = {"q": query}
+    elif kind == "zip":
+        location = {"zip": f"{query},IN"}
+    else:
+        location = {"lat": query[0], "lon": query[1]}
+    try:
+        res = _openweather_get("/data/2.5/forecast", dict(location, units="metric"))
+        data = res.json()
+        if str(data.get("cod")) == '200':
+            return aggregate_forecast(data)
+        return None
+    except Exception as e:
+        print("Error fetching forecast:", str(e))
+        return None
+
+def aggregate_forecast(data, days=5, hours=8):
+    """Collapse OpenWeather's 3-hourly forecast into daily min/max/precipitation cards."""
+    offset = timedelta(seconds=(data.get("city") or {}).get("timezone", 0))
+    hourly = []
+    daily = OrderedDict()
+    for item in data.get("list", []):
+        local = datetime.fromtimestamp(item["dt"], tz=timezone.utc) + offset
+        main = item.get("main", {})
+        condition = (item.get("weather") or [{}])[0]
+        precipitation = (item.get("rain") or {}).get("3h", 0) + (item.get("snow") or {}).get("3h", 0)
+        visibility = item.get("visibility")
+        if len(hourly) < hours:
+            hourly.append({
+                "time": local.strftime("%I %p").lstrip("0"),
+                "temp": main.get("temp"),
+                "humidity": main.get("humidity"),
+                "visibility": visibility / 1000 if visibility else None,
+                "precipitation": round(precipitation, 1),
+            })
+        day = daily.setdefault(local.date(), {
+            "min": None, "max": None, "precipitation": 0.0,
+            "conditions": Counter(), "descriptions": Counter(), "wind": [], "pressure": [],
+        })
+        low, high = main.get("temp_min", main.get("temp")), main.get("temp_max", main.get("temp"))
+        if low is not None:
+            day["min"] = low if day["min"] is None else min(day["min"], low)
+        if high is not None:
+            day["max"] = high if day["max"] is None else max(day["max"], high)
+        day["precipitation"] += precipitation
+        if condition.get("main"):
+            day["conditions"][condition["main"]] += 1
+            day["descriptions"][condition.get("description", condition["main"])] += 1
+        if (item.get("wind") or {}).get("speed") is not None:
+            day["wind"].append(item["wind"]["speed"])
+        if main.get("pressure") is not None:
+            day["pressure"].append(main["pressure"])
+
+    cards = []
+    for date, day in list(daily.items())[:days]:
+        main_condition = day["conditions"].most_common(1)[0][0] if day["conditions"] else ""
+        description = day["descriptions"].most_common(1)[0][0] if day["descriptions"] else ""
+        icon = _FORECAST_ICONS.get(main_condition, "fas fa-smog")
+        if main_condition == "Clouds" and ("few" in description or "scattered" in description):
+            icon = "fas fa-cloud-sun"
+        cards.append({
+            "day": date.strftime("%a"),
+            "date": date.isoformat(),
+            "icon": icon,
+            "temp": f"{round(day['max'])}°C" if day["max"] is not None else "--°",
+            "desc": description.title(),
+            "min": day["min"],
+            "max": day["max"],
+            "precipitation": round(day["precipitation"], 1),
+            "wind": round(sum(day["wind"]) / len(day["wind"]), 1) if day["wind"] else None,
+            "pressure": round(sum(day["pressure"]) / len(day["pressure"])) if day["pressure"] else None,
+        })
+    return {"days": cards, "hourly": hourly}
+
+# ---------- FIXED WEATHER FUNCTIONS ----------
+
+class WeatherSnapshot:
+    """Current conditions for one location, parsed once from an OpenWeather ``/weather`` payload.
+
+    Slotted, so the thousands of entries ``weather_cache`` can hold carry no per-instance dict.
+    ``str()`` renders like the dict it replaced, so chat prompts are unchanged.
+    """
+
+    __slots__ = ("temperature", "description", "humidity", "wind_speed",
+                 "pressure", "visibility", "uv_index", "wind_gust")
+
+    def __init__(self, temperature, description, humidity, wind_speed,
+                 pressure=None, visibility=None, uv_index=None, wind_gust=None):
+        self.temperature = temperature
+        self.description = description
+        self.humidity = humidity
+        self.wind_speed = wind_speed
+        self.pressure = pressure
+        self.visibility = visibility
+        self.uv_index = uv_index
+        self.wind_gust = wind_gust
+
+    @classmethod
+    def from_openweather(cls, data):
+        visibility = data.get("visibility", None)
+        if visibility:
+            visibility = visibility / 1000  # Convert from meters to kilometers
+        return cls(
+            temperature=data["main"]["temp"],
+            description=data["weather"][0]["description"],
+            humidity=data["main"]["humidity"],
+            wind_speed=data["wind"]["speed"],
+            pressure=data["main"].get("pressure", None),
+            visibility=visibility,
+            uv_index=data.get("uvi", None),
+            wind_gust=data["wind"].get("gust", None),
+        )
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __str__(self):
+        return str(self.to_dict())
+
+    def __repr__(self):
+        return f"WeatherSnapshot({self.to_dict()!r})"
+
+def weather_json(value):
+    """JSON-ready form of a weather lookup result (a snapshot, an error message or None)."""
+    return value.to_dict() if isinstance(value, WeatherSnapshot) else value
+
+def _fetch_weather(city):
     if not OPENWEATHER_API_KEY:
         return "OpenWeather API key not configured."
     try:
-        url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={OPENWEATHER_API_KEY}&units=metric"
-        res = requests.get(url, timeout=8)
+        res = _openweather_get("/data/2.5/weather", {"q": city, "units": "metric"})
         data = res.json()
         if str(data.get("cod")) == '200':
-            visibility = data.get("visibility", None)
-            if visibility:
-                visibility = visibility / 1000  # Convert from meters to kilometers
-            
-            return {
-                "temperature": data["main"]["temp"],
-                "description": data["weather"][0]["description"],
-                "humidity": data["main"]["humidity"],
-                "wind_speed": data["wind"]["speed"],
-                "pressure": data["main"].get("pressure", None),
-                "visibility": visibility,
-                "uv_index": data.get("uvi", None),
-                "wind_gust": data["wind"].get("gust", None)
-            }
+            return WeatherSnapshot.from_openweather(data)
         else:
             return "Weather data not available."
     except Exception:
         return "Error fetching weather."
 
-def get_coordinates_by_zip(zip_code):
+def _fetch_coordinates_by_zip(zip_code):
+    """Returns ((lat, lon, name), not_found) where not_found marks a definitive 404."""
     if not OPENWEATHER_API_KEY:
-        return None, None, None
+        return (None, None, None), False
     try:
         # Use the ZIP-specific API for better accuracy in India
-        url = f"https://api.openweathermap.org/geo/1.0/zip?zip={zip_code},IN&appid={OPENWEATHER_API_KEY}"
-        res = requests.get(url, timeout=8)
+        res = _openweather_get("/geo/1.0/zip", {"zip": f"{zip_code},IN"})
         data = res.json()
         if "lat" in data and "lon" in data:
             lat = data["lat"]
             lon = data["lon"]
             name = data.get("name", f"ZIP {zip_code}")
-            return lat, lon, name
+            return (lat, lon, name), False
         else:
-            return None, None, None
+            return (None, None, None), str(data.get("cod")) == '404'
     except Exception as e:
         print("Error fetching coordinates:", str(e))
-        return None, None, None
+        return (None, None, None), False
 
-def get_weather_by_coordinates(lat, lon):
+def _fetch_weather_by_coordinates(lat, lon):
     if not OPENWEATHER_API_KEY:
         return "OpenWeather API key not configured."
     try:
-        url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric"
-        res = requests.get(url, timeout=8)
+        res = _openweather_get("/data/2.5/weather", {"lat": lat, "lon": lon, "units": "metric"})
         data = res.json()
         if str(data.get("cod")) == '200':
-            visibility = data.get("visibility", None)
-            if visibility:
-                visibility = visibility / 1000  # Convert from meters to kilometers
-            
-            return {
-                "temperature": data["main"]["temp"],
-                "description": data["weather"][0]["description"],
-                "humidity": data["main"]["humidity"],
-                "wind_speed": data["wind"]["speed"],
-                "pressure": data["main"].get("pressure", None),
-                "visibility": visibility,
-                "uv_index": data.get("uvi", None),
-                "wind_gust": data["wind"].get("gust", None)
-            }
+            return WeatherSnapshot.from_openweather(data)
         else:
             return "Weather data not available."
     except Exception:
         return "Error fetching weather."
 
-def get_weather_by_zip(zip_code):
-    """Fallback direct weather fetch if coordinates not found"""
+def _fetch_weather_by_zip(zip_code):
+    """Returns (weather, not_found) where not_found marks a definitive 404."""
     if not OPENWEATHER_API_KEY:
-        return None
+        return None, False
     try:
-        url = f"https://api.openweathermap.org/data/2.5/weather?zip={zip_code},IN&appid={OPENWEATHER_API_KEY}&units=metric"
-        res = requests.get(url, timeout=8)
+        res = _openweather_get("/data/2.5/weather", {"zip": f"{zip_code},IN", "units": "metric"})
         data = res.json()
         if str(data.get("cod")) == '200':
-            visibility = data.get("visibility", None)
-            if visibility:
-                visibility = visibility / 1000  # Convert from meters to kilometers
-            
-            return {
-                "temperature": data["main"]["temp"],
-                "description": data["weather"][0]["description"],
-                "humidity": data["main"]["humidity"],
-                "wind_speed": data["wind"]["speed"],
-                "pressure": data["main"].get("pressure", None),
-                "visibility": visibility,
-                "uv_index": data.get("uvi", None),
-                "wind_gust": data["wind"].get("gust", None)
-            }
+            return WeatherSnapshot.from_openweather(data), False
         else:
-            return None
+            return None, str(data.get("cod")) == '404'
     except Exception as e:
         print("Error fetching weather by ZIP:", str(e))
-        return None
+        return None, False
+
+@app.cli.command("geocode-import")
+@click.argument("csv_path")
+def geocode_import(csv_path):
+    """Seed the PIN code index from a CSV with pincode, latitude, longitude and name columns."""
+    def columns(row):
+        lowered = {k.strip().lower(): v for k, v in row.items() if k}
+        pin = lowered.get("pincode") or lowered.get("pin") or lowered.get("zip")
+        lat = lowered.get("latitude") or lowered.get("lat")
+        lon = lowered.get("longitude") or lowered.get("lon")
+        name = lowered.get("name") or lowered.get("officename") or lowered.get("district") or f"ZIP {pin}"
+        try:
+            return _normalize_zip(pin), float(lat), float(lon), name.strip()
+        except (TypeError, ValueError):
+            return None
+
+    seen = {}
+    with open(csv_path, newline="", encoding="utf-8") as fh:
+        for row in csv.DictReader(fh):
+            parsed = columns(row)
+            if parsed and parsed[0] not in seen:
+                seen[parsed[0]] = parsed
+    written = geocode_index.store_many(seen.values())
+    click.echo(f"Indexed {written} PIN codes into {geocode_index.path}")
 
 # --------------------------------------------
 
 if __name__ == "__main__":
-    # Use 0.0.0.0 for dev accessibility if needed. In production use a proper WSGI server.
-    app.run(debug=True, host='0.0.0.0', port=int(os.getenv('PORT', 5000)))
\ No newline at end of file
+    # Development server. In production run gunicorn with gunicorn.conf.py (see wsgi.py).
+    create_app().run(debug=True, host='0.0.0.0', port=int(os.getenv('PORT', 5000)))
\ No newline at end of file
@@ -0,0 +1,19 @@
+"""ASGI entry point for uvicorn or hypercorn: ``uvicorn asgi:app --workers 4``.
+
+AgriBuddy is a WSGI app, so requests run on asgiref's thread pool; prefer
+gunicorn with gthread workers (``gunicorn -c gunicorn.conf.py wsgi:app``)
+unless the deployment platform requires ASGI.
+"""
+import atexit
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    raise RuntimeError("Serving over ASGI needs asgiref: pip install asgiref uvicorn")
+
+from app import create_app, drain
+
+app = WsgiToAsgi(create_app())
+
+# uvicorn stops accepting connections and waits for open ones itself; flush background work last
+atexit.register(drain, 10.0)
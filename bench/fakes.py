@@ -0,0 +1,481 @@
+"""Local stand-ins for Supabase, Gemini and OpenWeather used by the benchmark.
+
+All three upstreams are served by one threaded HTTP server, routed by path:
+
+    /auth/v1/...                 Supabase auth (password sign-in, sign-up, logout)
+    /rest/v1/<table>             Supabase REST for profiles, conversations and messages
+    /v1beta/models/<m>:...       Gemini generateContent / streamGenerateContent / countTokens
+    /data/2.5/..., /geo/1.0/...  OpenWeather current weather, forecast and ZIP geocoding
+
+Every upstream gets its own latency (mean and jitter, in seconds) and error
+rate, so slow or flaky dependencies can be simulated independently. Writes to
+the REST tables are checked like the schema's row level security policies: a
+statement with any row the caller's access token does not own is rejected.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+
+# Access tokens are HS256 JWTs signed with this secret; run.py passes it to the app
+JWT_SECRET = "bench-jwt-secret-0123456789abcdef0123"
+
+
+class Upstream:
+    """Latency and error injection for one fake service."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def delay(self, scale=1.0):
+        seconds = max(0.0, random.gauss(self.latency, self.jitter)) * scale
+        if seconds:
+            time.sleep(seconds)
+
+    def should_fail(self):
+        failed = random.random() < self.error_rate
+        with self._lock:
+            self.calls += 1
+            self.errors += failed
+        return failed
+
+    def stats(self):
+        return {"calls": self.calls, "errors": self.errors}
+
+
+class FakeData:
+    """In-memory rows for the three Supabase tables the app uses."""
+
+    CITIES = [("Pune", "Maharashtra", 18.52, 73.85), ("Nashik", "Maharashtra", 19.99, 73.79),
+              ("Ludhiana", "Punjab", 30.90, 75.85), ("Guntur", "Andhra Pradesh", 16.30, 80.44),
+              ("Indore", "Madhya Pradesh", 22.72, 75.86), ("Coimbatore", "Tamil Nadu", 11.02, 76.96)]
+    SOILS = ["Black", "Alluvial", "Red", "Laterite", "Loamy"]
+    CROPS = ["wheat", "rice", "cotton", "soybean", "sugarcane", "onion", "tomato", "chickpea"]
+
+    def __init__(self, users=200, seed=7):
+        rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.users = {}  # email -> user id
+        self.tables = {"profiles": [], "conversations": [], "messages": []}
+        self.rls_rejections = 0
+        for i in range(users):
+            user_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            self.users[f"farmer{i}@example.com"] = user_id
+            city, state, _, _ = rng.choice(self.CITIES)
+            self.tables["profiles"].append({
+                "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                "user_id": user_id,
+                "full_name": f"Farmer {i}",
+                "state": state,
+                "city": city,
+                "region": city,
+                "crops": rng.sample(self.CROPS, 2),
+                "land_area": rng.randint(1, 40),
+                "land_unit": "acres",
+                "water_source": rng.choice(["Canal", "Borewell", "Rainfed"]),
+                "soil_type": rng.choice(self.SOILS),
+                "current_crops": rng.choice(self.CROPS),
+                "preferred_crops": rng.choice(self.CROPS),
+                "past_cultivation": rng.choice(self.CROPS),
+                "future_plans": "Try drip irrigation",
+                "preferred_language": "English",
+            })
+
+    def select(self, table, params):
+        rows = self.tables.get(table, [])
+        filters = [(k, v[0]) for k, v in params.items() if k not in ("select", "order", "limit", "offset", "or")]
+        keyset = params.get("or", [None])[0]
+        with self.lock:
+            matched = [row for row in rows if all(_matches(row.get(k), v) for k, v in filters)
+                       and (keyset is None or _matches_or(row, keyset))]
+        order = params.get("order", [None])[0]
+        if order:
+            # Stable sorts applied last key first give a multi-column order
+            for part in reversed(order.split(",")):
+                column, _, direction = part.partition(".")
+                matched.sort(key=lambda row: row.get(column) or "", reverse=direction.startswith("desc"))
+        limit = params.get("limit", [None])[0]
+        if limit:
+            matched = matched[:int(limit)]
+        columns = params.get("select", ["*"])[0]
+        if columns != "*":
+            wanted = [c.strip() for c in columns.split(",")]
+            matched = [{c: row.get(c) for c in wanted} for row in matched]
+        return matched
+
+    def owns(self, table, rows, user_id):
+        """Whether ``user_id`` may write every row, per supabase_schema.sql (auth.uid() = user_id)."""
+        if user_id is None:
+            return False
+        with self.lock:
+            if table == "messages":
+                owned = {row["id"] for row in self.tables["conversations"] if row.get("user_id") == user_id}
+                return all(row.get("conversation_id") in owned for row in rows)
+            existing = {row["id"]: row for row in self.tables.get(table, [])}
+            return all(row.get("user_id") == user_id
+                       and existing.get(row.get("id"), row).get("user_id") == user_id for row in rows)
+
+    def insert(self, table, rows, merge=False):
+        now = datetime.now(timezone.utc).isoformat()
+        stored = []
+        with self.lock:
+            existing = {row["id"]: row for row in self.tables.setdefault(table, [])} if merge else {}
+            for row in rows if isinstance(rows, list) else [rows]:
+                if row.get("id") in existing:
+                    existing[row["id"]].update(row)
+                    stored.append(existing[row["id"]])
+                    continue
+                row = dict(row)
+                row.setdefault("id", str(uuid.uuid4()))
+                row.setdefault("created_at", now)
+                if table == "conversations":
+                    row.setdefault("updated_at", now)
+                    row.setdefault("summary", "")
+                    row.setdefault("recent_turns", [])
+                self.tables[table].append(row)
+                stored.append(row)
+        return stored
+
+    def update(self, table, params, values):
+        filters = [(k, v[0]) for k, v in params.items() if k != "select"]
+        with self.lock:
+            matched = [row for row in self.tables.get(table, []) if all(_matches(row.get(k), v) for k, v in filters)]
+            for row in matched:
+                row.update(values)
+        return matched
+
+
+def _matches_or(row, expression):
+    """Evaluates the keyset filter the history API sends: (col.lt.X,and(col.eq.X,id.lt.Y))."""
+    terms = re.findall(r'(\w+)\.(eq|lt|gt)\.("[^"]*"|[^,()]+)', expression)
+    (column, op, value), tie, last = terms
+    first = _matches(row.get(column), f"{op}.{value.strip(chr(34))}")
+    rest = all(_matches(row.get(c), f"{o}.{v.strip(chr(34))}") for c, o, v in (tie, last))
+    return first or rest
+
+
+def _matches(value, expression):
+    op, _, operand = expression.partition(".")
+    if op == "eq":
+        return str(value) == operand
+    if op == "in":
+        return str(value) in operand.strip("()").split(",")
+    if op == "lt":
+        return value is not None and str(value) < operand
+    if op == "gt":
+        return value is not None and str(value) > operand
+    return True
+
+
+_ANSWERS = [
+    "For {crop} on {soil} soil, apply a split dose of nitrogen: half at sowing and half at first irrigation.",
+    "Watch for aphids on the underside of leaves; neem oil at 5 ml per litre is an effective first response.",
+    "Given the current humidity, delay irrigation by two days and check soil moisture at 10 cm depth.",
+    "Mulching between rows will cut evaporation and keep weeds down during the hot afternoons.",
+]
+
+# Same fields as the app's PEST_ANALYSIS_PROMPT asks for
+_DIAGNOSIS = {
+    "is_agricultural": True,
+    "is_relevant": True,
+    "identified_as": "Wheat leaf with insect colony",
+    "name": "Aphids",
+    "type": "Pest",
+    "description": "Small sap-sucking insects clustered on young leaves.",
+    "severity": "Medium",
+    "affected_crops": "Wheat, mustard, cotton",
+    "solutions": ["Spray neem oil (5 ml/L)", "Release ladybird beetles"],
+    "prevention": ["Avoid excess nitrogen", "Monitor weekly"],
+}
+
+
+def _gemini_text(body):
+    parts = [p for c in body.get("contents", []) for p in c.get("parts", [])]
+    if any("inlineData" in p or "inline_data" in p for p in parts):
+        return json.dumps(_DIAGNOSIS)
+    return " ".join(random.choice(_ANSWERS).format(crop=random.choice(FakeData.CROPS), soil="black")
+                    for _ in range(3))
+
+
+def _gemini_chunk(text, finished=False):
+    candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+    if finished:
+        candidate["finishReason"] = "STOP"
+    return {"candidates": [candidate], "usageMetadata": {"promptTokenCount": 50, "candidatesTokenCount": 40}}
+
+
+def _weather(name, lat, lon):
+    return {
+        "coord": {"lat": lat, "lon": lon},
+        "weather": [{"id": 802, "main": "Clouds", "description": "scattered clouds", "icon": "03d"}],
+        "main": {"temp": round(random.uniform(22, 36), 1), "feels_like": 31.0, "humidity": random.randint(30, 90),
+                 "pressure": 1008},
+        "wind": {"speed": round(random.uniform(0.5, 7), 1)},
+        "name": name,
+        "cod": 200,
+    }
+
+
+def _forecast(lat, lon):
+    start = int(time.time()) // 10800 * 10800
+    entries = []
+    for i in range(40):
+        entries.append({
+            "dt": start + i * 10800,
+            "main": {"temp": round(random.uniform(20, 36), 1), "temp_min": 20.0, "temp_max": 36.0,
+                     "humidity": random.randint(30, 90)},
+            "weather": [{"main": random.choice(["Clear", "Clouds", "Rain"]), "description": "forecast"}],
+            "wind": {"speed": 3.2},
+            "pop": round(random.random(), 2),
+        })
+    return {"cod": "200", "cnt": len(entries), "list": entries,
+            "city": {"name": "Fake", "coord": {"lat": lat, "lon": lon}, "timezone": 19800}}
+
+
+class FakeUpstreams:
+    """Runs the fake services on one local port in a background thread."""
+
+    def __init__(self, host="127.0.0.1", port=0, users=200, supabase=None, gemini=None, openweather=None,
+                 stream_chunks=6, token_ttl=3600):
+        self.data = FakeData(users)
+        self.token_ttl = token_ttl
+        self.refresh_tokens = {}  # refresh token -> (user id, email)
+        self.upstreams = {
+            "supabase": supabase or Upstream(),
+            "gemini": gemini or Upstream(),
+            "openweather": openweather or Upstream(),
+        }
+        self.stream_chunks = stream_chunks
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-upstreams", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        stats = {name: upstream.stats() for name, upstream in self.upstreams.items()}
+        stats["supabase"]["rls_rejections"] = self.data.rls_rejections
+        return stats
+
+
+def _make_handler(fakes):
+    data = fakes.data
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            return json.loads(raw) if raw else {}
+
+        def _json(self, payload, status=200):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _route(self, method):
+            parsed = urlparse(self.path)
+            path, params = parsed.path, parse_qs(parsed.query)
+            if path.startswith(("/auth/", "/rest/")):
+                name = "supabase"
+            elif path.startswith("/v1beta/"):
+                name = "gemini"
+            else:
+                name = "openweather"
+            upstream = fakes.upstreams[name]
+            body = self._body() if method in ("POST", "PATCH") else {}
+            if upstream.should_fail():
+                upstream.delay()
+                return self._json({"error": {"code": 503, "message": f"injected {name} failure"}}, 503)
+            if name == "supabase":
+                upstream.delay()
+                return self._supabase(method, path, params, body)
+            if name == "gemini":
+                return self._gemini(upstream, path, body)
+            upstream.delay()
+            return self._openweather(path, params)
+
+        def do_GET(self):
+            self._route("GET")
+
+        def do_POST(self):
+            self._route("POST")
+
+        def do_PATCH(self):
+            self._route("PATCH")
+
+        # ---------- Supabase ----------
+
+        def _supabase(self, method, path, params, body):
+            if path == "/auth/v1/token" and params.get("grant_type") == ["refresh_token"]:
+                # Refresh tokens are single use, as in Supabase
+                owner = fakes.refresh_tokens.pop(body.get("refresh_token"), None)
+                if not owner:
+                    return self._json({"error": "invalid_grant", "error_description": "Invalid Refresh Token"}, 400)
+                return self._json(self._session(*owner))
+            if path == "/auth/v1/token":
+                user_id = data.users.get(body.get("email"))
+                if not user_id:
+                    return self._json({"error": "invalid_grant", "error_description": "Invalid login credentials"}, 400)
+                return self._json(self._session(user_id, body["email"]))
+            if path == "/auth/v1/signup":
+                user_id = data.users.setdefault(body.get("email"), str(uuid.uuid4()))
+                return self._json(self._session(user_id, body.get("email"))["user"])
+            if path == "/auth/v1/logout":
+                self.send_response(204)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            match = re.match(r"^/rest/v1/(\w+)$", path)
+            if not match:
+                return self._json({"message": "not found"}, 404)
+            table = match.group(1)
+            if method == "GET":
+                return self._json(data.select(table, params))
+            rows = body if isinstance(body, list) else [body]
+            if method == "POST" and not data.owns(table, rows, self._auth_uid()):
+                with data.lock:
+                    data.rls_rejections += 1
+                return self._json({"code": "42501", "details": None, "hint": None,
+                                   "message": f'new row violates row-level security policy for table "{table}"'}, 403)
+            if method == "POST":
+                merge = "merge-duplicates" in (self.headers.get("Prefer") or "")
+                return self._json(data.insert(table, body, merge), 201)
+            return self._json(data.update(table, params, body))
+
+        def _auth_uid(self):
+            # The anon key is not a user token; only access tokens issued by the fake carry a sub
+            token = (self.headers.get("Authorization") or "").removeprefix("Bearer ")
+            try:
+                return jwt.decode(token, JWT_SECRET, algorithms=["HS256"], audience="authenticated")["sub"]
+            except jwt.PyJWTError:
+                return None
+
+        def _session(self, user_id, email):
+            session = _auth_session(user_id, email, fakes.token_ttl)
+            fakes.refresh_tokens[session["refresh_token"]] = (user_id, email)
+            return session
+
+        # ---------- Gemini ----------
+
+        def _gemini(self, upstream, path, body):
+            if path.endswith(":countTokens"):
+                upstream.delay(0.1)
+                return self._json({"totalTokens": 3})
+            text = _gemini_text(body)
+            if path.endswith(":generateContent"):
+                upstream.delay()
+                return self._json(_gemini_chunk(text, finished=True))
+            if not path.endswith(":streamGenerateContent"):
+                return self._json({"error": {"code": 404, "message": "unknown method"}}, 404)
+            # Time to first chunk is half the configured latency; the rest is spread over the chunks
+            words = text.split(" ")
+            count = max(1, min(fakes.stream_chunks, len(words)))
+            step = -(-len(words) // count)
+            pieces = [" ".join(words[i:i + step]) + " " for i in range(0, len(words), step)]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            upstream.delay(0.5)
+            self._write_chunk(b"[")
+            for i, piece in enumerate(pieces):
+                if i:
+                    upstream.delay(0.5 / len(pieces))
+                    self._write_chunk(b",\r\n")
+                self._write_chunk(json.dumps(_gemini_chunk(piece, finished=i == len(pieces) - 1)).encode())
+            self._write_chunk(b"]")
+            self.wfile.write(b"0\r\n\r\n")
+            return None
+
+        def _write_chunk(self, payload):
+            self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+            self.wfile.flush()
+
+        # ---------- OpenWeather ----------
+
+        def _openweather(self, path, params):
+            def first(name):
+                return params.get(name, [""])[0]
+
+            if path == "/geo/1.0/zip":
+                code = first("zip").split(",")[0]
+                if not code.isdigit():
+                    return self._json({"cod": "404", "message": "not found"}, 404)
+                city, _, lat, lon = FakeData.CITIES[int(code) % len(FakeData.CITIES)]
+                return self._json({"zip": code, "name": city, "lat": lat, "lon": lon, "country": "IN"})
+            if path == "/data/2.5/weather":
+                if first("q"):
+                    known = {c[0].lower(): c for c in FakeData.CITIES}
+                    city = known.get(first("q").lower())
+                    if not city:
+                        return self._json({"cod": "404", "message": "city not found"}, 404)
+                    return self._json(_weather(city[0], city[2], city[3]))
+                if first("zip"):
+                    city, _, lat, lon = FakeData.CITIES[int(first("zip").split(",")[0] or 0) % len(FakeData.CITIES)]
+                    return self._json(_weather(city, lat, lon))
+                return self._json(_weather("Fake", float(first("lat") or 0), float(first("lon") or 0)))
+            if path == "/data/2.5/forecast":
+                return self._json(_forecast(float(first("lat") or 18.5), float(first("lon") or 73.8)))
+            return self._json({"cod": "404", "message": "not found"}, 404)
+
+    return Handler
+
+
+def _auth_session(user_id, email, ttl):
+    now = datetime.now(timezone.utc).isoformat()
+    expires_at = int(time.time()) + ttl
+    user = {
+        "id": user_id,
+        "aud": "authenticated",
+        "role": "authenticated",
+        "email": email,
+        "email_confirmed_at": now,
+        "confirmed_at": now,
+        "created_at": now,
+        "updated_at": now,
+        "app_metadata": {"provider": "email"},
+        "user_metadata": {},
+    }
+    return {
+        "access_token": jwt.encode({"sub": user_id, "aud": "authenticated", "role": "authenticated",
+                                    "email": email, "exp": expires_at, "jti": uuid.uuid4().hex},
+                                   JWT_SECRET, algorithm="HS256"),
+        "token_type": "bearer",
+        "expires_in": ttl,
+        "expires_at": expires_at,
+        "refresh_token": uuid.uuid4().hex,
+        "user": user,
+    }
@@ -0,0 +1,126 @@
+"""Offline evaluation of the pest checker's image pre-filter.
+
+    python bench/prefilter_eval.py --plants photos/leaves --others images
+    python bench/prefilter_eval.py --plants photos/leaves --sweep
+
+Every file in the ``--plants`` folders should be accepted and every file in the
+``--others`` folders (default: the repository's ``images/``, which are app
+screenshots and graphics) rejected. Images go through the same ``prepare_image``
+path as uploads. The report lists each verdict with its score and timing, then
+how many model calls the filter would save and how many crop photos it would
+wrongly turn away. ``--sweep`` repeats the count over a range of thresholds.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, ROOT]
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+def _files(folders):
+    for folder in folders:
+        for name in sorted(os.listdir(folder)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(folder, name)
+
+
+def screen_all(agribuddy, labelled):
+    rows = []
+    for path, is_plant in labelled:
+        with open(path, "rb") as f:
+            prepared = agribuddy.prepare_image(f.read())
+        screening = prepared.screening
+        rows.append({
+            "file": os.path.relpath(path, ROOT) if path.startswith(ROOT) else path,
+            "plant": is_plant,
+            "score": screening.score,
+            "sharpness": screening.sharpness,
+            "brightness": screening.brightness,
+            "reasons": screening.reasons,
+            "passed": screening.passed,
+            "ms": screening.elapsed_ms,
+            "features": screening.features,
+        })
+    return rows
+
+
+def confusion(rows, threshold=None, min_sharpness=None):
+    """Counts for the recorded verdicts, or re-decided at another threshold."""
+    counts = {"plants_accepted": 0, "plants_rejected": 0, "others_rejected": 0, "others_accepted": 0}
+    for row in rows:
+        passed = row["passed"]
+        if threshold is not None:
+            unusable = any(r in ("too_dark", "overexposed") for r in row["reasons"])
+            blurry = row["sharpness"] < (min_sharpness if min_sharpness is not None else 0)
+            passed = row["score"] >= threshold and not unusable and not blurry
+        if row["plant"]:
+            counts["plants_accepted" if passed else "plants_rejected"] += 1
+        else:
+            counts["others_rejected" if not passed else "others_accepted"] += 1
+    return counts
+
+
+def print_report(rows, counts):
+    print(f"{'file':48} {'label':6} {'score':>6} {'sharp':>7} {'ms':>6}  verdict")
+    print("-" * 96)
+    for row in rows:
+        verdict = "accept" if row["passed"] else "reject (" + ", ".join(row["reasons"]) + ")"
+        label = "plant" if row["plant"] else "other"
+        print(f"{row['file'][-48:]:48} {label:6} {row['score']:6.3f} {row['sharpness']:7.1f} {row['ms']:6.2f}  {verdict}")
+    timings = sorted(row["ms"] for row in rows)
+    others = counts["others_rejected"] + counts["others_accepted"]
+    plants = counts["plants_accepted"] + counts["plants_rejected"]
+    print()
+    print(f"screening time: mean {sum(timings) / len(timings):.2f} ms, max {timings[-1]:.2f} ms")
+    if others:
+        print(f"non-plant images rejected (model calls saved): {counts['others_rejected']}/{others}")
+    if plants:
+        print(f"crop photos wrongly rejected: {counts['plants_rejected']}/{plants}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--plants", action="append", default=[], help="folder of photos that should pass")
+    parser.add_argument("--others", action="append", help="folder of images that should be rejected")
+    parser.add_argument("--threshold", type=float, help="PREFILTER_THRESHOLD for this run")
+    parser.add_argument("--min-sharpness", type=float, help="PREFILTER_MIN_SHARPNESS for this run")
+    parser.add_argument("--sweep", action="store_true", help="also count verdicts over a range of thresholds")
+    parser.add_argument("--json", help="write per-image results to this file")
+    args = parser.parse_args(argv)
+
+    # Configure before the app reads its environment
+    os.environ["PREFILTER_MODE"] = "reject"
+    if args.threshold is not None:
+        os.environ["PREFILTER_THRESHOLD"] = str(args.threshold)
+    if args.min_sharpness is not None:
+        os.environ["PREFILTER_MIN_SHARPNESS"] = str(args.min_sharpness)
+    import app as agribuddy
+
+    others = args.others or [os.path.join(ROOT, "images")]
+    labelled = [(path, True) for path in _files(args.plants)] + [(path, False) for path in _files(others)]
+    if not labelled:
+        parser.error("no images found")
+    rows = screen_all(agribuddy, labelled)
+    print_report(rows, confusion(rows))
+
+    if args.sweep:
+        print()
+        print(f"{'threshold':>9} {'others rejected':>16} {'plants rejected':>16}")
+        for step in range(1, 11):
+            threshold = step * 0.05
+            counts = confusion(rows, threshold, agribuddy.PREFILTER_MIN_SHARPNESS)
+            print(f"{threshold:9.2f} {counts['others_rejected']:16} {counts['plants_rejected']:16}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+"""Offline load test: runs the Flask app against the local fakes and reports per-route latency.
+
+    python bench/run.py --users 20 --duration 30
+    python bench/run.py --gemini-latency 1.5 --openweather-error-rate 0.2 --json out.json
+    python bench/run.py --compare baseline.json --max-regression 0.15
+
+Each virtual user logs in once and then loops over a weighted mix of chat,
+streaming chat, weather and pest-checker requests with a short think time.
+Results (RPS, error count and p50/p95/p99 in ms per route) are printed as a
+table; ``--compare`` exits non-zero when p95 latency or throughput of any
+route regressed by more than ``--max-regression`` against an earlier run.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, ROOT]
+
+from fakes import JWT_SECRET, FakeUpstreams, Upstream  # noqa: E402
+
+QUESTIONS = [
+    "When should I irrigate my wheat this week?",
+    "How much urea per acre for cotton at flowering?",
+    "What is the best time to sow soybean in black soil?",
+    "My tomato leaves are curling, what should I do?",
+    "Which fungicide works for rice blast?",
+    "Is it safe to spray pesticide before rain?",
+    "How do I improve organic matter in red soil?",
+    "What intercrop suits sugarcane in the first three months?",
+]
+CITIES = ["Pune", "Nashik", "Ludhiana", "Guntur", "Indore", "Coimbatore"]
+ZIPS = ["411001", "422001", "141001", "522001", "452001", "641001"]
+
+DEFAULT_MIX = "chat=4,chat_stream=3,weather=5,pest=1"
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.ttft = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, ok, ttft=None):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            if ttft is not None:
+                self.ttft[route].append(ttft)
+            if not ok:
+                self.errors[route] += 1
+
+    def summary(self, elapsed):
+        report = {}
+        for route in sorted(self.latencies):
+            samples = sorted(self.latencies[route])
+            row = {
+                "requests": len(samples),
+                "errors": self.errors[route],
+                "rps": round(len(samples) / elapsed, 2),
+                "p50_ms": _percentile(samples, 50),
+                "p95_ms": _percentile(samples, 95),
+                "p99_ms": _percentile(samples, 99),
+            }
+            if self.ttft[route]:
+                row["ttft_p50_ms"] = _percentile(sorted(self.ttft[route]), 50)
+                row["ttft_p95_ms"] = _percentile(sorted(self.ttft[route]), 95)
+            report[route] = row
+        return report
+
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(pct / 100.0 * len(ordered)) - 1))
+    return round(ordered[index] * 1000, 1)
+
+
+def _parse_mix(spec):
+    weights = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    unknown = set(weights) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f"Unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return weights
+
+
+# ---------- OPERATIONS ----------
+
+def op_chat(http, base, rng, images):
+    res = http.post(f"{base}/chat", json={"message": rng.choice(QUESTIONS)}, timeout=60)
+    return "POST /chat", res.ok and "reply" in res.json(), None
+
+
+def op_chat_stream(http, base, rng, images):
+    started = time.perf_counter()
+    ttft = None
+    ok = False
+    with http.post(f"{base}/chat/stream", json={"message": rng.choice(QUESTIONS)}, stream=True, timeout=60) as res:
+        for line in res.iter_lines():
+            if line.startswith(b"data:") and ttft is None:
+                ttft = time.perf_counter() - started
+            if line.startswith(b"event: done"):
+                ok = res.ok
+    return "POST /chat/stream", ok, ttft
+
+
+def op_weather(http, base, rng, images):
+    if rng.random() < 0.5:
+        res = http.get(f"{base}/weather", params={"city": rng.choice(CITIES)}, timeout=30)
+    else:
+        res = http.get(f"{base}/weather", params={"zip": rng.choice(ZIPS)}, timeout=30)
+    return "GET /weather", res.ok, None
+
+
+def op_pest(http, base, rng, images):
+    name, payload = rng.choice(images)
+    res = http.post(f"{base}/pest-checker", files={"image": (name, payload, "image/jpeg")}, timeout=120)
+    body = res.json() if res.ok else {}
+    return "POST /pest-checker", bool(body.get("name")) and isinstance(body.get("solutions"), list), None
+
+
+OPERATIONS = {
+    "chat": op_chat,
+    "chat_stream": op_chat_stream,
+    "weather": op_weather,
+    "pest": op_pest,
+}
+
+
+def _load_images(limit=20):
+    folder = os.path.join(ROOT, "images")
+    names = sorted(n for n in os.listdir(folder) if n.lower().endswith((".jpg", ".jpeg", ".png")))[:limit]
+    images = []
+    for name in names:
+        with open(os.path.join(folder, name), "rb") as f:
+            images.append((name, f.read()))
+    return images
+
+
+def virtual_user(index, base, phases, weights, think, images, seed):
+    """``phases`` is a list of ``(deadline, results)``; warm-up requests go to a discarded Results."""
+    rng = random.Random(seed + index)
+    http = requests.Session()
+    res = http.post(f"{base}/login", data={"email": f"farmer{index}@example.com", "password": "bench"},
+                    allow_redirects=False, timeout=30)
+    if res.status_code != 302:
+        phases[-1][1].record("POST /login", 0.0, False)
+        return
+    names = list(weights)
+    totals = [weights[n] for n in names]
+    for deadline, results in phases:
+        while time.time() < deadline:
+            op = OPERATIONS[rng.choices(names, totals)[0]]
+            started = time.perf_counter()
+            try:
+                route, ok, ttft = op(http, base, rng, images)
+            except Exception as e:
+                route, ok, ttft = op.__name__.replace("op_", "op "), False, None
+                print(f"user {index}: {type(e).__name__}: {e}", file=sys.stderr)
+            results.record(route, time.perf_counter() - started, ok, ttft)
+            if think:
+                time.sleep(rng.expovariate(1.0 / think))
+
+
+def configure_environment(fakes_url, args):
+    """Point the app at the fakes; must run before ``app`` is imported."""
+    os.environ.update({
+        "NEXT_PUBLIC_SUPABASE_URL": fakes_url,
+        # supabase-py only checks that the key is JWT shaped
+        "NEXT_PUBLIC_SUPABASE_ANON_KEY": "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.bench",
+        "SUPABASE_JWT_SECRET": JWT_SECRET,
+        "GEMINI_API_KEY": "bench",
+        "GEMINI_API_ENDPOINT": fakes_url,
+        "OPENWEATHER_API_KEY": "bench",
+        "OPENWEATHER_BASE_URL": fakes_url,
+        "FLASK_SECRET_KEY": "bench",
+        "GEOCODE_INDEX_PATH": args.geocode_index,
+    })
+    # The fake Gemini has no quota; admission limits stay tunable from the shell
+    os.environ.setdefault("GEMINI_RPM", "60000")
+    os.environ.setdefault("GEMINI_BURST", "1000")
+    # The sample uploads are app screenshots; keep them on the vision path, just flagged
+    os.environ.setdefault("PREFILTER_MODE", "flag")
+    if args.cold_caches:
+        for name in ("WEATHER_CACHE_TTL", "PROFILE_CACHE_TTL", "FORECAST_CACHE_TTL", "DIAGNOSIS_CACHE_TTL"):
+            os.environ[name] = "0"
+        os.environ["WEATHER_REFRESH_INTERVAL"] = "0"
+
+
+def start_app(port, verbose=False):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    import app as agribuddy
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            if verbose:
+                super().log_request(*args, **kwargs)
+
+    server = make_server("127.0.0.1", port, agribuddy.create_app(), threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="bench-app", daemon=True).start()
+    return agribuddy, server, f"http://127.0.0.1:{server.server_port}"
+
+
+def compare(report, baseline, max_regression):
+    failures = []
+    for route, row in report.items():
+        before = baseline.get(route)
+        if not before:
+            continue
+        if before.get("p95_ms") and row["p95_ms"] and row["p95_ms"] > before["p95_ms"] * (1 + max_regression):
+            failures.append(f"{route}: p95 {before['p95_ms']} -> {row['p95_ms']} ms")
+        if before.get("rps") and row["rps"] < before["rps"] * (1 - max_regression):
+            failures.append(f"{route}: rps {before['rps']} -> {row['rps']}")
+    return failures
+
+
+def print_table(report):
+    header = f"{'route':<22}{'reqs':>7}{'errs':>6}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'ttft p50':>10}"
+    print(header)
+    print("-" * len(header))
+    for route, row in report.items():
+        print(f"{route:<22}{row['requests']:>7}{row['errors']:>6}{row['rps']:>8}"
+              f"{row['p50_ms'] or '-':>9}{row['p95_ms'] or '-':>9}{row['p99_ms'] or '-':>9}"
+              f"{row.get('ttft_p50_ms') or '-':>10}")
+
+
+def _run_load(args, fakes, weights, images):
+    agribuddy, server, base = start_app(args.port, args.verbose)
+    warm = Results()
+    results = Results()
+    started = time.time()
+    threads = []
+    phases = [(started + args.warmup, warm), (started + args.warmup + args.duration, results)]
+    for i in range(args.users):
+        thread = threading.Thread(target=virtual_user, args=(i, base, phases, weights, args.think, images, args.seed),
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return max(time.time() - started - args.warmup, 1e-6), results, agribuddy, server
+
+
+def _report(args, fakes, elapsed, results):
+    report = results.summary(elapsed)
+    print_table(report)
+    print(f"\nupstream calls: {json.dumps(fakes.stats())}")
+    fakes.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"routes": report, "args": vars(args)}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            failures = compare(report, json.load(f)["routes"], args.max_regression)
+        if failures:
+            print("\nRegressions:\n  " + "\n  ".join(failures))
+            return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load after warm-up")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load excluded from the report")
+    parser.add_argument("--think", type=float, default=0.2, help="mean think time between requests (s)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=0, help="port for the app (default: any free port)")
+    parser.add_argument("--cold-caches", action="store_true", help="disable app caches and prefetching")
+    parser.add_argument("--geocode-index", default=":memory:", help="GEOCODE_INDEX_PATH for the run")
+    for name, latency in (("supabase", 0.03), ("gemini", 0.8), ("openweather", 0.12)):
+        parser.add_argument(f"--{name}-latency", type=float, default=latency, help="mean seconds per call")
+        parser.add_argument(f"--{name}-jitter", type=float, default=latency / 4, help="std dev in seconds")
+        parser.add_argument(f"--{name}-error-rate", type=float, default=0.0, help="fraction of calls failing")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's request and stage logging")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--compare", help="earlier --json report to regression-test against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed slowdown fraction")
+    args = parser.parse_args(argv)
+
+    upstreams = {
+        name: Upstream(getattr(args, f"{name}_latency"), getattr(args, f"{name}_jitter"),
+                       getattr(args, f"{name}_error_rate"))
+        for name in ("supabase", "gemini", "openweather")
+    }
+    weights = _parse_mix(args.mix)
+    images = _load_images()
+    fakes = FakeUpstreams(users=max(args.users, 1), **upstreams).start()
+    configure_environment(fakes.url, args)
+    with contextlib.ExitStack() as quiet:
+        if not args.verbose:
+            # The app logs every chat turn with print(); keep the report readable
+            quiet.enter_context(contextlib.redirect_stdout(open(os.devnull, "w")))
+        elapsed, results, agribuddy, server = _run_load(args, fakes, weights, images)
+        server.shutdown()
+        agribuddy.message_writer.flush()
+    return _report(args, fakes, elapsed, results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""Cold-start benchmark: import time and time to first response of a fresh app process.
+
+    python bench/startup.py --runs 5
+    python bench/startup.py --client-warmup lazy,background,eager
+    python bench/startup.py --json startup.json
+    python bench/startup.py --compare startup.json --max-regression 0.25
+
+Every run spawns a new Python process that imports ``app`` and serves it
+against the local fakes, so nothing is shared with earlier runs except the
+OS file cache. Per ``CLIENT_WARMUP`` mode the report gives the median, min
+and max in ms of:
+
+    import        ``import app`` inside the child
+    first_page    spawn -> first 200 from GET /login (interpreter start included)
+    first_chat    that response -> first POST /chat reply after logging in,
+                  i.e. what the first user waits for the Supabase and Gemini clients
+
+``--compare`` exits non-zero when a median regressed by more than
+``--max-regression`` against an earlier ``--json`` report.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import types
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, ROOT]
+
+# requests and the fakes are imported where they are used, so the child's
+# import time still includes everything the app pulls in
+
+METRICS = ("import", "first_page", "first_chat")
+READY_PREFIX = "STARTUP "
+
+
+def serve():
+    """Child side: import and serve the app, then report the import time and port on stdout."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    out = sys.stdout
+    # The app logs with print(); nobody reads the pipe after the ready line
+    sys.stdout = open(os.devnull, "w")
+    started = time.perf_counter()
+    import app as agribuddy
+    import_ms = (time.perf_counter() - started) * 1000
+    server = make_server("127.0.0.1", 0, agribuddy.create_app(), threaded=True, request_handler=QuietHandler)
+    out.write(READY_PREFIX + json.dumps({"import_ms": import_ms, "port": server.server_port}) + "\n")
+    out.flush()
+    server.serve_forever()
+
+
+def _wait_ok(http, method, url, deadline, **kwargs):
+    import requests
+
+    while True:
+        try:
+            res = http.request(method, url, timeout=30, **kwargs)
+            if res.status_code < 400:
+                return res
+        except requests.ConnectionError:
+            pass
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"{method} {url} did not succeed in time")
+        time.sleep(0.005)
+
+
+def measure(mode, timeout):
+    """One cold start; returns ms per metric."""
+    import requests
+
+    env = dict(os.environ, CLIENT_WARMUP=mode)
+    spawned = time.perf_counter()
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve"], env=env,
+                             stdout=subprocess.PIPE, text=True)
+    try:
+        line = child.stdout.readline()
+        if not line.startswith(READY_PREFIX):
+            raise RuntimeError(f"app process exited before serving (status {child.poll()})")
+        ready = json.loads(line[len(READY_PREFIX):])
+        base = f"http://127.0.0.1:{ready['port']}"
+        deadline = spawned + timeout
+        http = requests.Session()
+        _wait_ok(http, "GET", f"{base}/login", deadline)
+        first_page = time.perf_counter()
+        http.post(f"{base}/login", data={"email": "farmer0@example.com", "password": "bench"},
+                  allow_redirects=False, timeout=30)
+        res = _wait_ok(http, "POST", f"{base}/chat", deadline, json={"message": "When should I irrigate my wheat?"})
+        if "reply" not in res.json():
+            raise RuntimeError("first /chat returned no reply")
+        first_chat = time.perf_counter()
+    finally:
+        child.terminate()
+        child.wait(timeout=10)
+    return {
+        "import": ready["import_ms"],
+        "first_page": (first_page - spawned) * 1000,
+        "first_chat": (first_chat - first_page) * 1000,
+    }
+
+
+def summarize(samples):
+    return {
+        metric: {
+            "median_ms": round(statistics.median(s[metric] for s in samples), 1),
+            "min_ms": round(min(s[metric] for s in samples), 1),
+            "max_ms": round(max(s[metric] for s in samples), 1),
+        }
+        for metric in METRICS
+    }
+
+
+def compare(report, baseline, max_regression):
+    failures = []
+    for mode, rows in report.items():
+        for metric, row in rows.items():
+            before = baseline.get(mode, {}).get(metric)
+            if before and row["median_ms"] > before["median_ms"] * (1 + max_regression):
+                failures.append(f"{mode} {metric}: median {before['median_ms']} -> {row['median_ms']} ms")
+    return failures
+
+
+def print_table(report):
+    header = f"{'warm-up':<12}{'metric':<12}{'median':>9}{'min':>9}{'max':>9}"
+    print(header)
+    print("-" * len(header))
+    for mode, rows in report.items():
+        for metric, row in rows.items():
+            print(f"{mode:<12}{metric:<12}{row['median_ms']:>9}{row['min_ms']:>9}{row['max_ms']:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per warm-up mode")
+    parser.add_argument("--client-warmup", default=os.getenv("CLIENT_WARMUP", "background"),
+                        help="comma-separated CLIENT_WARMUP modes to measure (lazy, background, eager)")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds allowed per cold start")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--compare", help="earlier --json report to regression-test against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed slowdown fraction")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        return serve()
+
+    from fakes import FakeUpstreams
+    from run import configure_environment
+
+    fakes = FakeUpstreams(users=1).start()
+    configure_environment(fakes.url, types.SimpleNamespace(geocode_index=":memory:", cold_caches=False))
+    report = {}
+    try:
+        for mode in [m.strip() for m in args.client_warmup.split(",") if m.strip()]:
+            report[mode] = summarize([measure(mode, args.timeout) for _ in range(args.runs)])
+    finally:
+        fakes.stop()
+    print_table(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"modes": report, "args": vars(args)}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            failures = compare(report, json.load(f)["modes"], args.max_regression)
+        if failures:
+            print("\nRegressions:\n  " + "\n  ".join(failures))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+"""gunicorn settings for AgriBuddy: ``gunicorn -c gunicorn.conf.py wsgi:app``.
+
+Requests spend most of their time waiting on Gemini, Supabase and
+OpenWeather, so the default is a few processes with many threads each
+(gthread). Every setting can be overridden from the environment.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', 5000)}")
+
+# One process per core is enough for the CPU work (image resizing, JSON); threads cover the waiting
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 32))  # concurrent requests per worker (gthread)
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 1000))  # gevent / eventlet only
+
+# Chat answers stream for a while and pest diagnoses can take tens of seconds
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 60))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Recycle workers now and then to cap memory growth (0 = never)
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 100))
+
+# Clients are created per worker (see app.create_app), so there is nothing to gain from preloading
+preload_app = False
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")
+errorlog = "-"
+
+# Each chat request fans out up to three lookups; size the shared I/O pool to the thread count
+os.environ.setdefault("IO_POOL_WORKERS", str(threads * 3))
+
+
+def worker_exit(server, worker):
+    # In-flight requests are done by now; flush conversation summaries and queued chat rows
+    from app import drain
+
+    drain(timeout=graceful_timeout)
@@ -42,7 +42,9 @@ CREATE TABLE public.conversations (
   created_at timestamp with time zone NOT NULL DEFAULT now(),
   updated_at timestamp with time zone NOT NULL DEFAULT now(),
   title text NOT NULL DEFAULT 'New Chat'::text,
-  user_id uuid NOT NULL
+  user_id uuid NOT NULL,
+  summary text NOT NULL DEFAULT '',
+  recent_turns jsonb NOT NULL DEFAULT '[]'::jsonb
 );
 
 
@@ -234,20 +236,12 @@ CREATE TRIGGER update_profiles_updated_at
 -- ============================================
 
 
-CREATE INDEX IF NOT EXISTS idx_messages_conversation_id 
-  ON public.messages(conversation_id);
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_created 
+  ON public.messages(conversation_id, created_at DESC, id DESC);
 
 
-CREATE INDEX IF NOT EXISTS idx_messages_created_at 
-  ON public.messages(created_at);
-
-
-CREATE INDEX IF NOT EXISTS idx_conversations_user_id 
-  ON public.conversations(user_id);
-
-
-CREATE INDEX IF NOT EXISTS idx_conversations_updated_at 
-  ON public.conversations(updated_at DESC);
+CREATE INDEX IF NOT EXISTS idx_conversations_user_updated 
+  ON public.conversations(user_id, updated_at DESC, id DESC);
 
 
 CREATE INDEX IF NOT EXISTS idx_profiles_user_id 
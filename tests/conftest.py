@@ -0,0 +1,41 @@
+"""Shared setup: the app reads its configuration at import, so point it at the
+bench fakes before any test module imports ``app``."""
+
+import os
+import sys
+import tempfile
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "bench"), ROOT]
+
+import pytest  # noqa: E402
+from fakes import FakeUpstreams  # noqa: E402
+from run import configure_environment  # noqa: E402
+
+fakes = FakeUpstreams(users=10).start()
+configure_environment(fakes.url, types.SimpleNamespace(geocode_index=":memory:", cold_caches=False))
+os.environ.setdefault("CLIENT_WARMUP", "lazy")
+os.environ.setdefault("SESSION_STORE_PATH", os.path.join(tempfile.mkdtemp(prefix="agribuddy-tests-"), "sessions.sqlite3"))
+
+
+def pytest_unconfigure(config):
+    fakes.stop()
+
+
+@pytest.fixture(scope="session")
+def upstreams():
+    return fakes
+
+
+@pytest.fixture
+def login():
+    """Returns a test client logged in (through the fake Supabase auth) as ``farmer<index>``."""
+    import app as agribuddy
+
+    def login_as(index):
+        client = agribuddy.app.test_client()
+        res = client.post("/login", data={"email": f"farmer{index}@example.com", "password": "bench"})
+        assert res.status_code == 302, res.get_data(as_text=True)
+        return client
+    return login_as
@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+
+import app as agribuddy
+from app import AdmissionController, Overloaded, SingleFlight, TokenBucket
+
+
+def controller(rate=1000.0, capacity=1000, max_concurrent=1, per_user=2, queue_size=4, queue_timeout=1.0):
+    return AdmissionController(TokenBucket(rate, capacity), max_concurrent=max_concurrent, per_user=per_user,
+                               queue_size=queue_size, queue_timeout=queue_timeout)
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached in time"
+        time.sleep(0.005)
+
+
+def test_queue_admits_waiters_in_arrival_order():
+    gate = controller(max_concurrent=1, per_user=10)
+    gate.acquire("holder")
+    order = []
+
+    def worker(name):
+        gate.acquire(name, timeout=5)
+        order.append(name)
+        gate.release(name)
+
+    threads = []
+    for name in ("a", "b", "c"):
+        t = threading.Thread(target=worker, args=(name,))
+        t.start()
+        threads.append(t)
+        wait_for(lambda: gate.stats()["queued"] == len(threads))
+    gate.release("holder")
+    for t in threads:
+        t.join(5)
+    assert order == ["a", "b", "c"]
+    assert gate.stats()["in_flight"] == 0
+    assert gate.stats()["users_active"] == 0
+
+
+def test_queue_timeout_forgets_the_user():
+    gate = controller(max_concurrent=1)
+    gate.acquire("holder")
+    with pytest.raises(Overloaded) as err:
+        gate.acquire("farmer", timeout=0.05)
+    assert err.value.reason == "queue_timeout"
+    assert gate.stats()["queued"] == 0
+    assert gate.stats()["users_active"] == 1
+    gate.release("holder")
+    assert gate.stats()["users_active"] == 0
+
+
+def test_queue_full_rejects_at_once():
+    gate = controller(max_concurrent=1, queue_size=0)
+    gate.acquire()
+    started = time.monotonic()
+    with pytest.raises(Overloaded) as err:
+        gate.acquire("farmer")
+    assert err.value.reason == "queue_full"
+    assert time.monotonic() - started < 0.5
+    assert gate.stats()["users_active"] == 0
+
+
+def test_per_user_limit_is_429_and_leaves_others_alone():
+    gate = controller(max_concurrent=4, per_user=1)
+    gate.acquire("farmer")
+    with pytest.raises(Overloaded) as err:
+        gate.acquire("farmer")
+    assert (err.value.reason, err.value.status) == ("user_limit", 429)
+    gate.acquire("neighbour")
+    gate.release("neighbour")
+    gate.release("farmer")
+    assert gate.stats()["users_active"] == 0
+
+
+def test_rate_limited_releases_the_slot():
+    gate = controller(rate=0.01, capacity=1, max_concurrent=2)
+    with gate.slot("farmer"):
+        pass
+    with pytest.raises(Overloaded) as err:
+        gate.acquire("farmer", timeout=0.05)
+    assert err.value.reason == "rate_limited"
+    stats = gate.stats()
+    assert stats["in_flight"] == 0
+    assert stats["users_active"] == 0
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(rate=50.0, capacity=2)
+    assert bucket.try_acquire() and bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert 0 < bucket.wait_time() <= 0.02
+    assert bucket.acquire(timeout=0.5)
+    assert not TokenBucket(rate=0.01, capacity=1).acquire(tokens=2, timeout=0.05)
+
+
+def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def slow():
+        calls.append(1)
+        release.wait(5)
+        return "answer"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", slow))) for _ in range(3)]
+    threads[0].start()
+    wait_for(lambda: calls)
+    for t in threads[1:]:
+        t.start()
+    wait_for(lambda: flight.coalesced == 2)
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert results == ["answer"] * 3
+    assert len(calls) == 1
+
+
+def test_single_flight_shares_errors_and_forgets_the_key():
+    flight = SingleFlight()
+
+    def boom():
+        raise ValueError("upstream")
+
+    with pytest.raises(ValueError):
+        flight.do("k", boom)
+    assert flight.do("k", lambda: "fresh") == "fresh"
+
+
+def test_chat_goes_through_the_module_gate(login, monkeypatch):
+    gate = agribuddy.gemini_admission
+    monkeypatch.setattr(gate, "queue_size", 0)
+    for _ in range(gate.max_concurrent):
+        gate.acquire()
+    try:
+        res = login(8).post("/chat", json={"message": "Is it safe to spray urea before rain?"})
+    finally:
+        for _ in range(gate.max_concurrent):
+            gate.release()
+    assert res.status_code == 503
+    assert res.get_json()["reason"] == "queue_full"
+    assert int(res.headers["Retry-After"]) >= 1
+    assert gate.stats()["in_flight"] == 0
@@ -0,0 +1,33 @@
+import time
+
+import jwt
+from fakes import JWT_SECRET
+
+from app import AuthSessions, RefreshTokenStore
+
+
+def sessions(upstreams, tmp_path, secret):
+    return AuthSessions(upstreams.url, "anon", secret, refresh_margin=120, jwks_ttl=3600, pool_size=10,
+                        token_store=RefreshTokenStore(str(tmp_path / "sessions.sqlite3"), 3600))
+
+
+def token(user_id, ttl=3600, secret=JWT_SECRET):
+    return jwt.encode({"sub": user_id, "aud": "authenticated", "exp": int(time.time()) + ttl}, secret, algorithm="HS256")
+
+
+def test_verified_claims_are_cached_until_expiry(upstreams, tmp_path):
+    auth = sessions(upstreams, tmp_path, JWT_SECRET)
+    access = token("farmer")
+    assert auth.verify(access)["sub"] == "farmer"
+    assert auth._claims.ttl_remaining(access) > 3000
+    assert auth.stats_counts["verified"] == 1
+
+
+def test_hs256_without_secret_warns_once_and_caches_briefly(upstreams, tmp_path, capsys):
+    auth = sessions(upstreams, tmp_path, None)
+    first, second = token("farmer"), token("neighbour", secret="some-other-secret-0123456789abcdef")
+    assert auth.verify(first)["sub"] == "farmer"
+    assert auth.verify(second)["sub"] == "neighbour"
+    assert capsys.readouterr().out.count("SUPABASE_JWT_SECRET is not set") == 1
+    assert auth.stats_counts["unverified"] == 2
+    assert 0 < auth._claims.ttl_remaining(first) <= AuthSessions.UNVERIFIED_TTL
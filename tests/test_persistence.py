@@ -0,0 +1,93 @@
+import time
+
+from postgrest.exceptions import APIError
+
+import app as agribuddy
+from app import ConversationMemory, WriteBehindQueue
+
+MISSING_COLUMN = {"code": "PGRST204", "message": "Could not find the 'summary' column of 'conversations' in the schema cache"}
+
+
+class Table:
+    def __init__(self, db, name):
+        self.db, self.name = db, name
+
+    def __getattr__(self, method):
+        def step(*args, **kwargs):
+            self.db.calls.append((self.name, method))
+            return self
+        return step
+
+    def execute(self):
+        self.db.executed += 1
+        if self.db.errors:
+            raise self.db.errors.pop(0)
+        return type("Result", (), {"data": []})()
+
+
+class Database:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+        self.executed = 0
+
+    def table(self, name):
+        return Table(self, name)
+
+
+def test_writer_drops_permanent_errors_without_retrying(monkeypatch):
+    db = Database(APIError(MISSING_COLUMN))
+    monkeypatch.setattr(agribuddy, "user_db", lambda user_id: db)
+    writer = WriteBehindQueue(batch_size=10, flush_interval=0.01, max_retries=5)
+    writer._ensure_started = lambda: None
+    writer.enqueue("farmer", "conversations", {"id": "c1", "summary": ""}, upsert=True)
+    started = time.monotonic()
+    writer.flush()
+    assert time.monotonic() - started < 0.1
+    assert db.executed == 1
+    assert writer.stats_counts["dropped"] == 1
+    assert writer.stats_counts["retries"] == 0
+
+
+def test_writer_retries_transient_errors(monkeypatch):
+    db = Database(APIError({"code": "PGRST002", "message": "Could not query the database"}))
+    monkeypatch.setattr(agribuddy, "user_db", lambda user_id: db)
+    writer = WriteBehindQueue(batch_size=10, flush_interval=0.01, max_retries=2)
+    writer._ensure_started = lambda: None
+    writer.enqueue("farmer", "messages", {"id": "m1"})
+    writer.flush()
+    assert db.executed == 2
+    assert writer.stats_counts["written"] == 1
+    assert writer.stats_counts["retries"] == 1
+
+
+def test_memory_stops_persisting_when_columns_are_missing(monkeypatch):
+    db = Database(APIError(MISSING_COLUMN))
+    queued = []
+    monkeypatch.setattr(agribuddy, "user_db", lambda user_id: db)
+    monkeypatch.setattr(agribuddy.message_writer, "enqueue", lambda *args, **kwargs: queued.append(args))
+    memory = ConversationMemory(window=4, summarize_every=2, turn_chars=200, summary_chars=400, maxsize=10)
+    state = {"summary": "", "turns": [{"user": "q", "assistant": "a"}], "summarizing": False}
+
+    memory._persist("c1", "farmer", state)
+    memory._persist("c2", "farmer", state)
+    assert not memory.persistent
+    assert queued == []
+    assert db.executed == 1  # probed once per process, not once per turn
+    memory.close()
+
+
+def test_memory_probe_passes_once_columns_exist(monkeypatch):
+    db = Database()
+    queued = []
+    monkeypatch.setattr(agribuddy, "user_db", lambda user_id: db)
+    monkeypatch.setattr(agribuddy.message_writer, "enqueue", lambda *args, **kwargs: queued.append(args))
+    memory = ConversationMemory(window=4, summarize_every=2, turn_chars=200, summary_chars=400, maxsize=10)
+    state = {"summary": "", "turns": [], "summarizing": False}
+
+    memory._persist("c1", "farmer", state)
+    memory._persist("c2", "farmer", state)
+    assert memory.persistent
+    assert len(queued) == 2
+    assert db.executed == 1
+    memory.close()
@@ -0,0 +1,122 @@
+"""End-to-end requests through the app against the bench fakes."""
+
+import json
+import os
+import time
+
+import pytest
+
+import app as agribuddy
+from app import AdmissionController, TokenBucket
+
+IMAGES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "images")
+
+
+def eventually(fetch, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        value = fetch()
+        if value or time.monotonic() > deadline:
+            return value
+        time.sleep(0.05)
+
+
+def test_chat_reply_is_saved_to_history(login, upstreams):
+    client = login(0)
+    res = client.post("/chat", json={"message": "When should I irrigate my wheat this week?"})
+    assert res.status_code == 200
+    reply = res.get_json()["reply"]
+    assert reply
+
+    agribuddy.message_writer.flush()
+    conversations = eventually(lambda: client.get("/conversations").get_json()["conversations"])
+    assert len(conversations) == 1
+    messages = eventually(
+        lambda: client.get(f"/conversations/{conversations[0]['id']}/messages").get_json()["messages"])
+    assert [m["role"] for m in messages] == ["user", "assistant"]
+    assert messages[0]["content"] == "When should I irrigate my wheat this week?"
+    assert messages[1]["content"] == reply
+    assert upstreams.stats()["supabase"]["rls_rejections"] == 0
+
+
+def test_history_is_private_to_its_owner(login):
+    owner, other = login(1), login(2)
+    owner.post("/chat", json={"message": "How much urea per acre for cotton at flowering?"})
+    agribuddy.message_writer.flush()
+    conversations = eventually(lambda: owner.get("/conversations").get_json()["conversations"])
+    assert other.get(f"/conversations/{conversations[0]['id']}/messages").status_code == 404
+
+
+def test_chat_stream_sends_deltas_then_done(login):
+    client = login(3)
+    res = client.post("/chat/stream", json={"message": "What is the best time to sow soybean in black soil?"})
+    assert res.status_code == 200
+    assert res.mimetype == "text/event-stream"
+    events = [block for block in res.get_data(as_text=True).split("\n\n") if block]
+    deltas = [json.loads(block[len("data: "):]) for block in events if block.startswith("data: ")]
+    assert deltas[0]["delta"]
+    assert events[-1].startswith("event: done")
+
+
+def test_bulk_weather_looks_up_each_place_once(login):
+    res = login(4).post("/weather/bulk", json={"cities": ["Pune", "pune", "Nashik"], "zips": ["411001"],
+                                               "coordinates": [{"lat": 18.52, "lon": 73.85}]})
+    assert res.status_code == 200
+    body = res.get_json()
+    assert body["requested"] == 5
+    assert body["unique"] == 4
+    assert all("weather" in item for item in body["results"]), body["results"]
+
+
+def test_batch_streams_one_line_per_image_then_summary(login):
+    names = sorted(n for n in os.listdir(IMAGES) if n.endswith(".jpg"))[:3]
+    files = [(open(os.path.join(IMAGES, name), "rb"), name, "image/jpeg") for name in names]
+    try:
+        res = login(5).post("/pest-checker/batch", data={"images": files}, content_type="multipart/form-data")
+    finally:
+        for f, _, _ in files:
+            f.close()
+    assert res.status_code == 200
+    lines = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+    res.close()
+    assert sorted(line["filename"] for line in lines[:-1]) == names
+    assert all(line["status"] == "ok" for line in lines[:-1]), lines
+    for line in lines[:-1]:
+        assert line["result"]["name"] == "Aphids"
+        assert line["result"]["solutions"]
+    summary = lines[-1]["summary"]
+    assert summary["images"] == 3
+    assert summary["issues"] == [{"name": "Aphids", "count": 3}]
+    assert summary["highest_severity"] == "Medium"
+
+
+@pytest.fixture
+def tight_admission(monkeypatch):
+    gate = AdmissionController(TokenBucket(1000, 1000), max_concurrent=1, per_user=1, queue_size=0, queue_timeout=0.1)
+    monkeypatch.setattr(agribuddy, "gemini_admission", gate)
+    return gate
+
+
+def test_chat_is_turned_away_when_gemini_is_saturated(login, tight_admission):
+    tight_admission.acquire()  # a background call holds the only slot
+    try:
+        res = login(6).post("/chat", json={"message": "Which fungicide for tomato blight?"})
+    finally:
+        tight_admission.release()
+    assert res.status_code == 503
+    assert res.get_json()["reason"] == "queue_full"
+    assert int(res.headers["Retry-After"]) >= 1
+
+
+def test_stream_is_429_when_the_user_already_has_a_call(login, tight_admission):
+    client = login(7)
+    with client.session_transaction() as sess:
+        user_id = sess["user_id"]
+    tight_admission.acquire(user_id)
+    try:
+        res = client.post("/chat/stream", json={"message": "How do I control aphids on mustard?"})
+    finally:
+        tight_admission.release(user_id)
+    assert res.status_code == 429
+    assert res.get_json()["reason"] == "user_limit"
+    assert tight_admission.stats()["users_active"] == 0
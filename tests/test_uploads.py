@@ -0,0 +1,123 @@
+import io
+import json
+import threading
+import time
+
+import pytest
+
+import app as agribuddy
+
+
+def logged_in_client():
+    client = agribuddy.app.test_client()
+    with client.session_transaction() as sess:
+        sess["logged_in"] = True
+        sess["user_id"] = "user-0"
+    return client
+
+
+def _declared(client, path, size, content_type="multipart/form-data; boundary=x"):
+    # Only the declared length is large; the body is never there to be read
+    return client.post(path, input_stream=io.BytesIO(b""), content_type=content_type,
+                       environ_overrides={"CONTENT_LENGTH": str(size)})
+
+
+@pytest.mark.parametrize("path, size, content_type", [
+    ("/pest-checker", agribuddy.MAX_IMAGE_BYTES + 2 * 1024 * 1024, "multipart/form-data; boundary=x"),
+    ("/pest-checker/batch", agribuddy.BATCH_MAX_BYTES + 2 * 1024 * 1024, "multipart/form-data; boundary=x"),
+    ("/login", 2 * 1024 * 1024, "application/x-www-form-urlencoded"),
+    ("/chat", 2 * 1024 * 1024, "application/json"),
+    ("/weather/bulk", 2 * 1024 * 1024, "application/json"),
+])
+def test_oversized_body_is_refused_before_parsing(path, size, content_type):
+    res = _declared(logged_in_client(), path, size, content_type)
+    assert res.status_code == 413, path
+    assert "too large" in res.get_json()["error"]
+
+
+def test_batch_accepts_bodies_beyond_the_single_image_cap():
+    res = _declared(logged_in_client(), "/pest-checker/batch", agribuddy.MAX_IMAGE_BYTES + 2 * 1024 * 1024)
+    assert res.status_code != 413
+
+
+
+def _batch(client, count):
+    files = [(io.BytesIO(b"img%d" % i), f"leaf{i}.jpg", "image/jpeg") for i in range(count)]
+    res = client.post("/pest-checker/batch", data={"images": files}, content_type="multipart/form-data")
+    assert res.status_code == 200
+    body = res.get_data(as_text=True)
+    res.close()  # what the WSGI server does once the body is sent
+    return [json.loads(line) for line in body.splitlines()]
+
+
+def test_batch_holds_only_its_share_of_the_vision_pool(monkeypatch):
+    lock, active, peak = threading.Lock(), [0], [0]
+
+    def diagnose(vision_model, raw, user_id):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        return {"name": "Aphids", "severity": "low"}, False
+
+    monkeypatch.setattr(agribuddy, "_diagnose_batch_item", diagnose)
+    monkeypatch.setattr(agribuddy, "BATCH_REQUEST_WORKERS", 2)
+    lines = _batch(logged_in_client(), 8)
+    assert peak[0] == 2
+    assert sorted(line["index"] for line in lines[:-1]) == list(range(8))
+    assert lines[-1]["summary"]["succeeded"] == 8
+
+
+def test_batch_item_deadline_runs_from_submission(monkeypatch):
+    release = threading.Event()
+
+    def diagnose(vision_model, raw, user_id):
+        if raw == b"img0":
+            release.wait(5)
+        return {"name": "Aphids", "severity": "low"}, False
+
+    monkeypatch.setattr(agribuddy, "_diagnose_batch_item", diagnose)
+    monkeypatch.setattr(agribuddy, "BATCH_REQUEST_WORKERS", 1)
+    monkeypatch.setattr(agribuddy, "BATCH_ITEM_TIMEOUT", 0.2)
+    try:
+        lines = _batch(logged_in_client(), 2)
+    finally:
+        release.set()
+    by_index = {line["index"]: line for line in lines[:-1]}
+    assert by_index[0]["error"] == "Timed out"
+    assert by_index[1]["status"] == "ok"
+    assert lines[-1]["summary"]["failed"] == 1
+
+
+def test_batch_items_count_against_the_users_share(monkeypatch):
+    users = []
+
+    def diagnose(vision_model, raw, user_id):
+        users.append(user_id)
+        return {"name": "Aphids", "severity": "low"}, False
+
+    monkeypatch.setattr(agribuddy, "_diagnose_batch_item", diagnose)
+    _batch(logged_in_client(), 3)
+    assert users == ["user-0"] * 3
+
+
+def test_second_concurrent_batch_from_a_user_is_429(monkeypatch):
+    monkeypatch.setattr(agribuddy, "_diagnose_batch_item",
+                        lambda vision_model, raw, user_id: ({"name": "Aphids", "severity": "low"}, False))
+    client = logged_in_client()
+    files = lambda: {"images": [(io.BytesIO(b"img"), "leaf.jpg", "image/jpeg")]}
+    first = client.post("/pest-checker/batch", data=files(), content_type="multipart/form-data")
+    assert first.status_code == 200
+    # The first survey's stream has not been read yet, so it is still running
+    second = client.post("/pest-checker/batch", data=files(), content_type="multipart/form-data")
+    assert second.status_code == 429
+    assert second.get_json()["reason"] == "user_limit"
+    assert int(second.headers["Retry-After"]) >= 1
+    first.get_data()
+    first.close()
+    third = client.post("/pest-checker/batch", data=files(), content_type="multipart/form-data")
+    assert third.status_code == 200
+    third.get_data()
+    third.close()
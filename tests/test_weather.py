@@ -0,0 +1,74 @@
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+import app as agribuddy
+
+
+@pytest.fixture
+def client():
+    return agribuddy.app.test_client()
+
+
+@pytest.mark.parametrize("body, message", [
+    (["Pune"], "body must be a JSON object"),
+    ("Pune", "body must be a JSON object"),
+    ({"cities": "Pune"}, "cities must be a list"),
+    ({"zips": 411001}, "zips must be a list"),
+    ({"coordinates": {"lat": 18.5, "lon": 73.8}}, "coordinates must be a list"),
+    ({"coordinates": [{"lat": "north", "lon": 73.8}]}, "invalid coordinates"),
+    ({"coordinates": [[95, 73.8]]}, "out of range"),
+])
+def test_bulk_rejects_malformed_bodies(client, body, message):
+    res = client.post("/weather/bulk", json=body)
+    assert res.status_code == 400
+    assert message in res.get_json()["error"]
+
+
+def test_bulk_requires_a_location(client):
+    assert client.post("/weather/bulk", json={}).status_code == 400
+
+
+def test_prefetch_zip_geocoding_is_rate_limited(monkeypatch):
+    calls = []
+
+    def fetch(pin):
+        calls.append(pin)
+        return (18.52, 73.85, "Pune"), False
+
+    monkeypatch.setattr(agribuddy, "_fetch_coordinates_by_zip", fetch)
+    empty = agribuddy.TokenBucket(rate=0.001, capacity=1)
+    assert empty.try_acquire()
+    prefetcher = agribuddy.WeatherPrefetcher(60, 600, 10, user_window=600, rate_limiter=empty)
+    prefetcher._users["farmer"] = ("zip", "999001", time.monotonic())
+
+    assert prefetcher.hot_locations() == [("zip", "999001")]
+    assert calls == []
+    assert prefetcher.throttled == 1
+
+    prefetcher.rate_limiter = agribuddy.TokenBucket(rate=1, capacity=1)
+    assert prefetcher.hot_locations() == [("coord", (18.52, 73.85))]
+    assert calls == ["999001"]
+    # Resolved once; later passes use the cache without spending quota
+    assert prefetcher.hot_locations() == [("coord", (18.52, 73.85))]
+    assert calls == ["999001"]
+
+
+def test_bulk_city_names_cannot_inject_openweather_params(client, monkeypatch):
+    sent = []
+    real_get = agribuddy.openweather_http.get
+
+    def recording_get(url, params=None, **kwargs):
+        sent.append(requests.Request("GET", url, params=params).prepare().url)
+        return real_get(url, params=params, **kwargs)
+
+    monkeypatch.setattr(agribuddy.openweather_http, "get", recording_get)
+    res = client.post("/weather/bulk", json={"cities": ["Sawai Madhopur&units=imperial&appid=stolen#x"]})
+    assert res.status_code == 200
+    assert "error" in res.get_json()["results"][0]
+    query = parse_qs(urlparse(sent[0]).query)
+    assert query["q"] == ["Sawai Madhopur&units=imperial&appid=stolen#x"]
+    assert query["units"] == ["metric"]
+    assert query["appid"] == ["bench"]
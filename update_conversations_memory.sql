@@ -0,0 +1,9 @@
+-- SQL commands to store the chat assistant's conversation memory on each conversation
+
+-- Rolling summary of older turns and the most recent turns kept verbatim
+ALTER TABLE public.conversations
+ADD COLUMN IF NOT EXISTS summary TEXT NOT NULL DEFAULT '',
+ADD COLUMN IF NOT EXISTS recent_turns JSONB NOT NULL DEFAULT '[]'::jsonb;
+
+-- The app writes memory with an upsert keyed on id
+GRANT SELECT, INSERT, UPDATE ON public.conversations TO authenticated;
@@ -0,0 +1,19 @@
+-- SQL commands to index conversation and message history for keyset pagination
+
+-- Latest conversations per user (chat lookup and GET /conversations),
+-- tie-broken by id so pages never skip or repeat rows
+CREATE INDEX IF NOT EXISTS idx_conversations_user_updated
+  ON public.conversations(user_id, updated_at DESC, id DESC);
+
+-- Messages of one conversation, newest first (GET /conversations/<id>/messages)
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_created
+  ON public.messages(conversation_id, created_at DESC, id DESC);
+
+-- The composite indexes above cover these; dropping them saves work on every insert
+DROP INDEX IF EXISTS public.idx_conversations_user_id;
+DROP INDEX IF EXISTS public.idx_conversations_updated_at;
+DROP INDEX IF EXISTS public.idx_messages_conversation_id;
+DROP INDEX IF EXISTS public.idx_messages_created_at;
+
+-- On large live tables, run the CREATE statements one by one with CONCURRENTLY
+-- (outside a transaction) to avoid blocking writes while the indexes build
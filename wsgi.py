@@ -0,0 +1,8 @@
+"""Production entry point: ``gunicorn -c gunicorn.conf.py wsgi:app``.
+
+Any WSGI server works; each worker process builds its own Supabase and
+Gemini clients, in the background right after it starts (see CLIENT_WARMUP).
+"""
+from app import create_app
+
+app = create_app()